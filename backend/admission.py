@@ -0,0 +1,204 @@
+"""
+Admission Control - Per-group concurrency limits, bounded queues and per-client rate limits
+
+Requests are sorted into route groups by path prefix. Each group admits a
+fixed number of concurrent requests; beyond that, requests wait in a bounded
+FIFO queue for up to a timeout, and once the queue is full they are turned
+away at once with 503 and Retry-After instead of piling up behind slow
+storage. Login and promo validation also get a per-client token bucket
+(429 when empty). Limits are per worker process. Configuration:
+
+    BOOKHAVEN_ADMISSION_LIMITS         concurrent requests per group, e.g. "auth=64,admin=4" (0 = unlimited)
+    BOOKHAVEN_ADMISSION_QUEUE          requests allowed to wait per group (default 256)
+    BOOKHAVEN_ADMISSION_QUEUE_TIMEOUT  seconds a queued request may wait (default 5)
+    BOOKHAVEN_RETRY_AFTER              Retry-After seconds sent with 503 (default 1)
+    BOOKHAVEN_LOGIN_RATE               "rate/burst" per client per second (default "5/20", 0 = off)
+    BOOKHAVEN_PROMO_RATE               same for /api/promo/validate (default "20/40")
+"""
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Dict, Optional, Tuple
+
+from app_metrics import REGISTRY, Counter, Gauge
+
+# First matching prefix wins; paths outside every group (health, metrics) are never limited
+ROUTE_GROUPS = (
+    ("/api/admin/", "admin"),
+    ("/api/auth/", "auth"),
+    ("/api/promo/", "promo"),
+    ("/api/subscription/", "subscription"),
+    ("/api/themes/", "subscription"),
+)
+
+DEFAULT_LIMITS = {"auth": 64, "promo": 128, "subscription": 128, "admin": 4}
+
+RATE_LIMITED_ROUTES = {
+    ("POST", "/api/auth/login"): ("BOOKHAVEN_LOGIN_RATE", "5/20"),
+    ("POST", "/api/promo/validate"): ("BOOKHAVEN_PROMO_RATE", "20/40"),
+}
+
+ADMISSION_REJECTED = REGISTRY.register(Counter(
+    "bookhaven_admission_rejected_total", "Requests turned away by admission control", ("group", "reason")))
+ADMISSION_QUEUED = REGISTRY.register(Gauge(
+    "bookhaven_admission_queued", "Requests waiting for a concurrency slot", ("group",)))
+
+def route_group(path: str) -> Optional[str]:
+    """Route group a request path belongs to, if any"""
+    for prefix, group in ROUTE_GROUPS:
+        if path.startswith(prefix):
+            return group
+    return None
+
+class ConcurrencyLimiter:
+    """At most `limit` holders, up to `queue_size` FIFO waiters, each waiting at most `timeout` seconds"""
+
+    def __init__(self, group: str, limit: int, queue_size: int, timeout: float):
+        self.group = group
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self._waiters: deque = deque()
+
+    async def acquire(self) -> Optional[str]:
+        """Take a slot; returns None on success or the reason the request was rejected"""
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return None
+        if len(self._waiters) >= self.queue_size:
+            return "queue_full"
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        ADMISSION_QUEUED.inc(self.group)
+        try:
+            # release() hands its slot straight to the waiter, so active is already counted
+            await asyncio.wait_for(waiter, self.timeout)
+            return None
+        except asyncio.TimeoutError:
+            return "queue_timeout"
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            ADMISSION_QUEUED.dec(self.group)
+            if not waiter.done() or waiter.cancelled():
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+
+    def release(self):
+        """Give the slot to the next live waiter, or free it"""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+class RateLimiter:
+    """Token bucket per client: `rate` tokens a second, holding at most `burst`"""
+
+    def __init__(self, rate: float, burst: float, max_clients: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()  # client -> (tokens, updated)
+
+    def allow(self, client: str) -> Tuple[bool, float]:
+        """Spend one token; returns (allowed, seconds until a token is available)"""
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[client] = (tokens, now)
+        # Least recently seen clients are forgotten first; they come back with a full bucket
+        while len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+        return allowed, 0.0 if allowed else (1 - tokens) / self.rate
+
+def _parse_limits(spec: str) -> Dict[str, int]:
+    limits = dict(DEFAULT_LIMITS)
+    for item in spec.split(","):
+        if "=" in item:
+            group, limit = item.split("=", 1)
+            limits[group.strip()] = int(limit)
+    return limits
+
+def _parse_rate(spec: str) -> Optional[Tuple[float, float]]:
+    """Parse "rate/burst" (or just "rate"); None when rate limiting is off"""
+    rate, _, burst = spec.partition("/")
+    rate = float(rate)
+    if rate <= 0:
+        return None
+    return rate, float(burst) if burst else max(rate, 1.0)
+
+async def _reject(send, status: int, detail: str, retry_after: float):
+    body = ('{"detail":"%s"}' % detail).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+class AdmissionMiddleware:
+    """ASGI middleware applying the group limits and rate limits configured in the environment"""
+
+    def __init__(self, app):
+        self.app = app
+        limits = _parse_limits(os.environ.get("BOOKHAVEN_ADMISSION_LIMITS", ""))
+        queue_size = int(os.environ.get("BOOKHAVEN_ADMISSION_QUEUE", 256))
+        timeout = float(os.environ.get("BOOKHAVEN_ADMISSION_QUEUE_TIMEOUT", 5))
+        self.retry_after = float(os.environ.get("BOOKHAVEN_RETRY_AFTER", 1))
+        self.limiters = {
+            group: ConcurrencyLimiter(group, limit, queue_size, timeout)
+            for group, limit in limits.items() if limit > 0
+        }
+        self.rate_limiters = {}
+        for route, (env, default) in RATE_LIMITED_ROUTES.items():
+            rate = _parse_rate(os.environ.get(env, default))
+            if rate:
+                self.rate_limiters[route] = RateLimiter(*rate)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        path = scope["path"]
+        group = route_group(path)
+        rate_limiter = self.rate_limiters.get((scope["method"], path))
+        if rate_limiter is not None:
+            client = scope.get("client")
+            allowed, wait = rate_limiter.allow(client[0] if client else "unknown")
+            if not allowed:
+                ADMISSION_REJECTED.inc(group or "none", "rate_limited")
+                await _reject(send, 429, "Too many requests, slow down", wait)
+                return
+
+        limiter = self.limiters.get(group)
+        if limiter is None:
+            await self.app(scope, receive, send)
+            return
+
+        reason = await limiter.acquire()
+        if reason is not None:
+            ADMISSION_REJECTED.inc(group, reason)
+            await _reject(send, 503, "Server busy, retry later", self.retry_after)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
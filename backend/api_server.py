@@ -1,14 +1,27 @@
 """
 FastAPI Server for Subscription and Theme Management
 """
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response
 from pydantic import BaseModel
 from typing import Dict, List, Optional
+import asyncio
+import os
 import uvicorn
+from admission import AdmissionMiddleware
+from app_logging import log_requests
+from app_metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsMiddleware, render_metrics
+from fast_json import FastJSONResponse
 from subscription_service import SubscriptionService, SubscriptionTier
+from subscription_storage import create_subscription_storage
+from session_store import Session, optional_session
 
-app = FastAPI(title="Bookstore Subscription API", version="1.0.0")
+app = FastAPI(title="Bookstore Subscription API", version="1.0.0", default_response_class=FastJSONResponse)
+
+# Concurrency limits, wait queues and login/promo rate limits (innermost, behind CORS and logging)
+app.add_middleware(AdmissionMiddleware)
 
 # Enable CORS for frontend integration
 app.add_middleware(
@@ -19,8 +32,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize subscription service
-subscription_service = SubscriptionService()
+# Request ids and access logging
+app.middleware("http")(log_requests)
+
+# Per-route counters and latency histograms (outermost, so it times everything)
+app.add_middleware(MetricsMiddleware)
+
+# Initialize subscription service; use the sqlite backend when running several workers
+subscription_service = SubscriptionService(storage=create_subscription_storage(
+    os.environ.get("BOOKHAVEN_SUBSCRIPTION_DB_BACKEND", "json"),
+    os.environ.get("BOOKHAVEN_SUBSCRIPTION_DB_FILE"),
+    durability=os.environ.get("BOOKHAVEN_SUBSCRIPTION_DB_DURABILITY", "batched")
+))
 
 # Pydantic models for API requests/responses
 class PaymentRequest(BaseModel):
@@ -47,15 +70,26 @@ class ThemeAccessRequest(BaseModel):
     user_id: str
     theme_id: str
 
+class ThemeAccessBatchRequest(BaseModel):
+    # Either a list of (user, theme) pairs, or one user_id with many theme_ids
+    checks: List[ThemeAccessRequest] = []
+    user_id: Optional[str] = None
+    theme_ids: List[str] = []
+
 class ThemeValidationResponse(BaseModel):
     has_access: bool
     theme_name: Optional[str] = None
     required_tier: Optional[str] = None
 
 @app.post("/api/subscription/process")
-async def process_subscription(payment_request: PaymentRequest, background_tasks: BackgroundTasks):
+async def process_subscription(payment_request: PaymentRequest, background_tasks: BackgroundTasks,
+                               session: Optional[Session] = Depends(optional_session)):
     """Process a subscription payment and immediately unlock themes"""
     try:
+        # A signed-in caller may only subscribe for their own account
+        if session and session.user_id != payment_request.user_id:
+            raise HTTPException(status_code=403, detail="Session does not match user")
+        
         # Validate payment data (in production, integrate with payment processor)
         if not payment_request.card_number or len(payment_request.card_number) < 16:
             raise HTTPException(status_code=400, detail="Invalid card number")
@@ -75,8 +109,10 @@ async def process_subscription(payment_request: PaymentRequest, background_tasks
             'cardholder_name': payment_request.card_name
         }
         
-        # Process subscription and unlock themes immediately
-        result = subscription_service.process_subscription(
+        # Process subscription and unlock themes immediately; the storage
+        # write (and its fsync) runs off the event loop
+        result = await run_in_threadpool(
+            subscription_service.process_subscription,
             payment_request.user_id, 
             payment_request.plan, 
             payment_data
@@ -86,7 +122,7 @@ async def process_subscription(payment_request: PaymentRequest, background_tasks
             raise HTTPException(status_code=500, detail=result.message)
         
         # Return immediate response with unlocked themes
-        return {
+        return FastJSONResponse({
             "success": True,
             "message": result.message,
             "subscription": {
@@ -96,24 +132,11 @@ async def process_subscription(payment_request: PaymentRequest, background_tasks
                 "transaction_id": result.subscription.transaction_id
             },
             "unlocked_themes": [
-                {
-                    "id": theme.id,
-                    "name": theme.name,
-                    "description": theme.description,
-                    "colors": theme.colors,
-                    "tier": theme.tier.value
-                }
-                for theme in result.unlocked_themes
+                theme.to_dict() for theme in result.unlocked_themes
             ],
-            "auto_applied_theme": {
-                "id": result.auto_applied_theme.id,
-                "name": result.auto_applied_theme.name,
-                "description": result.auto_applied_theme.description,
-                "colors": result.auto_applied_theme.colors,
-                "tier": result.auto_applied_theme.tier.value
-            } if result.auto_applied_theme else None,
+            "auto_applied_theme": result.auto_applied_theme.to_dict() if result.auto_applied_theme else None,
             "total_available_themes": len(subscription_service.get_themes_for_tier(result.subscription.tier))
-        }
+        })
         
     except HTTPException:
         raise
@@ -124,8 +147,9 @@ async def process_subscription(payment_request: PaymentRequest, background_tasks
 async def get_subscription_status(user_id: str):
     """Get current subscription status and available themes for a user"""
     try:
-        status = subscription_service.get_user_subscription_status(user_id)
-        return status
+        # Reads may catch up on other workers' storage writes, so keep them off the event loop
+        content = await run_in_threadpool(subscription_service.get_user_subscription_status_json, user_id)
+        return Response(content=content, media_type="application/json")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get subscription status: {str(e)}")
 
@@ -133,7 +157,9 @@ async def get_subscription_status(user_id: str):
 async def validate_theme_access(request: ThemeAccessRequest):
     """Validate if a user has access to a specific theme"""
     try:
-        has_access = subscription_service.validate_theme_access(request.user_id, request.theme_id)
+        has_access = await run_in_threadpool(
+            subscription_service.validate_theme_access, request.user_id, request.theme_id
+        )
         
         theme = subscription_service.themes.get(request.theme_id)
         if not theme:
@@ -149,17 +175,42 @@ async def validate_theme_access(request: ThemeAccessRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Theme validation failed: {str(e)}")
 
+# Largest batch accepted by /api/themes/validate-access/batch
+MAX_BATCH_CHECKS = int(os.environ.get("BOOKHAVEN_MAX_BATCH_CHECKS", 1000))
+
+@app.post("/api/themes/validate-access/batch")
+async def validate_theme_access_batch(request: ThemeAccessBatchRequest):
+    """Validate many theme access checks in one call.
+
+    Returns {"has_access": [...]} in request order, with null for unknown themes.
+    """
+    if request.user_id is not None and request.checks:
+        raise HTTPException(status_code=400, detail="Send either checks or user_id with theme_ids, not both")
+    if request.user_id is None and request.theme_ids:
+        raise HTTPException(status_code=400, detail="theme_ids needs a user_id")
+    count = len(request.theme_ids) if request.user_id is not None else len(request.checks)
+    if count > MAX_BATCH_CHECKS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_CHECKS} checks per batch")
+    try:
+        if request.user_id is not None:
+            results = await run_in_threadpool(
+                subscription_service.validate_user_theme_access, request.user_id, request.theme_ids
+            )
+        else:
+            results = await run_in_threadpool(
+                subscription_service.validate_theme_access_batch,
+                [(check.user_id, check.theme_id) for check in request.checks]
+            )
+        return FastJSONResponse({"has_access": results})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Theme validation failed: {str(e)}")
+
 @app.get("/api/themes/available/{user_id}")
 async def get_available_themes(user_id: str):
     """Get all themes available to a user based on their subscription"""
     try:
-        status = subscription_service.get_user_subscription_status(user_id)
-        return {
-            "available_themes": status["available_themes"],
-            "total_themes": status["total_themes"],
-            "subscription_tier": status["tier"],
-            "is_premium": status["is_premium"]
-        }
+        content = await run_in_threadpool(subscription_service.get_available_themes_json, user_id)
+        return Response(content=content, media_type="application/json")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get available themes: {str(e)}")
 
@@ -167,19 +218,33 @@ async def get_available_themes(user_id: str):
 async def get_all_themes():
     """Get all themes with their tier requirements"""
     try:
-        all_themes = []
-        for theme in subscription_service.themes.values():
-            all_themes.append({
-                "id": theme.id,
-                "name": theme.name,
-                "description": theme.description,
-                "colors": theme.colors,
-                "tier": theme.tier.value
-            })
-        return {"themes": all_themes}
+        all_themes = [theme.to_dict() for theme in subscription_service.themes.values()]
+        return FastJSONResponse({"themes": all_themes})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get themes: {str(e)}")
 
+# Background sweep that downgrades expired subscriptions in batches
+expiry_task: Optional[asyncio.Task] = None
+
+@app.on_event("startup")
+async def start_expiry_sweeper():
+    """Start downgrading expired subscriptions in the background"""
+    global expiry_task
+    interval = float(os.environ.get("BOOKHAVEN_EXPIRY_INTERVAL", 30))
+    expiry_task = asyncio.create_task(subscription_service.run_expiry_loop(interval))
+
+@app.on_event("shutdown")
+async def stop_expiry_sweeper():
+    """Stop the expiry sweep and flush the subscription store"""
+    if expiry_task is not None:
+        expiry_task.cancel()
+    await run_in_threadpool(subscription_service.close)
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus metrics for this process"""
+    return Response(content=render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
@@ -0,0 +1,171 @@
+"""
+App Logging - Queue-backed structured logging shared by every backend module
+
+Loggers hand records to an in-memory queue; a single listener thread formats
+them (one JSON object per line by default) and writes them out, so request
+threads never wait on stdout. Configuration comes from the environment:
+
+    BOOKHAVEN_LOG_LEVEL        root level for bookhaven loggers (default INFO)
+    BOOKHAVEN_LOG_LEVELS       per-module overrides, e.g. "user_database=WARNING,api_server=DEBUG"
+    BOOKHAVEN_LOG_FORMAT       "json" (default) or "text"
+    BOOKHAVEN_LOG_QUEUE_SIZE   records buffered before new ones are dropped (default 10000)
+"""
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+ROOT_LOGGER = "bookhaven"
+
+# Request id of the request being handled by the current task or thread
+request_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with the event's structured fields inlined"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id:
+            entry["request_id"] = request_id
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class TextFormatter(logging.Formatter):
+    """Human-readable single-line records for local development"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = getattr(record, "fields", None) or {}
+        request_id = getattr(record, "request_id", None)
+        parts = [f"{self.formatTime(record)} {record.levelname} {record.name}: {record.getMessage()}"]
+        if request_id:
+            parts.append(f"request_id={request_id}")
+        parts.extend(f"{key}={value}" for key, value in fields.items())
+        text = " ".join(parts)
+        if record.exc_info:
+            text += "\n" + self.formatException(record.exc_info)
+        return text
+
+class NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler that stamps the request id and drops records when the queue is full.
+
+    Formatting is left to the listener thread; only the message
+    interpolation happens on the caller's thread.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.request_id = request_id_var.get()
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+_lock = threading.Lock()
+_listener: Optional[QueueListener] = None
+_handler: Optional[NonBlockingQueueHandler] = None
+
+def _parse_levels(spec: str):
+    for item in spec.split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            yield name.strip(), level.strip().upper()
+
+def configure_logging():
+    """Install the queue handler and start the listener (idempotent)"""
+    global _listener, _handler
+    with _lock:
+        if _listener is not None:
+            return
+
+        formatter = TextFormatter() if os.environ.get("BOOKHAVEN_LOG_FORMAT") == "text" else JsonFormatter()
+        output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(formatter)
+
+        log_queue = queue.Queue(maxsize=int(os.environ.get("BOOKHAVEN_LOG_QUEUE_SIZE", 10000)))
+        _handler = NonBlockingQueueHandler(log_queue)
+        root = logging.getLogger(ROOT_LOGGER)
+        root.addHandler(_handler)
+        root.setLevel(os.environ.get("BOOKHAVEN_LOG_LEVEL", "INFO").upper())
+        root.propagate = False
+        for name, level in _parse_levels(os.environ.get("BOOKHAVEN_LOG_LEVELS", "")):
+            logging.getLogger(f"{ROOT_LOGGER}.{name}").setLevel(level)
+
+        _listener = QueueListener(log_queue, output, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown_logging)
+
+def shutdown_logging():
+    """Drain queued records and stop the listener thread"""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+            logging.getLogger(ROOT_LOGGER).removeHandler(_handler)
+
+def dropped_records() -> int:
+    """Records discarded because the queue was full"""
+    return _handler.dropped if _handler is not None else 0
+
+def get_logger(name: str) -> logging.Logger:
+    """Logger for a backend module, e.g. get_logger("user_database")"""
+    configure_logging()
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+def log_event(logger: logging.Logger, event: str, level: int = logging.INFO, **fields):
+    """Log a structured event; fields become top-level keys of the JSON record"""
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={"fields": fields})
+
+def elapsed_ms(started: float) -> float:
+    """Milliseconds since a time.perf_counter() reading"""
+    return round((time.perf_counter() - started) * 1000, 3)
+
+_access_logger = None
+
+async def log_requests(request, call_next):
+    """HTTP middleware: tag the request with an id and log its outcome and timing"""
+    global _access_logger
+    if _access_logger is None:
+        _access_logger = get_logger("http")
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex
+    token = request_id_var.set(request_id)
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    except Exception:
+        _access_logger.exception("request_failed", extra={"fields": {
+            "method": request.method, "path": request.url.path, "duration_ms": elapsed_ms(started)
+        }})
+        raise
+    finally:
+        request_id_var.reset(token)
+    response.headers["X-Request-ID"] = request_id
+    log_event(_access_logger, "request", method=request.method, path=request.url.path,
+              status=response.status_code, duration_ms=elapsed_ms(started), request_id=request_id)
+    return response
@@ -0,0 +1,237 @@
+"""
+App Metrics - In-process request and operation metrics in Prometheus text format
+
+Every recording is a dict update under a per-metric lock, so the hot path
+pays a couple of perf_counter() calls and no I/O. Metrics are per process;
+with several workers, scrape each one (or label them by instance). Exposed:
+
+    bookhaven_http_requests_total{method,route,status}
+    bookhaven_http_request_errors_total{method,route}      5xx responses and unhandled exceptions
+    bookhaven_http_requests_in_flight
+    bookhaven_http_request_duration_seconds{method,route}  histogram
+    bookhaven_operation_duration_seconds{operation}         histogram, via @timed
+    bookhaven_operation_failures_total{operation}           exceptions and success=False results
+"""
+import asyncio
+import bisect
+import functools
+import math
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)) + "}"
+
+class Metric:
+    """A named family of samples keyed by label values"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        """(sample name, formatted labels, value) for every label combination"""
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in self.samples())
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value: float, *labels: str):
+        with self._lock:
+            self._values[labels] = value
+
+class Histogram(Metric):
+    """Fixed-bucket histogram; per label set it keeps per-bucket counts and a sum"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        with self._lock:
+            items = [(labels, list(state[0]), state[1]) for labels, state in self._values.items()]
+        names = self.labelnames + ("le",)
+        for labels, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", _format_labels(names, labels + (_format_value(bound),)), cumulative
+            yield f"{self.name}_sum", _format_labels(self.labelnames, labels), total
+            yield f"{self.name}_count", _format_labels(self.labelnames, labels), cumulative
+
+class MetricsRegistry:
+    """Metrics of this process, rendered together for /metrics"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """Add a metric, or return the one already registered under its name"""
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        """Prometheus text exposition of every registered metric"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+
+HTTP_REQUESTS = REGISTRY.register(Counter(
+    "bookhaven_http_requests_total", "HTTP requests by route and status", ("method", "route", "status")))
+HTTP_ERRORS = REGISTRY.register(Counter(
+    "bookhaven_http_request_errors_total", "HTTP requests that ended in a 5xx or an exception", ("method", "route")))
+HTTP_IN_FLIGHT = REGISTRY.register(Gauge(
+    "bookhaven_http_requests_in_flight", "HTTP requests currently being handled"))
+HTTP_DURATION = REGISTRY.register(Histogram(
+    "bookhaven_http_request_duration_seconds", "HTTP request latency by route", ("method", "route")))
+OPERATION_DURATION = REGISTRY.register(Histogram(
+    "bookhaven_operation_duration_seconds", "Latency of instrumented domain operations", ("operation",)))
+OPERATION_FAILURES = REGISTRY.register(Counter(
+    "bookhaven_operation_failures_total", "Domain operations that raised or reported success=False", ("operation",)))
+
+def _failed(result) -> bool:
+    """Whether an operation result reports failure the way this codebase does"""
+    if isinstance(result, dict):
+        return result.get("success") is False
+    return getattr(result, "success", None) is False
+
+def timed(operation: str) -> Callable:
+    """Decorator recording latency and failures of a sync or async domain call"""
+    def decorate(fn: Callable) -> Callable:
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    result = await fn(*args, **kwargs)
+                except Exception:
+                    OPERATION_FAILURES.inc(operation)
+                    raise
+                finally:
+                    OPERATION_DURATION.observe(time.perf_counter() - started, operation)
+                if _failed(result):
+                    OPERATION_FAILURES.inc(operation)
+                return result
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                OPERATION_FAILURES.inc(operation)
+                raise
+            finally:
+                OPERATION_DURATION.observe(time.perf_counter() - started, operation)
+            if _failed(result):
+                OPERATION_FAILURES.inc(operation)
+            return result
+        return wrapper
+    return decorate
+
+def render_metrics() -> str:
+    """Body for a /metrics endpoint"""
+    return REGISTRY.render()
+
+class MetricsMiddleware:
+    """ASGI middleware recording per-route counts, errors, in-flight requests and latency.
+
+    Routes are labelled with their template (e.g. /api/auth/user/{email}),
+    which the router leaves in the scope, so label cardinality stays fixed.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        except Exception:
+            status = 500
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            HTTP_IN_FLIGHT.dec()
+            method = scope["method"]
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_REQUESTS.inc(method, route, str(status))
+            if status >= 500:
+                HTTP_ERRORS.inc(method, route)
+            HTTP_DURATION.observe(elapsed, method, route)
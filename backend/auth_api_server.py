@@ -1,14 +1,33 @@
 """
 Authentication and Promo Code API Server
 """
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel, EmailStr
 from typing import Optional, List
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import io
+import json
+import multiprocessing
+import os
+import tempfile
 import uvicorn
-from user_database import user_db
+from admission import AdmissionMiddleware
+from app_logging import log_requests
+from app_metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsMiddleware, render_metrics
+from fast_json import FastJSONResponse
+from response_cache import CACHE_CONTROL
+from user_database import PROMO_CODES_CACHE_KEY, async_user_db, user_cache_key, user_db
+from user_import import IMPORT_FORMATS, read_rows
+from session_store import Session, bearer_token, session_store, require_session
 
-app = FastAPI(title="BookHaven Auth API", version="1.0.0")
+app = FastAPI(title="BookHaven Auth API", version="1.0.0", default_response_class=FastJSONResponse)
+
+# Concurrency limits, wait queues and login/promo rate limits (innermost, behind CORS and logging)
+app.add_middleware(AdmissionMiddleware)
 
 # CORS middleware
 app.add_middleware(
@@ -19,6 +38,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request ids and access logging
+app.middleware("http")(log_requests)
+
+# Per-route counters and latency histograms (outermost, so it times everything)
+app.add_middleware(MetricsMiddleware)
+
 # Pydantic models
 class UserRegistration(BaseModel):
     email: EmailStr
@@ -40,11 +65,18 @@ class PremiumUpdate(BaseModel):
     is_premium: bool
     plan: Optional[str] = None
 
+def cached_response(etag: str, body: Optional[bytes]) -> Response:
+    """200 with a pre-serialized body, or 304 when body is None"""
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if body is None:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 # Authentication endpoints
 @app.post("/api/auth/register")
 async def register_user(user_data: UserRegistration):
     """Register a new user"""
-    result = user_db.register_user(
+    result = await async_user_db.register_user(
         user_data.email,
         user_data.password,
         user_data.first_name,
@@ -54,40 +86,58 @@ async def register_user(user_data: UserRegistration):
     if not result["success"]:
         raise HTTPException(status_code=400, detail=result["error"])
     
-    return result
+    return FastJSONResponse(result)
 
 @app.post("/api/auth/login")
 async def login_user(login_data: UserLogin):
     """Authenticate user login"""
-    result = user_db.authenticate_user(login_data.email, login_data.password)
+    result = await async_user_db.authenticate_user(login_data.email, login_data.password)
     
     if not result["success"]:
         raise HTTPException(status_code=401, detail=result["error"])
     
-    return result
+    # Issue a session so later requests don't need to resend credentials
+    token, session = session_store.issue(result["user"])
+    result["session_token"] = token
+    result["expires_at"] = session.expires_at
+    return FastJSONResponse(result)
 
-@app.get("/api/auth/user/{email}")
-async def get_user(email: str):
-    """Get user information by email"""
-    user = user_db.get_user_by_email(email)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
+@app.post("/api/auth/logout")
+async def logout_user(session: Session = Depends(require_session), authorization: str = Header(None)):
+    """Revoke the caller's session token"""
+    session_store.revoke(bearer_token(authorization))
+    return {"success": True, "message": "Logged out successfully"}
+
+@app.get("/api/auth/session")
+async def get_session(session: Session = Depends(require_session)):
+    """Get the user behind the caller's session token"""
     return {
-        "id": user.id,
-        "email": user.email,
-        "first_name": user.first_name,
-        "last_name": user.last_name,
-        "is_premium": user.is_premium,
-        "premium_plan": user.premium_plan,
-        "role": user.role
+        "user_id": session.user_id,
+        "email": session.email,
+        "role": session.role,
+        "is_premium": session.is_premium,
+        "expires_at": session.expires_at
     }
 
+def user_info(email: str) -> Optional[dict]:
+    user = user_db.get_user_by_email(email)
+    return user.public_dict() if user else None
+
+@app.get("/api/auth/user/{email}")
+async def get_user(email: str, if_none_match: Optional[str] = Header(None)):
+    """Get user information by email (supports If-None-Match)"""
+    etag, body = await async_user_db.cached_payload(
+        user_cache_key(email), lambda: user_info(email), if_none_match
+    )
+    if etag is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return cached_response(etag, body)
+
 # Promo code endpoints
 @app.post("/api/promo/validate")
 async def validate_promo_code(promo_data: PromoCodeValidation):
     """Validate a promotional code"""
-    result = user_db.validate_promo_code(
+    result = await async_user_db.validate_promo_code(
         promo_data.code,
         promo_data.order_total,
         promo_data.cart_items
@@ -101,15 +151,43 @@ async def validate_promo_code(promo_data: PromoCodeValidation):
 @app.post("/api/promo/use/{code}")
 async def use_promo_code(code: str):
     """Mark a promo code as used"""
-    success = user_db.use_promo_code(code)
+    success = await async_user_db.use_promo_code(code)
     if not success:
         raise HTTPException(status_code=400, detail="Failed to use promo code")
     
     return {"success": True, "message": "Promo code used successfully"}
 
-@app.get("/api/promo/codes")
-async def list_promo_codes():
-    """List all available promo codes (for admin)"""
+@app.post("/api/promo/reserve")
+async def reserve_promo_code(promo_data: PromoCodeValidation):
+    """Validate a promotional code and hold one use of it during checkout"""
+    result = await async_user_db.reserve_promo_code(
+        promo_data.code,
+        promo_data.order_total,
+        promo_data.cart_items
+    )
+    
+    if not result["success"]:
+        raise HTTPException(status_code=400, detail=result["error"])
+    
+    return result
+
+@app.post("/api/promo/commit/{reservation_id}")
+async def commit_promo_reservation(reservation_id: str):
+    """Record the promo code use held by a reservation"""
+    if not await async_user_db.commit_promo_reservation(reservation_id):
+        raise HTTPException(status_code=409, detail="Reservation not found or expired")
+    
+    return {"success": True, "message": "Promo code used successfully"}
+
+@app.post("/api/promo/release/{reservation_id}")
+async def release_promo_reservation(reservation_id: str):
+    """Release a promo code reservation without using it"""
+    if not await async_user_db.release_promo_reservation(reservation_id):
+        raise HTTPException(status_code=404, detail="Reservation not found")
+    
+    return {"success": True, "message": "Promo code reservation released"}
+
+def promo_code_listing() -> dict:
     return {
         "promo_codes": [
             {
@@ -123,15 +201,21 @@ async def list_promo_codes():
                 "is_active": promo.is_active,
                 "minimum_order": promo.minimum_order
             }
-            for promo in user_db.promo_codes.values()
+            for promo in user_db.list_promo_codes()
         ]
     }
 
+@app.get("/api/promo/codes")
+async def list_promo_codes(if_none_match: Optional[str] = Header(None)):
+    """List all available promo codes (for admin, supports If-None-Match)"""
+    etag, body = await async_user_db.cached_payload(PROMO_CODES_CACHE_KEY, promo_code_listing, if_none_match)
+    return cached_response(etag, body)
+
 # Premium status endpoints
 @app.post("/api/auth/premium/update")
 async def update_premium_status(premium_data: PremiumUpdate):
     """Update user's premium status"""
-    success = user_db.update_user_premium_status(
+    success = await async_user_db.update_user_premium_status(
         premium_data.email,
         premium_data.is_premium,
         premium_data.plan
@@ -144,9 +228,76 @@ async def update_premium_status(premium_data: PremiumUpdate):
 
 # Admin endpoints
 @app.get("/api/admin/users")
-async def list_users():
-    """List all users (admin only)"""
-    return {"users": user_db.list_all_users()}
+async def list_users(limit: int = Query(100, ge=1, le=1000), cursor: Optional[str] = None,
+                     role: Optional[str] = None, is_premium: Optional[bool] = None,
+                     premium_plan: Optional[str] = None, created_from: Optional[datetime] = None,
+                     created_to: Optional[datetime] = None, stream: bool = False):
+    """List users (admin only), a page at a time or streamed as NDJSON"""
+    filters = dict(
+        role=role,
+        is_premium=is_premium,
+        premium_plan=premium_plan,
+        created_from=created_from.isoformat() if created_from else None,
+        created_to=created_to.isoformat() if created_to else None
+    )
+    try:
+        if stream:
+            users = user_db.iter_users(cursor, **filters)
+            return StreamingResponse(
+                (json.dumps(user) + "\n" for user in users),
+                media_type="application/x-ndjson"
+            )
+        return await async_user_db.list_users_page(limit, cursor, **filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Password hashing pool for imports, started on first use like user_import.py's
+_import_executor: Optional[ProcessPoolExecutor] = None
+
+def import_executor() -> ProcessPoolExecutor:
+    global _import_executor
+    if _import_executor is None:
+        # Spawned workers only import password_hashing, never the database
+        _import_executor = ProcessPoolExecutor(
+            max_workers=int(os.environ.get("BOOKHAVEN_IMPORT_WORKERS", os.cpu_count() or 1)),
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _import_executor
+
+@app.post("/api/admin/users/import")
+async def import_users(request: Request, format: str = "ndjson",
+                       batch_size: int = Query(1000, ge=1, le=10000),
+                       session: Session = Depends(require_session)):
+    """Bulk import users from a raw CSV or NDJSON request body (admin only)"""
+    if session.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    if format not in IMPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown import format: {format}")
+
+    # Spool the upload (to disk past 8 MB) so large files never sit in memory
+    with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as spool:
+        async for chunk in request.stream():
+            # Past the threshold this is a blocking disk write
+            await run_in_threadpool(spool.write, chunk)
+        spool.seek(0)
+        text = io.TextIOWrapper(spool, encoding='utf-8', newline='')
+        try:
+            return await async_user_db.import_users(read_rows(text, format), batch_size,
+                                                    executor=import_executor())
+        finally:
+            text.detach()
+
+@app.on_event("shutdown")
+async def flush_user_database():
+    """Make sure every queued user change reaches disk before exiting"""
+    await async_user_db.close()
+    if _import_executor is not None:
+        _import_executor.shutdown(wait=True)
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus metrics for this process"""
+    return Response(content=render_metrics(), media_type=METRICS_CONTENT_TYPE)
 
 @app.get("/api/health")
 async def health_check():
@@ -158,11 +309,17 @@ if __name__ == "__main__":
     print("Available endpoints:")
     print("- POST /api/auth/register - Register new user")
     print("- POST /api/auth/login - User login")
+    print("- POST /api/auth/logout - Revoke session token")
+    print("- GET /api/auth/session - Get session user")
     print("- GET /api/auth/user/{email} - Get user info")
     print("- POST /api/promo/validate - Validate promo code")
     print("- POST /api/promo/use/{code} - Use promo code")
+    print("- POST /api/promo/reserve - Reserve promo code use")
+    print("- POST /api/promo/commit/{reservation_id} - Commit reservation")
+    print("- POST /api/promo/release/{reservation_id} - Release reservation")
     print("- GET /api/promo/codes - List promo codes")
     print("- POST /api/auth/premium/update - Update premium status")
-    print("- GET /api/admin/users - List all users")
+    print("- GET /api/admin/users - List users (paginated, ?stream=true for NDJSON)")
+    print("- POST /api/admin/users/import - Bulk import users (CSV or NDJSON body)")
     
     uvicorn.run(app, host="0.0.0.0", port=8002)
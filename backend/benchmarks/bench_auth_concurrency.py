@@ -0,0 +1,114 @@
+"""
+Auth Concurrency Benchmark - Login latency with blocking vs offloaded storage
+
+Fires N parallel logins at the auth API in-process (httpx ASGI transport)
+while a probe keeps hitting /api/health, once against handlers that call
+UserDatabase synchronously (the old behaviour) and once against the real
+auth_api_server handlers, which go through AsyncUserDatabase. Probe latency
+shows how long the event loop was blocked for everyone else.
+
+Usage:
+    python benchmarks/bench_auth_concurrency.py [--logins 500] [--users 50] [--n 4096]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import httpx
+except ImportError:
+    sys.exit("This benchmark needs httpx (pip install httpx)")
+
+def percentile(samples, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def blocking_app(user_db):
+    """Login handler as it was before AsyncUserDatabase: sync storage + KDF inside async def"""
+    from fastapi import FastAPI, HTTPException
+    from auth_api_server import UserLogin
+
+    app = FastAPI()
+
+    @app.post("/api/auth/login")
+    async def login_user(login_data: UserLogin):
+        result = user_db.authenticate_user(login_data.email, login_data.password)
+        if not result["success"]:
+            raise HTTPException(status_code=401, detail=result["error"])
+        return result
+
+    @app.get("/api/health")
+    async def health_check():
+        return {"status": "healthy"}
+
+    return app
+
+async def probe(client, stop: asyncio.Event, latencies, interval: float = 0.005):
+    """Time /api/health every `interval` until the logins finish, counting time spent waiting for the loop"""
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        await client.get("/api/health")
+        latencies.append(time.perf_counter() - started - interval)
+
+async def run(app, logins: int, users: int):
+    """Run `logins` concurrent logins; returns (seconds, login latencies, probe latencies)"""
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        login_latencies, probe_latencies = [], []
+
+        async def login(i: int):
+            response = await client.post("/api/auth/login", json={
+                "email": f"bench{i % users}@example.com", "password": "bench-password"
+            })
+            assert response.status_code == 200, response.text
+            # Every login is sent at once, so latency counts from the common start
+            login_latencies.append(time.perf_counter() - started)
+
+        stop = asyncio.Event()
+        probe_task = asyncio.create_task(probe(client, stop, probe_latencies))
+        await asyncio.sleep(0)
+        started = time.perf_counter()
+        await asyncio.gather(*(login(i) for i in range(logins)))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await probe_task
+        return elapsed, login_latencies, probe_latencies
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--logins", type=int, default=500)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--n", type=int, default=2 ** 12, help="scrypt cost for the benchmark users")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench-auth-")
+    os.environ["BOOKHAVEN_USER_DB_FILE"] = os.path.join(workdir, "users.json")
+    os.environ["BOOKHAVEN_SCRYPT_N"] = str(args.n)
+    os.environ.setdefault("BOOKHAVEN_LOG_LEVEL", "WARNING")
+    os.environ.setdefault("BOOKHAVEN_LOGIN_RATE", "0")
+
+    import auth_api_server
+    from user_database import user_db
+
+    for i in range(args.users):
+        user_db.register_user(f"bench{i}@example.com", "bench-password", "Bench", str(i))
+
+    print(f"{args.logins} parallel logins over {args.users} users, scrypt n={args.n}, {os.cpu_count()} CPUs")
+    print(f"{'handlers':>10} {'logins/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'probe p50':>10} {'probe p99':>10}")
+    for name, app in (("blocking", blocking_app(user_db)), ("offloaded", auth_api_server.app)):
+        elapsed, logins, probes = asyncio.run(run(app, args.logins, args.users))
+        print(f"{name:>10} {args.logins / elapsed:>9.1f} "
+              f"{statistics.median(logins) * 1000:>8.1f} {percentile(logins, 0.99) * 1000:>8.1f} "
+              f"{statistics.median(probes) * 1000:>10.1f} {percentile(probes, 0.99) * 1000:>10.1f}")
+
+    user_db.close()
+
+if __name__ == "__main__":
+    main()
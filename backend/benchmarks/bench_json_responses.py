@@ -0,0 +1,94 @@
+"""
+JSON Response Benchmark - Default FastAPI encoding vs the fast serialization path
+
+Compares, per response body, the old path (asdict() per theme, then
+jsonable_encoder + json.dumps as JSONResponse does) against to_dict()
+serializers rendered by fast_json.dumps (orjson when installed, stdlib
+json otherwise) for the subscription status, theme list and order payloads,
+plus the per-tier pre-encoded status body the API actually serves.
+
+Usage:
+    python benchmarks/bench_json_responses.py [--iterations 20000]
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+from dataclasses import asdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOOKHAVEN_LOG_LEVEL", "WARNING")
+
+from fastapi.encoders import jsonable_encoder
+
+import fast_json
+from ecommerce_platform import (CartItem, EcommercePlatform, Order, OrderStatus, PaymentInfo,
+                                PaymentMethod, ShippingAddress, ShippingMethod)
+from subscription_service import SubscriptionService, SubscriptionTier
+
+def default_render(content) -> bytes:
+    """What FastAPI does for a returned dict: jsonable_encoder, then JSONResponse.render"""
+    return json.dumps(jsonable_encoder(content), ensure_ascii=False, allow_nan=False,
+                      indent=None, separators=(",", ":")).encode("utf-8")
+
+def time_per_call(fn, iterations: int) -> float:
+    """Microseconds per call, best of three runs"""
+    best = float("inf")
+    for _ in range(3):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        best = min(best, time.perf_counter() - started)
+    return best / iterations * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    service = SubscriptionService()
+    service.process_subscription("bench-user", "yearly", {"transaction_id": "TXN-BENCH"})
+    themes = service.get_themes_for_tier(SubscriptionTier.YEARLY)
+    subscription = service.subscriptions["bench-user"]
+
+    platform = EcommercePlatform()
+    order = Order(
+        id="ORD-BENCH", user_id="bench-user",
+        items=[CartItem(book, 1) for book in platform.books.values()],
+        shipping_address=ShippingAddress("Bench", "User", "1 Main St", city="Springfield"),
+        payment_info=PaymentInfo(PaymentMethod.CREDIT_CARD, "4111111111111111", "Bench User", "12/30", "123"),
+        shipping_method=ShippingMethod.STANDARD, subtotal=42.0, shipping_cost=4.99, tax=3.36, total=50.35,
+        status=OrderStatus.CONFIRMED, created_at=datetime.datetime.now(), digital_downloads=[]
+    )
+
+    def status_old():
+        status = service.get_user_subscription_status("bench-user")
+        status["available_themes"] = [asdict(theme) for theme in themes]
+        return default_render(status)
+
+    cases = [
+        ("subscription status", status_old,
+         lambda: fast_json.dumps(service.get_user_subscription_status("bench-user"))),
+        ("status, pre-encoded", status_old,
+         lambda: service.get_user_subscription_status_json("bench-user")),
+        ("theme list", lambda: default_render({"themes": [asdict(theme) for theme in themes]}),
+         lambda: fast_json.dumps({"themes": [theme.to_dict() for theme in themes]})),
+        ("subscription", lambda: default_render(asdict(subscription)),
+         lambda: fast_json.dumps(subscription.to_dict())),
+        # asdict(order) would also leak card details; the timing is the point here
+        ("order", lambda: default_render(asdict(order)),
+         lambda: fast_json.dumps(order.to_dict())),
+    ]
+
+    backend = "orjson" if fast_json.orjson is not None else "stdlib json"
+    print(f"fast path uses {backend}, {args.iterations} iterations per case")
+    print(f"{'payload':>20} {'default us':>11} {'fast us':>9} {'speedup':>8}")
+    for name, old, new in cases:
+        old_us = time_per_call(old, args.iterations)
+        new_us = time_per_call(new, args.iterations)
+        print(f"{name:>20} {old_us:>11.1f} {new_us:>9.1f} {old_us / new_us:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Password Hashing Benchmark - KDF cost, pool throughput and event-loop stalls
+
+Usage:
+    python benchmarks/bench_password_hashing.py [--logins 64] [--n 16384 32768] [--pool-sizes 1 2 4 8]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from password_hashing import PasswordHasher
+
+async def measure_loop_lag(stop: asyncio.Event, interval: float = 0.005) -> float:
+    """Sample how late the event loop wakes up while hashing runs"""
+    worst = 0.0
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - started - interval)
+    return worst
+
+async def run_logins(hasher: PasswordHasher, password_hash: str, logins: int, use_pool: bool):
+    """Verify `logins` passwords concurrently; returns (seconds, latencies, worst loop lag)"""
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_loop_lag(stop))
+    latencies = []
+
+    async def login():
+        started = time.perf_counter()
+        if use_pool:
+            await hasher.verify_async("correct horse", password_hash)
+        else:
+            hasher.verify("correct horse", password_hash)
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(login() for _ in range(logins)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    return elapsed, latencies, await lag_task
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=64, help="concurrent logins per run")
+    parser.add_argument("--n", type=int, nargs="+", default=[2 ** 14], help="scrypt cost parameters to try")
+    parser.add_argument("--r", type=int, default=8)
+    parser.add_argument("--pool-sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    print(f"{'n':>7} {'pool':>6} {'logins/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'max loop lag ms':>16}")
+    for n in args.n:
+        for pool_size in [0] + args.pool_sizes:
+            hasher = PasswordHasher(n=n, r=args.r, pool_size=max(pool_size, 1))
+            password_hash = hasher.hash("correct horse")
+            elapsed, latencies, lag = asyncio.run(
+                run_logins(hasher, password_hash, args.logins, use_pool=pool_size > 0)
+            )
+            hasher.shutdown()
+
+            latencies.sort()
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            print(f"{n:>7} {pool_size or 'inline':>6} {args.logins / elapsed:>10.1f} "
+                  f"{statistics.median(latencies) * 1000:>8.1f} {p99 * 1000:>8.1f} {lag * 1000:>16.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+User Record Memory Benchmark - dataclass records vs compact __slots__ records
+
+Builds a synthetic user file (one JSON record per line) for each size, then
+loads it in a fresh subprocess per record type and reports resident memory
+growth and load time. Records are parsed line by line so the numbers reflect
+the records themselves rather than a transient json.load() tree.
+
+Usage:
+    python benchmarks/bench_user_memory.py [--sizes 100000 1000000]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+@dataclass
+class LegacyUser:
+    """The User dataclass as it was before the compact representation"""
+    id: str
+    email: str
+    password_hash: str
+    first_name: str
+    last_name: str
+    is_premium: bool = False
+    premium_plan: Optional[str] = None
+    created_at: str = ""
+    last_login: Optional[str] = None
+    is_active: bool = True
+    role: str = "user"
+
+def resident_bytes() -> int:
+    """Current resident set size of this process"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        # ru_maxrss is the peak, in KiB on Linux and bytes on macOS
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+def generate(path: str, count: int):
+    """Write `count` synthetic users, one JSON record per line"""
+    start = datetime(2023, 1, 1)
+    plans = [None, None, None, "monthly", "yearly"]
+    with open(path, "w") as f:
+        for i in range(count):
+            plan = plans[i % len(plans)]
+            user = {
+                "id": str(uuid.UUID(int=i)),
+                "email": f"user{i}@example.com",
+                "password_hash": f"scrypt$16384$8$1${i:022d}${i:043d}",
+                "first_name": f"First{i % 1000}",
+                "last_name": f"Last{i % 997}",
+                "is_premium": plan is not None,
+                "premium_plan": plan,
+                "created_at": (start + timedelta(seconds=i * 37, microseconds=i % 1000000)).isoformat(),
+                "last_login": (start + timedelta(days=300, seconds=i)).isoformat() if i % 3 else None,
+                "is_active": True,
+                "role": "user",
+            }
+            f.write(json.dumps(user) + "\n")
+
+def measure(path: str, kind: str):
+    """Load the user file into records of the given kind (runs in a subprocess)"""
+    if kind == "compact":
+        from user_models import User
+    else:
+        User = LegacyUser
+
+    baseline = resident_bytes()
+    started = time.perf_counter()
+    users = {}
+    with open(path) as f:
+        for line in f:
+            user = User(**json.loads(line))
+            users[user.email] = user
+    elapsed = time.perf_counter() - started
+    print(json.dumps({"rss": resident_bytes() - baseline, "seconds": elapsed, "count": len(users)}))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--measure", nargs=2, metavar=("PATH", "KIND"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(*args.measure)
+        return
+
+    print(f"{'users':>9} {'records':>10} {'RSS MiB':>9} {'bytes/user':>11} {'load s':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            path = os.path.join(tmp, f"users-{size}.ndjson")
+            generate(path, size)
+            for kind in ("dataclass", "compact"):
+                output = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--measure", path, kind],
+                    check=True, capture_output=True, text=True
+                ).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                print(f"{size:>9} {kind:>10} {result['rss'] / 2 ** 20:>9.1f} "
+                      f"{result['rss'] / size:>11.0f} {result['seconds']:>8.2f}")
+
+if __name__ == "__main__":
+    main()
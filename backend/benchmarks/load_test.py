@@ -0,0 +1,272 @@
+"""
+Load Test - Drive the API servers with scripted scenarios and report latency percentiles
+
+Scenarios run against api_server.app (subscriptions/themes) or
+auth_api_server.app (auth/promo), either in-process through httpx's ASGI
+transport or over a real localhost socket served by uvicorn. Everything
+runs against a throwaway user database in a temp directory.
+
+Usage:
+    python benchmarks/load_test.py [--mode asgi|uvicorn] [--scenarios login_storm promo_checks]
+                                   [--requests 500] [--concurrency 50]
+                                   [--save-baseline FILE] [--baseline FILE] [--tolerance 0.25]
+
+With --baseline the run fails (exit status 1) when a scenario's req/s drops, or
+its p99 grows, by more than the tolerance relative to the stored numbers.
+Baselines are machine-specific; save one on the machine that checks it.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import httpx
+except ImportError:
+    sys.exit("The load test needs httpx (pip install httpx)")
+
+PAYMENT = {
+    "card_number": "4111111111111111",
+    "card_name": "Load Test",
+    "expiry": "12/30",
+    "cvc": "123",
+    "billing_address": {"country": "United States"},
+}
+
+def percentile(samples: List[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+class Scenario:
+    """A named request script against one of the two apps"""
+
+    def __init__(self, name: str, app: str, request: Callable, ok_status=(200,), setup: Callable = None):
+        self.name = name
+        self.app = app
+        self.request = request  # async (client, i, state) -> httpx.Response
+        self.ok_status = ok_status
+        self.setup = setup  # async (client, args) -> state
+
+async def setup_users(client, args) -> Dict:
+    for i in range(args.users):
+        response = await client.post("/api/auth/register", json={
+            "email": f"load{i}@example.com", "password": "Load-password1",
+            "first_name": "Load", "last_name": str(i)
+        })
+        assert response.status_code in (200, 400), response.text
+    return {"users": args.users}
+
+async def login(client, i: int, state: Dict):
+    return await client.post("/api/auth/login", json={
+        "email": f"load{i % state['users']}@example.com", "password": "Load-password1"
+    })
+
+async def subscribe(client, i: int, state: Dict):
+    return await client.post("/api/subscription/process", json=dict(
+        PAYMENT, user_id=f"burst-{i}", plan="yearly" if i % 2 else "monthly"
+    ))
+
+async def setup_theme_users(client, args) -> Dict:
+    themes = (await client.get("/api/themes/all")).json()["themes"]
+    users = [f"themes-{i}" for i in range(args.users)]
+    # A third each of free, monthly and yearly users
+    for i, user_id in enumerate(users):
+        if i % 3:
+            await client.post("/api/subscription/process", json=dict(
+                PAYMENT, user_id=user_id, plan="monthly" if i % 3 == 1 else "yearly"
+            ))
+    return {"users": users, "themes": [theme["id"] for theme in themes]}
+
+async def validate_themes(client, i: int, state: Dict):
+    users, themes = state["users"], state["themes"]
+    return await client.post("/api/themes/validate-access", json={
+        "user_id": users[i % len(users)], "theme_id": themes[i % len(themes)]
+    })
+
+async def validate_theme_batch(client, i: int, state: Dict):
+    users, themes = state["users"], state["themes"]
+    # One page's worth of checks: every theme for a handful of users
+    return await client.post("/api/themes/validate-access/batch", json={"checks": [
+        {"user_id": users[(i + n) % len(users)], "theme_id": theme_id}
+        for n in range(10) for theme_id in themes
+    ]})
+
+async def setup_promo_codes(client, args) -> Dict:
+    codes = [promo["code"] for promo in (await client.get("/api/promo/codes")).json()["promo_codes"]]
+    return {"codes": codes + ["NOT-A-CODE"]}
+
+async def check_promo(client, i: int, state: Dict):
+    codes = state["codes"]
+    return await client.post("/api/promo/validate", json={
+        "code": codes[i % len(codes)], "order_total": 20.0 + (i % 80)
+    })
+
+SCENARIOS = {
+    scenario.name: scenario for scenario in (
+        Scenario("login_storm", "auth", login, setup=setup_users),
+        Scenario("subscription_burst", "api", subscribe),
+        Scenario("theme_validation", "api", validate_themes, setup=setup_theme_users),
+        Scenario("theme_batch", "api", validate_theme_batch, setup=setup_theme_users),
+        # Unknown codes and orders under a code's minimum are expected 400s
+        Scenario("promo_checks", "auth", check_promo, ok_status=(200, 400), setup=setup_promo_codes),
+    )
+}
+
+async def run_scenario(client, scenario: Scenario, args) -> Dict:
+    """Fire args.requests requests from args.concurrency workers; returns the report row"""
+    state = await scenario.setup(client, args) if scenario.setup else {}
+    latencies, errors = [], 0
+    counter = iter(range(args.requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            started = time.perf_counter()
+            try:
+                response = await scenario.request(client, i, state)
+                failed = response.status_code not in scenario.ok_status
+            except httpx.HTTPError:
+                failed = True
+            latencies.append(time.perf_counter() - started)
+            errors += failed
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": args.requests,
+        "errors": errors,
+        "rps": round(args.requests / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class UvicornThread:
+    """Serve an app on a localhost port from a background thread"""
+
+    def __init__(self, app):
+        import uvicorn
+        self.port = free_port()
+        config = uvicorn.Config(app, host="127.0.0.1", port=self.port, log_level="warning", lifespan="on")
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, name="load-test-uvicorn", daemon=True)
+
+    def __enter__(self) -> str:
+        self.thread.start()
+        while not self.server.started:
+            if not self.thread.is_alive():
+                raise RuntimeError("uvicorn failed to start")
+            time.sleep(0.01)
+        return f"http://127.0.0.1:{self.port}"
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join()
+
+async def run_all(apps: Dict, args) -> Dict[str, Dict]:
+    """Run the selected scenarios; in uvicorn mode each app is served once for all of its scenarios"""
+    results = {}
+    with contextlib.ExitStack() as stack:
+        clients = {}
+        for key in dict.fromkeys(SCENARIOS[name].app for name in args.scenarios):
+            if args.mode == "asgi":
+                clients[key] = httpx.AsyncClient(transport=httpx.ASGITransport(app=apps[key]),
+                                                 base_url="http://load-test", timeout=args.timeout)
+            else:
+                base_url = stack.enter_context(UvicornThread(apps[key]))
+                limits = httpx.Limits(max_connections=args.concurrency,
+                                      max_keepalive_connections=args.concurrency)
+                clients[key] = httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.timeout)
+        try:
+            for name in args.scenarios:
+                scenario = SCENARIOS[name]
+                results[name] = await run_scenario(clients[scenario.app], scenario, args)
+        finally:
+            for client in clients.values():
+                await client.aclose()
+    return results
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], tolerance: float) -> List[str]:
+    """Regressions beyond tolerance against a stored baseline"""
+    problems = []
+    for name, row in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if row["rps"] < base["rps"] * (1 - tolerance):
+            problems.append(f"{name}: {row['rps']} req/s vs baseline {base['rps']}")
+        if row["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            problems.append(f"{name}: p99 {row['p99_ms']} ms vs baseline {base['p99_ms']}")
+        if row["errors"] > base["errors"]:
+            problems.append(f"{name}: {row['errors']} errors vs baseline {base['errors']}")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--mode", choices=("asgi", "uvicorn"), default="asgi")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--users", type=int, default=50, help="accounts created for login/theme scenarios")
+    parser.add_argument("--n", type=int, default=2 ** 12, help="scrypt cost for the test users")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--save-baseline", metavar="FILE")
+    parser.add_argument("--baseline", metavar="FILE")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="load-test-")
+    os.environ["BOOKHAVEN_USER_DB_FILE"] = os.path.join(workdir, "users.json")
+    os.environ["BOOKHAVEN_SUBSCRIPTION_DB_FILE"] = os.path.join(workdir, "subscriptions.json")
+    os.environ["BOOKHAVEN_SCRYPT_N"] = str(args.n)
+    os.environ.setdefault("BOOKHAVEN_LOG_LEVEL", "WARNING")
+    # Every simulated client shares one address, so per-client rate limits would only measure 429s
+    os.environ.setdefault("BOOKHAVEN_LOGIN_RATE", "0")
+    os.environ.setdefault("BOOKHAVEN_PROMO_RATE", "0")
+
+    import api_server
+    import auth_api_server
+
+    results = asyncio.run(run_all({"api": api_server.app, "auth": auth_api_server.app}, args))
+
+    print(f"mode={args.mode} requests={args.requests} concurrency={args.concurrency} cpus={os.cpu_count()}")
+    print(f"{'scenario':>20} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for name, row in results.items():
+        print(f"{name:>20} {row['rps']:>8.1f} {row['p50_ms']:>8.2f} {row['p95_ms']:>8.2f} "
+              f"{row['p99_ms']:>8.2f} {row['errors']:>7}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump({"mode": args.mode, "scenarios": results}, f, indent=2)
+        print(f"Baseline written to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("mode") != args.mode:
+            sys.exit(f"Baseline was recorded in {baseline.get('mode')} mode, not {args.mode}")
+        problems = compare(results, baseline["scenarios"], args.tolerance)
+        for problem in problems:
+            print(f"REGRESSION {problem}")
+        if problems:
+            sys.exit(1)
+        print("No regressions against baseline")
+
+if __name__ == "__main__":
+    main()
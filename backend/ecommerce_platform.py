@@ -6,9 +6,14 @@ import datetime
 import uuid
 import hashlib
 from typing import Dict, List, Optional, Union
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass
 from enum import Enum
 import math
+import time
+from app_logging import elapsed_ms, get_logger, log_event
+from app_metrics import timed
+
+logger = get_logger("ecommerce_platform")
 
 class BookType(Enum):
     PHYSICAL = "physical"
@@ -54,6 +59,10 @@ class ShippingAddress:
     country: str = "United States"
     phone: str = ""
 
+    def to_dict(self) -> Dict:
+        """JSON-ready dict (every field is already a string)"""
+        return dict(vars(self))
+
 @dataclass
 class PaymentInfo:
     method: PaymentMethod
@@ -87,12 +96,37 @@ class Book:
     cover_image: str = ""
     description: str = ""
 
+    def to_dict(self) -> Dict:
+        """JSON-ready dict with enums as their values"""
+        return {
+            "id": self.id,
+            "title": self.title,
+            "author": self.author,
+            "isbn": self.isbn,
+            "price": self.price,
+            "book_type": self.book_type.value,
+            "stock_quantity": self.stock_quantity,
+            "weight_oz": self.weight_oz,
+            "digital_formats": [fmt.value for fmt in self.digital_formats] if self.digital_formats else None,
+            "file_size_mb": self.file_size_mb,
+            "cover_image": self.cover_image,
+            "description": self.description
+        }
+
 @dataclass
 class CartItem:
     book: Book
     quantity: int
     selected_format: Optional[EbookFormat] = None
 
+    def to_dict(self) -> Dict:
+        """JSON-ready dict with the book inlined"""
+        return {
+            "book": self.book.to_dict(),
+            "quantity": self.quantity,
+            "selected_format": self.selected_format.value if self.selected_format else None
+        }
+
 @dataclass
 class Order:
     id: str
@@ -110,6 +144,28 @@ class Order:
     tracking_number: str = ""
     digital_downloads: List[str] = None
 
+    def to_dict(self) -> Dict:
+        """JSON-ready dict; unlike asdict() it never exposes card number, expiry or CVC"""
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "items": [item.to_dict() for item in self.items],
+            "shipping_address": self.shipping_address.to_dict() if self.shipping_address else None,
+            "payment": {
+                "method": self.payment_info.method.value,
+                "card_last_four": self.payment_info.card_number[-4:] if self.payment_info.card_number else ""
+            },
+            "shipping_method": self.shipping_method.value if self.shipping_method else None,
+            "subtotal": self.subtotal,
+            "shipping_cost": self.shipping_cost,
+            "tax": self.tax,
+            "total": self.total,
+            "status": self.status.value,
+            "created_at": self.created_at.isoformat(),
+            "tracking_number": self.tracking_number,
+            "digital_downloads": self.digital_downloads or []
+        }
+
 class EcommercePlatform:
     def __init__(self):
         # Shipping options configuration
@@ -291,12 +347,13 @@ class EcommercePlatform:
             "items": availability
         }
 
+    @timed("process_order")
     def process_order(self, user_id: str, items: List[CartItem], 
                      shipping_address: Optional[ShippingAddress], 
                      payment_info: PaymentInfo,
                      shipping_method: Optional[ShippingMethod] = None) -> Dict:
         """Process a complete order"""
-        
+        started = time.perf_counter()
         try:
             # Generate order ID
             order_id = f"ORD-{uuid.uuid4().hex[:8].upper()}"
@@ -383,17 +440,10 @@ class EcommercePlatform:
             self.orders[order_id] = order
             
             # Log successful order
-            print(f"=== ORDER PROCESSED ===")
-            print(f"Order ID: {order_id}")
-            print(f"User ID: {user_id}")
-            print(f"Items: {len(items)}")
-            print(f"Subtotal: ${subtotal:.2f}")
-            print(f"Shipping: ${shipping_cost:.2f}")
-            print(f"Tax: ${tax:.2f}")
-            print(f"Total: ${total:.2f}")
-            print(f"Digital Downloads: {len(digital_downloads)}")
-            print(f"Transaction ID: {payment_result['transaction_id']}")
-            print(f"=== END ORDER LOG ===")
+            log_event(logger, "order_processed", order_id=order_id, user_id=user_id, items=len(items),
+                      subtotal=round(subtotal, 2), shipping=round(shipping_cost, 2), tax=round(tax, 2),
+                      total=round(total, 2), digital_downloads=len(digital_downloads),
+                      transaction_id=payment_result['transaction_id'], duration_ms=elapsed_ms(started))
             
             return {
                 "success": True,
@@ -407,7 +457,7 @@ class EcommercePlatform:
             }
             
         except Exception as e:
-            print(f"Order processing error: {str(e)}")
+            logger.error("Order processing error: %s", e)
             return {
                 "success": False,
                 "error": f"Order processing failed: {str(e)}"
@@ -444,6 +494,7 @@ class EcommercePlatform:
 
     def process_return(self, order_id: str, return_items: List[str], reason: str) -> Dict:
         """Process a return request"""
+        started = time.perf_counter()
         order = self.orders.get(order_id)
         if not order:
             return {
@@ -464,13 +515,8 @@ class EcommercePlatform:
         if len(return_items) == len(order.items):
             refund_amount += order.shipping_cost
         
-        print(f"=== RETURN PROCESSED ===")
-        print(f"Return ID: {return_id}")
-        print(f"Order ID: {order_id}")
-        print(f"Items: {return_items}")
-        print(f"Reason: {reason}")
-        print(f"Refund Amount: ${refund_amount:.2f}")
-        print(f"=== END RETURN LOG ===")
+        log_event(logger, "return_processed", return_id=return_id, order_id=order_id, items=return_items,
+                  reason=reason, refund_amount=round(refund_amount, 2), duration_ms=elapsed_ms(started))
         
         return {
             "success": True,
@@ -0,0 +1,75 @@
+"""
+Expiry Scheduler - Min-heap of keys ordered by the time they fall due
+"""
+import heapq
+import itertools
+from typing import Dict, List, Optional, Tuple
+
+class ExpiryScheduler:
+    """Keys scheduled at a timestamp, popped in due order.
+
+    Rescheduling or cancelling a key does not search the heap; the old entry
+    stays behind and is skipped when it surfaces. The heap is rebuilt once
+    stale entries outnumber live ones, so it stays O(live keys).
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int, str]] = []  # (due, seq, key)
+        self._due: Dict[str, float] = {}
+        self._seq = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def schedule(self, key: str, due: float):
+        """Schedule (or move) a key to fall due at `due`"""
+        self._due[key] = due
+        heapq.heappush(self._heap, (due, next(self._seq), key))
+        if len(self._heap) > 2 * len(self._due) + 64:
+            self._compact()
+
+    def cancel(self, key: str):
+        """Forget a key; its heap entry is dropped lazily"""
+        self._due.pop(key, None)
+
+    def due(self, key: str) -> Optional[float]:
+        """When a key falls due, if it is scheduled"""
+        return self._due.get(key)
+
+    def next_due(self) -> Optional[float]:
+        """Earliest live due time"""
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def has_due(self, now: float) -> bool:
+        """Whether any key is due at `now`"""
+        next_due = self.next_due()
+        return next_due is not None and next_due <= now
+
+    def pop_due(self, now: float, limit: Optional[int] = None) -> List[str]:
+        """Remove and return up to `limit` keys due at `now`, earliest first"""
+        keys = []
+        while self._heap and (limit is None or len(keys) < limit):
+            self._drop_stale()
+            if not self._heap or self._heap[0][0] > now:
+                break
+            _, _, key = heapq.heappop(self._heap)
+            del self._due[key]
+            keys.append(key)
+        return keys
+
+    def _is_live(self, entry: Tuple[float, int, str]) -> bool:
+        return self._due.get(entry[2]) == entry[0]
+
+    def _drop_stale(self):
+        while self._heap and not self._is_live(self._heap[0]):
+            heapq.heappop(self._heap)
+
+    def _compact(self):
+        # Keep the newest entry per key, in case a key was rescheduled to the same time
+        latest = {}
+        for entry in self._heap:
+            if self._is_live(entry) and entry[1] > latest.get(entry[2], (None, -1))[1]:
+                latest[entry[2]] = entry
+        self._heap = list(latest.values())
+        heapq.heapify(self._heap)
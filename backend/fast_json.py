@@ -0,0 +1,51 @@
+"""
+Fast JSON - Response serialization with orjson when installed, stdlib json otherwise
+
+FastAPI normally runs every returned dict through jsonable_encoder (a full
+recursive copy) before json.dumps. Handlers on hot paths return
+FastJSONResponse(payload) instead, which skips that pass and renders the
+payload in one call. Payloads should already be plain JSON types; models
+provide to_dict() for that, and enums/datetimes are handled as a fallback.
+"""
+import datetime
+import json
+from enum import Enum
+from typing import Any
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from fastapi.responses import JSONResponse
+except ImportError:  # dumps() is still usable from CLI tools without the web stack
+    JSONResponse = None
+
+def _default(obj: Any):
+    """Serialize the few non-JSON types our payloads may still carry"""
+    if isinstance(obj, Enum):
+        return obj.value
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    to_dict = getattr(obj, "to_dict", None)
+    if to_dict is not None:
+        return to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+if orjson is not None:
+    def dumps(content: Any) -> bytes:
+        """Compact UTF-8 JSON bytes"""
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+else:
+    def dumps(content: Any) -> bytes:
+        """Compact UTF-8 JSON bytes"""
+        return json.dumps(content, ensure_ascii=False, separators=(",", ":"),
+                          default=_default).encode("utf-8")
+
+if JSONResponse is not None:
+    class FastJSONResponse(JSONResponse):
+        """JSONResponse rendered with dumps(); also the apps' default_response_class"""
+
+        def render(self, content: Any) -> bytes:
+            return dumps(content)
@@ -0,0 +1,158 @@
+"""
+Group Commit Flusher - Coalesces writes into batches on a background thread
+"""
+import atexit
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, List
+
+from app_logging import get_logger
+
+logger = get_logger("group_commit")
+
+DURABILITY_MODES = ("sync", "batched", "async")
+
+class GroupCommitFlusher:
+    """Batches records and hands them to a writer in groups.
+
+    Durability modes:
+      - "sync":    every submit writes its record before returning
+      - "batched": submit blocks until the batch containing its record has been
+                   written, so concurrent callers share one write (group commit)
+      - "async":   submit returns immediately; records are written by the
+                   background thread every `interval` seconds or `batch_size`
+                   records, so a crash can lose up to one interval of changes
+
+    Pending records are always written on close(), which is also registered
+    with atexit so a normal interpreter shutdown never drops data.
+    """
+
+    def __init__(self, write_batch: Callable[[List[Any]], None], mode: str = "async",
+                 interval: float = 0.05, batch_size: int = 512):
+        if mode not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode: {mode}")
+        self.write_batch = write_batch
+        self.mode = mode
+        self.interval = interval
+        self.batch_size = batch_size
+
+        self._pending: List[Any] = []
+        self._submitted = 0   # sequence number of the last submitted record
+        self._written = 0     # sequence number of the last written record
+        self._error = None
+        self._error_upto = 0  # last sequence number covered by a failed write
+        self._error_size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        # Held while a batch is being written; pause() holds it to keep writes out
+        self._write_lock = threading.RLock()
+
+        self._thread = None
+        if mode != "sync":
+            self._thread = threading.Thread(target=self._run, name="group-commit-flusher", daemon=True)
+            self._thread.start()
+        atexit.register(self.close)
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def submit(self, record: Any):
+        """Queue a record according to the durability mode"""
+        self.wait_for(self.enqueue(record))
+
+    def enqueue(self, record: Any) -> int:
+        """Queue a record without waiting for it; returns the sequence number to pass to wait_for()"""
+        if self.mode == "sync":
+            with self._write_lock:
+                self.write_batch([record])
+            return 0
+
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Flusher is closed")
+            self._pending.append(record)
+            self._submitted += 1
+            if len(self._pending) >= self.batch_size or self.mode == "batched":
+                self._cond.notify_all()
+            return self._submitted
+
+    def wait_for(self, sequence: int):
+        """In batched mode, block until the record with this sequence number is written"""
+        if self.mode != "batched" or not sequence:
+            return
+        with self._cond:
+            while self._written < sequence:
+                self._cond.wait()
+            if self._error is not None and sequence <= self._error_upto and \
+                    sequence > self._error_upto - self._error_size:
+                raise self._error
+
+    def flush(self):
+        """Write all pending records now"""
+        with self._write_lock:
+            with self._cond:
+                batch = self._take_batch()
+            self._write(batch)
+
+    @contextmanager
+    def paused(self):
+        """Flush, then hold off further writes for the duration of the block"""
+        with self._write_lock:
+            self.flush()
+            yield
+
+    def close(self):
+        """Flush pending records and stop the background thread"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        atexit.unregister(self.close)
+
+    def _take_batch(self) -> List[Any]:
+        batch = self._pending
+        self._pending = []
+        return batch
+
+    def _write(self, batch: List[Any]):
+        if not batch:
+            return
+        error = None
+        try:
+            self.write_batch(batch)
+        except Exception as e:
+            logger.error("Group commit write error: %s", e)
+            error = e
+        with self._cond:
+            self._written += len(batch)
+            if error is not None:
+                self._error = error
+                self._error_upto = self._written
+                self._error_size = len(batch)
+            self._cond.notify_all()
+
+    def _run(self):
+        """Background loop: write whenever the interval elapses or a batch fills"""
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.interval
+                while not self._closed and len(self._pending) < self.batch_size:
+                    if self.mode == "batched" and self._pending:
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._closed:
+                    return
+
+            with self._write_lock:
+                with self._cond:
+                    batch = self._take_batch()
+                self._write(batch)
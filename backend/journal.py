@@ -0,0 +1,183 @@
+"""
+Append-only Journal - Change log with periodic snapshot compaction
+"""
+import json
+import os
+import tempfile
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+def write_json_snapshot(path: str, snapshot: Dict):
+    """Write a JSON snapshot file and fsync it"""
+    with open(path, 'w') as f:
+        json.dump(snapshot, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+
+class Journal:
+    """Append-only JSON-lines change log paired with a full JSON snapshot.
+
+    Every mutation is appended as one record, so writes cost O(1) regardless
+    of how much data the snapshot holds. Records are expected to be full
+    upserts, which makes replay idempotent: if the process dies between
+    writing a new snapshot and truncating the journal, replaying the old
+    records on top of the new snapshot yields the same state.
+
+    Compaction is due once the journal outgrows `compact_ratio` times the
+    snapshot (and at least `min_compact_bytes`), so its O(snapshot) cost
+    amortizes to O(1) per record whatever the size of the data.
+    """
+
+    def __init__(self, snapshot_file: str, journal_file: Optional[str] = None, compact_ratio: float = 1.0,
+                 min_compact_bytes: int = 1 << 20):
+        self.snapshot_file = snapshot_file
+        self.journal_file = journal_file or f"{snapshot_file}.journal"
+        self.compact_ratio = compact_ratio
+        self.min_compact_bytes = min_compact_bytes
+        self.journal_bytes = 0
+        self.snapshot_bytes = 0
+        self._handle = None
+
+    def exists(self) -> bool:
+        """Check whether a snapshot or journal is present on disk"""
+        return os.path.exists(self.snapshot_file) or os.path.exists(self.journal_file)
+
+    def read_snapshot(self) -> Optional[Dict]:
+        """Load the last compacted snapshot, if any"""
+        if not os.path.exists(self.snapshot_file):
+            return None
+        self.snapshot_bytes = os.path.getsize(self.snapshot_file)
+        with open(self.snapshot_file, 'r') as f:
+            return json.load(f)
+
+    def replay(self) -> Iterator[Dict]:
+        """Yield journal records written since the last compaction"""
+        self.journal_bytes = 0
+        if os.path.exists(self.snapshot_file):
+            self.snapshot_bytes = os.path.getsize(self.snapshot_file)
+        if not os.path.exists(self.journal_file):
+            return
+
+        good_offset = 0
+        torn = False
+        with open(self.journal_file, 'rb') as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    torn = True
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    torn = True
+                    break
+                good_offset += len(line)
+                self.journal_bytes = good_offset
+                yield record
+
+        # Drop a partially written tail so later appends stay readable
+        if torn:
+            self.close()
+            with open(self.journal_file, 'r+b') as f:
+                f.truncate(good_offset)
+
+    def size(self) -> int:
+        """Current length of the journal file in bytes"""
+        try:
+            return os.path.getsize(self.journal_file)
+        except FileNotFoundError:
+            return 0
+
+    def read_from(self, offset: int) -> Tuple[List[Dict], int]:
+        """Records appended after a byte offset, plus the offset just past the last complete one"""
+        records = []
+        if not os.path.exists(self.journal_file):
+            return records, 0
+        with open(self.journal_file, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+                offset += len(line)
+        self.journal_bytes = offset
+        return records, offset
+
+    def append(self, record: Dict, fsync: bool = False):
+        """Append a single change record"""
+        self.append_batch([record], fsync)
+
+    def append_batch(self, records: List[Dict], fsync: bool = False):
+        """Append several change records with a single write"""
+        if self._handle is None:
+            self._handle = open(self.journal_file, 'a')
+        data = "".join(json.dumps(record, separators=(',', ':')) + "\n" for record in records)
+        self._handle.write(data)
+        self._handle.flush()
+        if fsync:
+            os.fsync(self._handle.fileno())
+        # json.dumps escapes non-ASCII, so characters are bytes
+        self.journal_bytes += len(data)
+
+    def needs_compaction(self) -> bool:
+        """Check whether the journal has grown past the compaction threshold"""
+        return self.compact_ratio > 0 and \
+            self.journal_bytes >= max(self.min_compact_bytes, self.compact_ratio * self.snapshot_bytes)
+
+    def compact(self, snapshot: Dict):
+        """Write a new JSON snapshot atomically and start an empty journal"""
+        self.compact_with(lambda path: write_json_snapshot(path, snapshot))
+
+    def compact_with(self, write_snapshot: Callable[[str], None]):
+        """Let write_snapshot(path) produce the new snapshot, then swap it in atomically"""
+        self.install_snapshot(self.prepare_snapshot(write_snapshot), self.size())
+
+    def _temp_path(self, path: str) -> str:
+        """A fresh file next to path, so concurrent compactions never share one"""
+        fd, tmp_file = tempfile.mkstemp(prefix=f"{os.path.basename(path)}.", suffix=".tmp",
+                                        dir=os.path.dirname(os.path.abspath(path)))
+        os.close(fd)
+        return tmp_file
+
+    def prepare_snapshot(self, write_snapshot: Callable[[str], None]) -> str:
+        """Have write_snapshot(path) write a new snapshot beside the current one; returns its path"""
+        tmp_file = self._temp_path(self.snapshot_file)
+        try:
+            write_snapshot(tmp_file)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+        return tmp_file
+
+    def install_snapshot(self, tmp_file: str, keep_from: int):
+        """Swap in a prepared snapshot covering the journal up to byte `keep_from`.
+
+        Records appended after keep_from (while the snapshot was being
+        written) are kept in the new journal. Both swaps are atomic renames;
+        a crash between them leaves the new snapshot with the old journal,
+        which replays to the same state. Processes holding the old journal
+        open must reopen it, which a reload after the snapshot changed does.
+        """
+        tail = b""
+        if os.path.exists(self.journal_file):
+            with open(self.journal_file, 'rb') as f:
+                f.seek(keep_from)
+                tail = f.read()
+        journal_tmp = self._temp_path(self.journal_file)
+        with open(journal_tmp, 'wb') as f:
+            f.write(tail)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_file, self.snapshot_file)
+        self.close()
+        os.replace(journal_tmp, self.journal_file)
+        self.snapshot_bytes = os.path.getsize(self.snapshot_file)
+        self.journal_bytes = len(tail)
+
+    def close(self):
+        """Close the journal file handle"""
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
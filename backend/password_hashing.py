@@ -0,0 +1,129 @@
+"""
+Password Hashing - scrypt KDF with a bounded worker pool for async callers
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import re
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+SCRYPT_PREFIX = "scrypt"
+LEGACY_HASH = re.compile(r"[0-9a-f]{64}")
+
+def _b64encode(data: bytes) -> str:
+    return base64.b64encode(data).decode('ascii').rstrip('=')
+
+def _b64decode(data: str) -> bytes:
+    return base64.b64decode(data + '=' * (-len(data) % 4))
+
+class PasswordHasher:
+    """Salted scrypt password hashing.
+
+    Hashes are stored as "scrypt$<n>$<r>$<p>$<salt>$<key>" so cost parameters
+    can be raised later; needs_rehash() reports hashes made with older
+    parameters, and unsalted SHA-256 hex digests from earlier releases are
+    still accepted by verify() so they can be upgraded on the next login.
+
+    hashlib.scrypt releases the GIL, so the async helpers run it on a
+    dedicated thread pool; pool_size bounds how many KDFs (and how much KDF
+    memory, 128 * r * n bytes each) are in flight at once.
+    """
+
+    def __init__(self, n: int = 2 ** 14, r: int = 8, p: int = 1, salt_bytes: int = 16,
+                 key_bytes: int = 32, pool_size: int = 4):
+        self.n = n
+        self.r = r
+        self.p = p
+        self.salt_bytes = salt_bytes
+        self.key_bytes = key_bytes
+        self.pool_size = pool_size
+        self._executor = None
+
+    @classmethod
+    def from_env(cls) -> "PasswordHasher":
+        """Build a hasher from BOOKHAVEN_SCRYPT_* and BOOKHAVEN_HASH_POOL_SIZE"""
+        return cls(
+            n=int(os.environ.get("BOOKHAVEN_SCRYPT_N", 2 ** 14)),
+            r=int(os.environ.get("BOOKHAVEN_SCRYPT_R", 8)),
+            p=int(os.environ.get("BOOKHAVEN_SCRYPT_P", 1)),
+            pool_size=int(os.environ.get("BOOKHAVEN_HASH_POOL_SIZE", 4)),
+        )
+
+    @property
+    def settings(self) -> Tuple[int, int, int, int, int]:
+        """Constructor arguments that reproduce this hasher's output format"""
+        return (self.n, self.r, self.p, self.salt_bytes, self.key_bytes)
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="password-hash")
+        return self._executor
+
+    def _derive(self, password: str, salt: bytes, n: int, r: int, p: int, key_bytes: int) -> bytes:
+        return hashlib.scrypt(
+            password.encode(), salt=salt, n=n, r=r, p=p,
+            maxmem=256 * r * n, dklen=key_bytes
+        )
+
+    def hash(self, password: str) -> str:
+        """Hash a password with a fresh random salt"""
+        salt = secrets.token_bytes(self.salt_bytes)
+        key = self._derive(password, salt, self.n, self.r, self.p, self.key_bytes)
+        return f"{SCRYPT_PREFIX}${self.n}${self.r}${self.p}${_b64encode(salt)}${_b64encode(key)}"
+
+    def verify(self, password: str, password_hash: str) -> bool:
+        """Verify a password against a scrypt hash or a legacy SHA-256 digest"""
+        try:
+            if password_hash.startswith(SCRYPT_PREFIX + "$"):
+                _, n, r, p, salt, key = password_hash.split("$")
+                expected = _b64decode(key)
+                actual = self._derive(password, _b64decode(salt), int(n), int(r), int(p), len(expected))
+                return hmac.compare_digest(actual, expected)
+
+            legacy = hashlib.sha256(password.encode()).hexdigest()
+            return hmac.compare_digest(legacy, password_hash)
+        except (ValueError, TypeError):
+            return False
+
+    def is_valid_hash(self, password_hash: str) -> bool:
+        """Check that a stored hash is one verify() understands"""
+        if password_hash.startswith(SCRYPT_PREFIX + "$"):
+            parts = password_hash.split("$")
+            return len(parts) == 6 and all(part.isdigit() for part in parts[1:4])
+        return LEGACY_HASH.fullmatch(password_hash) is not None
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        """Check whether a stored hash predates the current algorithm or cost"""
+        if not password_hash.startswith(SCRYPT_PREFIX + "$"):
+            return True
+        try:
+            _, n, r, p, _, _ = password_hash.split("$")
+        except ValueError:
+            return True
+        return (int(n), int(r), int(p)) != (self.n, self.r, self.p)
+
+    async def hash_async(self, password: str) -> str:
+        """Hash a password on the worker pool without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.hash, password)
+
+    async def verify_async(self, password: str, password_hash: str) -> bool:
+        """Verify a password on the worker pool without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.verify, password, password_hash)
+
+    def shutdown(self):
+        """Stop the worker pool"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+def hash_passwords(passwords: List[str], settings: Tuple[int, int, int, int, int]) -> List[str]:
+    """Hash a chunk of passwords; a picklable entry point for process pool workers"""
+    hasher = PasswordHasher(*settings)
+    return [hasher.hash(password) for password in passwords]
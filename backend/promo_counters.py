@@ -0,0 +1,291 @@
+"""
+Promo Usage Counters - Reserve / commit / release accounting for limited codes
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+class PromoUsageCounter:
+    """In-process usage counter for promo codes.
+
+    A checkout first reserves a use, which counts against the usage limit
+    until it is committed (used_count += 1) or released. Reservations that
+    are never resolved expire after reservation_ttl seconds. Codes are spread
+    over lock shards so checkouts for different codes never wait on each
+    other; committed counts are persisted through the storage backend, whose
+    journal flusher batches the writes.
+
+    Reservations live in this process only, so it suits a single worker;
+    shared JSON storage uses SharedPromoUsageCounter instead.
+    """
+
+    def __init__(self, storage, reservation_ttl: float = 900, shards: int = 16):
+        self.storage = storage
+        self.reservation_ttl = reservation_ttl
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self._reserved: Dict[str, Dict[str, float]] = {}    # code -> {reservation_id: expires_at}
+        self._reservations: Dict[str, Tuple[str, float]] = {}  # reservation_id -> (code, expires_at)
+
+    def _lock_for(self, code: str) -> threading.Lock:
+        return self._locks[hash(code) % len(self._locks)]
+
+    def _purge(self, code: str, now: float) -> Dict[str, float]:
+        """Drop expired reservations for a code; caller holds the code's lock"""
+        reserved = self._reserved.setdefault(code, {})
+        expired = [reservation_id for reservation_id, expires_at in reserved.items() if expires_at <= now]
+        for reservation_id in expired:
+            del reserved[reservation_id]
+            self._reservations.pop(reservation_id, None)
+        return reserved
+
+    def reserve(self, code: str) -> Tuple[Optional[str], Optional[float]]:
+        """Reserve one use; returns (reservation_id, expires_at) or (None, None) if exhausted"""
+        now = time.time()
+        with self._lock_for(code):
+            promo = self.storage.get_promo(code)
+            if promo is None:
+                return None, None
+            reserved = self._purge(code, now)
+            if promo.usage_limit and promo.used_count + len(reserved) >= promo.usage_limit:
+                return None, None
+
+            reservation_id = uuid.uuid4().hex
+            expires_at = now + self.reservation_ttl
+            reserved[reservation_id] = expires_at
+            self._reservations[reservation_id] = (code, expires_at)
+            return reservation_id, expires_at
+
+    def commit(self, reservation_id: str) -> bool:
+        """Turn a live reservation into a recorded use"""
+        entry = self._reservations.get(reservation_id)
+        if entry is None:
+            return False
+        code = entry[0]
+        with self._lock_for(code):
+            reserved = self._purge(code, time.time())
+            if reservation_id not in reserved:
+                return False
+            del reserved[reservation_id]
+            del self._reservations[reservation_id]
+
+            promo = self.storage.get_promo(code)
+            if promo is None:
+                return False
+            promo.used_count += 1
+            self.storage.save_promo(promo)
+            return True
+
+    def release(self, reservation_id: str) -> bool:
+        """Give a reserved use back without recording it"""
+        entry = self._reservations.get(reservation_id)
+        if entry is None:
+            return False
+        code = entry[0]
+        with self._lock_for(code):
+            self._reservations.pop(reservation_id, None)
+            return self._reserved.get(code, {}).pop(reservation_id, None) is not None
+
+    def active_reservations(self, code: str) -> int:
+        """Number of unexpired reservations held for a code"""
+        with self._lock_for(code):
+            return len(self._purge(code, time.time()))
+
+class SharedPromoUsageCounter:
+    """Usage counter for JSON storage shared by several worker processes.
+
+    Each code's reservations are kept in a small file next to the database,
+    and every reserve, commit and release holds an exclusive lock on that
+    code's lock file, so all workers see the same reservations and
+    checkouts for different codes never wait on each other. Reservation ids
+    name their code's file, so any worker can commit or release them.
+    """
+
+    def __init__(self, storage, reservation_ttl: float = 900):
+        if fcntl is None:
+            raise RuntimeError("Shared promo counters need fcntl file locks, which this platform lacks")
+        self.storage = storage
+        self.reservation_ttl = reservation_ttl
+        self.directory = f"{storage.db_file}.promos"
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def _key(code: str) -> str:
+        return hashlib.sha1(code.encode()).hexdigest()[:16]
+
+    @staticmethod
+    def _key_of(reservation_id: str) -> Optional[str]:
+        """The code key a reservation id names, or None if it is malformed"""
+        key = reservation_id.partition('.')[0]
+        if len(key) != 16 or any(c not in '0123456789abcdef' for c in key):
+            return None
+        return key
+
+    @contextmanager
+    def _locked(self, key: str) -> Iterator[Dict]:
+        """Hold the code's file lock and yield its live reservations, saved on exit"""
+        path = os.path.join(self.directory, f"{key}.json")
+        with open(os.path.join(self.directory, f"{key}.lock"), 'a+') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(path, 'r') as f:
+                        state = json.load(f)
+                except (FileNotFoundError, ValueError):
+                    state = {'code': None, 'reserved': {}}
+                now = time.time()
+                state['reserved'] = {
+                    reservation_id: expires_at for reservation_id, expires_at in state['reserved'].items()
+                    if expires_at > now
+                }
+                before = dict(state['reserved'])
+                yield state
+                if state['reserved'] != before:
+                    tmp_path = f"{path}.tmp"
+                    with open(tmp_path, 'w') as f:
+                        json.dump(state, f)
+                    os.replace(tmp_path, path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def reserve(self, code: str) -> Tuple[Optional[str], Optional[float]]:
+        """Reserve one use; returns (reservation_id, expires_at) or (None, None) if exhausted"""
+        key = self._key(code)
+        with self._locked(key) as state:
+            promo = self.storage.get_promo(code)
+            if promo is None:
+                return None, None
+            if promo.usage_limit and promo.used_count + len(state['reserved']) >= promo.usage_limit:
+                return None, None
+
+            reservation_id = f"{key}.{uuid.uuid4().hex}"
+            expires_at = time.time() + self.reservation_ttl
+            state['code'] = code
+            state['reserved'][reservation_id] = expires_at
+            return reservation_id, expires_at
+
+    def commit(self, reservation_id: str) -> bool:
+        """Turn a live reservation into a recorded use"""
+        key = self._key_of(reservation_id)
+        if key is None:
+            return False
+        with self._locked(key) as state:
+            if state['reserved'].pop(reservation_id, None) is None:
+                return False
+            # Other workers commit under this same lock after saving, so the
+            # refreshed count already includes their uses
+            promo = self.storage.get_promo(state['code'])
+            if promo is None:
+                return False
+            promo.used_count += 1
+            self.storage.save_promo(promo)
+            return True
+
+    def release(self, reservation_id: str) -> bool:
+        """Give a reserved use back without recording it"""
+        key = self._key_of(reservation_id)
+        if key is None:
+            return False
+        with self._locked(key) as state:
+            return state['reserved'].pop(reservation_id, None) is not None
+
+    def active_reservations(self, code: str) -> int:
+        """Number of unexpired reservations held for a code"""
+        with self._locked(self._key(code)) as state:
+            return len(state['reserved'])
+
+class SQLitePromoUsageCounter:
+    """Usage counter whose reservations live in the shared SQLite database.
+
+    Every reserve and commit runs in a BEGIN IMMEDIATE transaction, so usage
+    limits hold across all worker processes using the same database file.
+    """
+
+    def __init__(self, storage, reservation_ttl: float = 900):
+        self.storage = storage
+        self.reservation_ttl = reservation_ttl
+        conn = storage._conn()
+        with conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS promo_reservations (
+                    id TEXT PRIMARY KEY,
+                    code TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_promo_reservations_code ON promo_reservations (code)")
+
+    def _transaction(self):
+        conn = self.storage._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        return conn
+
+    def reserve(self, code: str) -> Tuple[Optional[str], Optional[float]]:
+        now = time.time()
+        conn = self._transaction()
+        try:
+            conn.execute("DELETE FROM promo_reservations WHERE code = ? AND expires_at <= ?", (code, now))
+            row = conn.execute(
+                "SELECT usage_limit, used_count FROM promo_codes WHERE code = ?", (code,)
+            ).fetchone()
+            if row is None:
+                conn.rollback()
+                return None, None
+            usage_limit, used_count = row
+            reserved = conn.execute(
+                "SELECT COUNT(*) FROM promo_reservations WHERE code = ?", (code,)
+            ).fetchone()[0]
+            if usage_limit and used_count + reserved >= usage_limit:
+                conn.rollback()
+                return None, None
+
+            reservation_id = uuid.uuid4().hex
+            expires_at = now + self.reservation_ttl
+            conn.execute(
+                "INSERT INTO promo_reservations (id, code, expires_at) VALUES (?, ?, ?)",
+                (reservation_id, code, expires_at)
+            )
+            conn.commit()
+            return reservation_id, expires_at
+        except Exception:
+            conn.rollback()
+            raise
+
+    def commit(self, reservation_id: str) -> bool:
+        conn = self._transaction()
+        try:
+            row = conn.execute(
+                "SELECT code FROM promo_reservations WHERE id = ? AND expires_at > ?",
+                (reservation_id, time.time())
+            ).fetchone()
+            if row is None:
+                conn.rollback()
+                return False
+            conn.execute("DELETE FROM promo_reservations WHERE id = ?", (reservation_id,))
+            conn.execute("UPDATE promo_codes SET used_count = used_count + 1 WHERE code = ?", (row[0],))
+            conn.commit()
+            self.storage.invalidate_promo_rules()
+            return True
+        except Exception:
+            conn.rollback()
+            raise
+
+    def release(self, reservation_id: str) -> bool:
+        conn = self.storage._conn()
+        with conn:
+            cursor = conn.execute("DELETE FROM promo_reservations WHERE id = ?", (reservation_id,))
+        return cursor.rowcount > 0
+
+    def active_reservations(self, code: str) -> int:
+        return self.storage._conn().execute(
+            "SELECT COUNT(*) FROM promo_reservations WHERE code = ? AND expires_at > ?", (code, time.time())
+        ).fetchone()[0]
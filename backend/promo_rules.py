@@ -0,0 +1,128 @@
+"""
+Promo Code Rules - Pre-compiled validators for promotional codes
+"""
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from user_models import PromoCode
+
+# Book types each applicable_to value accepts; "both" books qualify for either
+APPLICABLE_BOOK_TYPES = {
+    "physical": frozenset(["physical", "both"]),
+    "ebook": frozenset(["ebook", "both"]),
+}
+
+def _epoch(timestamp: str) -> Optional[float]:
+    return datetime.fromisoformat(timestamp).timestamp() if timestamp else None
+
+def _value(item: Any, name: str):
+    if isinstance(item, dict):
+        return item.get(name)
+    return getattr(item, name, None)
+
+def cart_item_type(item: Any) -> Optional[str]:
+    """Book type of a cart item: a dict from the frontend or an ecommerce CartItem"""
+    book_type = _value(item, "book_type") or _value(item, "type")
+    if book_type is None:
+        book = _value(item, "book")
+        if book is not None:
+            book_type = _value(book, "book_type")
+    return getattr(book_type, "value", book_type)
+
+def cart_item_total(item: Any) -> Optional[float]:
+    """Price x quantity of a cart item, or None if the item carries no price"""
+    price = _value(item, "price")
+    if price is None:
+        book = _value(item, "book")
+        price = _value(book, "price") if book is not None else None
+    if price is None:
+        return None
+    return float(price) * (_value(item, "quantity") or 1)
+
+class CompiledPromo:
+    """A PromoCode with its rules resolved once, ready for repeated checks"""
+
+    __slots__ = ("promo", "code", "is_active", "valid_from", "valid_until", "usage_limit",
+                 "minimum_order", "discount_amount", "discount_percentage", "book_types",
+                 "applicable_to")
+
+    def __init__(self, promo: PromoCode):
+        self.promo = promo
+        self.code = promo.code.upper()
+        self.is_active = promo.is_active
+        self.valid_from = _epoch(promo.valid_from)
+        self.valid_until = _epoch(promo.valid_until)
+        self.usage_limit = promo.usage_limit or None
+        self.minimum_order = promo.minimum_order
+        self.discount_amount = promo.discount_amount or None
+        self.discount_percentage = promo.discount_percentage
+        self.applicable_to = promo.applicable_to
+        self.book_types = APPLICABLE_BOOK_TYPES.get(promo.applicable_to)
+
+    def check(self, order_total: float, cart_items: Optional[List] = None, now: Optional[float] = None) -> Dict:
+        """Validate the code for an order and compute its discount"""
+        if not self.is_active:
+            return {
+                "success": False,
+                "error": "This promotional code is no longer active"
+            }
+
+        # Check validity dates
+        now = time.time() if now is None else now
+        if self.valid_from is not None and self.valid_from > now:
+            return {
+                "success": False,
+                "error": "This promotional code is not yet valid"
+            }
+
+        if self.valid_until is not None and self.valid_until < now:
+            return {
+                "success": False,
+                "error": "This promotional code has expired"
+            }
+
+        # Check usage limit
+        if self.usage_limit and self.promo.used_count >= self.usage_limit:
+            return {
+                "success": False,
+                "error": "This promotional code has reached its usage limit"
+            }
+
+        # Check minimum order amount
+        if order_total < self.minimum_order:
+            return {
+                "success": False,
+                "error": f"Minimum order amount of ${self.minimum_order:.2f} required for this code"
+            }
+
+        # Restrict the discount to eligible books when the cart is known
+        eligible_total = order_total
+        if self.book_types is not None and cart_items:
+            eligible = [item for item in cart_items if cart_item_type(item) in self.book_types]
+            if not eligible:
+                return {
+                    "success": False,
+                    "error": f"This promotional code only applies to {self.applicable_to} books"
+                }
+            totals = [cart_item_total(item) for item in eligible]
+            if len(eligible) < len(cart_items) and None not in totals:
+                eligible_total = min(sum(totals), order_total)
+
+        # Calculate discount
+        if self.discount_amount:
+            discount = min(self.discount_amount, eligible_total)
+        else:
+            discount = eligible_total * (self.discount_percentage / 100)
+
+        # Ensure discount doesn't exceed order total
+        discount = min(discount, order_total)
+
+        return {
+            "success": True,
+            "code": self.code,
+            "discount_percentage": self.discount_percentage,
+            "discount_amount": discount,
+            "final_total": max(0, order_total - discount),
+            "message": f"Promotional code applied! {self.discount_percentage}% discount"
+        }
@@ -0,0 +1,76 @@
+"""
+Response Cache - Versioned, pre-serialized payloads for conditional GETs
+"""
+import secrets
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+CACHE_CONTROL = "private, no-cache"
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header names the current ETag"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+class ResponseCache:
+    """Serialized JSON bodies keyed by record or collection, tagged with a version.
+
+    Writers bump the version of whatever they changed; an entry is only
+    served while its version is current, so there is no TTL to tune. The
+    ETag is derived from the version alone, which lets a matching
+    If-None-Match be answered before any payload is built or serialized.
+    The instance token keeps ETags from a previous process (or another
+    worker) from ever matching by accident.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self.instance = secrets.token_hex(4)
+        self._epoch = 0
+        self._versions: Dict[str, int] = {}
+        self._entries: "OrderedDict[str, Tuple[str, bytes]]" = OrderedDict()  # key -> (etag, body)
+        self._lock = threading.Lock()
+
+    def etag(self, key: str) -> str:
+        """ETag for the current version of a key"""
+        return f'"{self.instance}-{self._epoch}-{self._versions.get(key, 0)}"'
+
+    def bump(self, key: str):
+        """Invalidate one key after its data changed"""
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            self._entries.pop(key, None)
+
+    def bump_all(self):
+        """Invalidate everything, e.g. after a full reload from disk"""
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+
+    def get(self, key: str) -> Optional[Tuple[str, bytes]]:
+        """Cached (etag, body) if it is still current"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != self.etag(key):
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, etag: str, body: bytes) -> Tuple[str, bytes]:
+        """Cache a body built for `etag`; it is dropped if the key changed meanwhile"""
+        entry = (etag, body)
+        with self._lock:
+            if etag == self.etag(key):
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return entry
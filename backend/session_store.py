@@ -0,0 +1,269 @@
+"""
+Session Store - HMAC-signed session tokens with a TTL/LRU validation cache
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+from fastapi import Header, HTTPException
+
+from app_logging import get_logger
+
+logger = get_logger("session_store")
+
+@dataclass
+class Session:
+    session_id: str
+    user_id: str
+    email: str
+    role: str
+    is_premium: bool
+    expires_at: float
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+class SessionStore:
+    """Issues and validates self-contained, HMAC-signed session tokens.
+
+    A token carries the session claims and a signature, so any process that
+    shares the secret (BOOKHAVEN_SESSION_SECRET) can validate it without a
+    database lookup or password check. Validated tokens are kept in a
+    bounded LRU cache so repeat requests skip even the HMAC. Revocations
+    are held in memory until the token would have expired anyway. With a
+    revocations_file they are also appended to that file, which every
+    process sharing it reads before trusting a token, so a logout holds in
+    all workers.
+    """
+
+    def __init__(self, secret: Optional[bytes] = None, ttl: int = 3600, cache_size: int = 10000,
+                 revocations_file: Optional[str] = None, revocations_compact_bytes: int = 1 << 20):
+        self.secret = secret or secrets.token_bytes(32)
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.revocations_file = revocations_file
+        self.revocations_compact_bytes = revocations_compact_bytes
+        self._cache: "OrderedDict[str, Session]" = OrderedDict()
+        self._revoked: Dict[str, float] = {}  # session_id -> expires_at
+        self._lock = threading.Lock()
+        # Identity and read position of the shared revocations file
+        self._revocations_inode: Optional[int] = None
+        self._revocations_offset = 0
+
+    @classmethod
+    def from_env(cls) -> "SessionStore":
+        """Build a store from BOOKHAVEN_SESSION_SECRET and BOOKHAVEN_SESSION_TTL"""
+        secret = os.environ.get("BOOKHAVEN_SESSION_SECRET")
+        if not secret:
+            logger.warning("BOOKHAVEN_SESSION_SECRET not set; session tokens will only be valid in this process")
+        # Tokens signed with a shared secret are accepted by every worker, so
+        # their revocations must be visible to every worker too
+        revocations_file = os.environ.get("BOOKHAVEN_SESSION_REVOCATIONS_FILE",
+                                          "revoked_sessions.log" if secret else "")
+        return cls(
+            secret=secret.encode() if secret else None,
+            ttl=int(os.environ.get("BOOKHAVEN_SESSION_TTL", 3600)),
+            revocations_file=revocations_file or None,
+        )
+
+    def _sign(self, payload: str) -> str:
+        return _b64encode(hmac.new(self.secret, payload.encode('ascii'), hashlib.sha256).digest())
+
+    def issue(self, user: Dict) -> Tuple[str, Session]:
+        """Create a session token for a user dict as returned by UserDatabase"""
+        session = Session(
+            session_id=secrets.token_urlsafe(16),
+            user_id=user["id"],
+            email=user["email"],
+            role=user.get("role", "user"),
+            is_premium=bool(user.get("is_premium")),
+            expires_at=time.time() + self.ttl
+        )
+        claims = {
+            "sid": session.session_id,
+            "uid": session.user_id,
+            "email": session.email,
+            "role": session.role,
+            "premium": session.is_premium,
+            "exp": session.expires_at
+        }
+        payload = _b64encode(json.dumps(claims, separators=(',', ':')).encode())
+        token = f"{payload}.{self._sign(payload)}"
+        self._remember(token, session)
+        return token, session
+
+    def validate(self, token: str) -> Optional[Session]:
+        """Return the session for a valid, unexpired, unrevoked token"""
+        now = time.time()
+        self._read_revocations()
+        with self._lock:
+            session = self._cache.get(token)
+            if session is not None:
+                if session.expires_at > now and session.session_id not in self._revoked:
+                    self._cache.move_to_end(token)
+                    return session
+                del self._cache[token]
+                return None
+
+        session = self._decode(token)
+        if session is None or session.expires_at <= now or session.session_id in self._revoked:
+            return None
+        self._remember(token, session)
+        return session
+
+    def revoke(self, token: str) -> bool:
+        """Revoke a token; returns False if it was not a valid token"""
+        session = self.validate(token)
+        if session is None:
+            return False
+        if self.revocations_file is not None:
+            self._append_revocation(session)
+        with self._lock:
+            self._revoked[session.session_id] = session.expires_at
+            self._cache.pop(token, None)
+            self._purge_revoked()
+        return True
+
+    @contextmanager
+    def _revocations_locked(self):
+        """Hold the cross-process lock that orders appends and rewrites of the revocations file"""
+        if fcntl is None:
+            yield
+            return
+        with open(f"{self.revocations_file}.lock", 'a+') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _append_revocation(self, session: Session):
+        """Record a revocation where every process sharing the file will see it"""
+        with self._revocations_locked():
+            with open(self.revocations_file, 'a') as f:
+                f.write(f"{session.session_id} {session.expires_at}\n")
+                f.flush()
+                os.fsync(f.fileno())
+                size = f.tell()
+            if size >= self.revocations_compact_bytes:
+                self._compact_revocations()
+
+    def _compact_revocations(self):
+        """Rewrite the revocations file without expired entries; caller holds the file lock"""
+        self._read_revocations()
+        now = time.time()
+        with self._lock:
+            live = [(session_id, expires_at) for session_id, expires_at in self._revoked.items()
+                    if expires_at > now]
+        tmp_file = f"{self.revocations_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            f.writelines(f"{session_id} {expires_at}\n" for session_id, expires_at in live)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.revocations_file)
+        # Still mostly live entries: raise the bar so the next revoke does not rewrite again
+        self.revocations_compact_bytes = max(self.revocations_compact_bytes, 2 * os.path.getsize(self.revocations_file))
+
+    def _read_revocations(self):
+        """Pick up revocations other processes appended since the last look"""
+        if self.revocations_file is None:
+            return
+        try:
+            stat = os.stat(self.revocations_file)
+        except FileNotFoundError:
+            return
+        if stat.st_ino == self._revocations_inode and stat.st_size == self._revocations_offset:
+            return
+        with self._lock:
+            if stat.st_ino != self._revocations_inode:
+                # Rewritten by a compaction; its entries are a subset of what was there
+                self._revocations_inode = stat.st_ino
+                self._revocations_offset = 0
+            try:
+                with open(self.revocations_file, 'rb') as f:
+                    f.seek(self._revocations_offset)
+                    data = f.read()
+            except FileNotFoundError:
+                return
+            # Leave a partly written last line for the next read
+            end = data.rfind(b'\n') + 1
+            self._revocations_offset += end
+            for line in data[:end].decode('ascii', 'replace').splitlines():
+                session_id, _, expires_at = line.partition(' ')
+                try:
+                    self._revoked[session_id] = float(expires_at)
+                except ValueError:
+                    continue
+
+    def _decode(self, token: str) -> Optional[Session]:
+        """Check the signature and parse the claims of a token"""
+        try:
+            payload, signature = token.split(".")
+            if not hmac.compare_digest(signature, self._sign(payload)):
+                return None
+            claims = json.loads(_b64decode(payload))
+            return Session(
+                session_id=claims["sid"],
+                user_id=claims["uid"],
+                email=claims["email"],
+                role=claims["role"],
+                is_premium=claims["premium"],
+                expires_at=claims["exp"]
+            )
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    def _remember(self, token: str, session: Session):
+        with self._lock:
+            # A revoke() may have landed since the caller checked
+            if session.session_id in self._revoked:
+                return
+            self._cache[token] = session
+            self._cache.move_to_end(token)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _purge_revoked(self):
+        """Forget revocations of tokens that have expired anyway"""
+        now = time.time()
+        expired = [session_id for session_id, expires_at in self._revoked.items() if expires_at <= now]
+        for session_id in expired:
+            del self._revoked[session_id]
+
+# Global session store shared by both API servers in a process
+session_store = SessionStore.from_env()
+
+def bearer_token(authorization: Optional[str]) -> Optional[str]:
+    if authorization and authorization.lower().startswith("bearer "):
+        return authorization[7:].strip()
+    return None
+
+async def optional_session(authorization: Optional[str] = Header(None)) -> Optional[Session]:
+    """FastAPI dependency: the caller's session, or None if no valid token was sent"""
+    token = bearer_token(authorization)
+    return session_store.validate(token) if token else None
+
+async def require_session(authorization: Optional[str] = Header(None)) -> Session:
+    """FastAPI dependency: the caller's session, rejecting the request with 401 otherwise"""
+    token = bearer_token(authorization)
+    session = session_store.validate(token) if token else None
+    if session is None:
+        raise HTTPException(status_code=401, detail="Invalid or expired session")
+    return session
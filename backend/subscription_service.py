@@ -1,11 +1,24 @@
 """
 Subscription Service - Handles premium subscriptions and theme unlocking
 """
+import asyncio
+import functools
 import json
 import datetime
-from typing import Dict, List, Optional
-from dataclasses import dataclass, asdict
+import threading
+from collections import deque
+from types import MappingProxyType
+from typing import Callable, Deque, Dict, Iterable, List, Mapping, Optional, Set, Tuple
+import time
+from dataclasses import dataclass
 from enum import Enum
+from app_logging import elapsed_ms, get_logger, log_event
+from app_metrics import timed
+from expiry_scheduler import ExpiryScheduler
+from fast_json import dumps
+from subscription_storage import SubscriptionStorage
+
+logger = get_logger("subscription_service")
 
 class SubscriptionTier(Enum):
     FREE = "free"
@@ -17,6 +30,13 @@ class ThemeTier(Enum):
     MONTHLY = "monthly"
     YEARLY = "yearly"
 
+# Theme tiers each subscription tier unlocks, in the order themes are listed
+TIER_THEME_TIERS = {
+    SubscriptionTier.FREE: (ThemeTier.FREE,),
+    SubscriptionTier.MONTHLY: (ThemeTier.FREE, ThemeTier.MONTHLY),
+    SubscriptionTier.YEARLY: (ThemeTier.FREE, ThemeTier.MONTHLY, ThemeTier.YEARLY),
+}
+
 @dataclass
 class Theme:
     id: str
@@ -24,7 +44,17 @@ class Theme:
     description: str
     colors: List[str]
     tier: ThemeTier
-    
+
+    def to_dict(self) -> Dict:
+        """JSON-ready dict without the deep copy asdict() makes (colors is shared, not copied)"""
+        return {
+            "id": self.id,
+            "name": self.name,
+            "description": self.description,
+            "colors": self.colors,
+            "tier": self.tier.value
+        }
+
 @dataclass
 class Subscription:
     user_id: str
@@ -34,6 +64,43 @@ class Subscription:
     auto_renew: bool = True
     transaction_id: Optional[str] = None
 
+    def to_dict(self) -> Dict:
+        """JSON-ready dict with the tier as its value and dates in ISO format"""
+        return {
+            "user_id": self.user_id,
+            "tier": self.tier.value,
+            "start_date": self.start_date.isoformat(),
+            "end_date": self.end_date.isoformat(),
+            "auto_renew": self.auto_renew,
+            "transaction_id": self.transaction_id
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Subscription":
+        """Inverse of to_dict"""
+        return cls(
+            user_id=data["user_id"],
+            tier=SubscriptionTier(data["tier"]),
+            start_date=datetime.datetime.fromisoformat(data["start_date"]),
+            end_date=datetime.datetime.fromisoformat(data["end_date"]),
+            auto_renew=data.get("auto_renew", True),
+            transaction_id=data.get("transaction_id")
+        )
+
+@dataclass
+class ExpiryEvent:
+    user_id: str
+    tier: SubscriptionTier
+    end_date: datetime.datetime
+    auto_renew: bool
+
+@dataclass
+class RenewalRequest:
+    user_id: str
+    tier: SubscriptionTier
+    expired_at: datetime.datetime
+    previous_transaction_id: Optional[str] = None
+
 @dataclass
 class SubscriptionResponse:
     success: bool
@@ -43,9 +110,9 @@ class SubscriptionResponse:
     message: str
 
 class SubscriptionService:
-    def __init__(self):
+    def __init__(self, storage: Optional[SubscriptionStorage] = None):
         # Define all available themes
-        self.themes = {
+        self.set_themes({
             "light": Theme("light", "Light", "Clean and bright default theme", 
                           ["#ffffff", "#f8f9fa", "#e9ecef", "#dee2e6"], ThemeTier.FREE),
             "dark": Theme("dark", "Dark", "Easy on the eyes default dark theme", 
@@ -66,46 +133,134 @@ class SubscriptionService:
                                  ["#0c4a6e", "#0369a1", "#0284c7", "#38bdf8"], ThemeTier.YEARLY),
             "golden-hour": Theme("golden-hour", "Golden Hour", "Warm golden tones perfect for evening reading", 
                                 ["#451a03", "#92400e", "#d97706", "#fbbf24"], ThemeTier.YEARLY),
-        }
+        }.values())
         
         # In-memory storage (in production, use a proper database)
         self.subscriptions = {}
         self.user_themes = {}
-    
-    def get_themes_for_tier(self, tier: SubscriptionTier) -> List[Theme]:
-        """Get all themes available for a subscription tier"""
-        available_themes = []
         
-        # Free themes are always available
-        available_themes.extend([theme for theme in self.themes.values() if theme.tier == ThemeTier.FREE])
+        # Active paid entitlements: user_id -> (tier, end timestamp). Reads check
+        # this table alone; expired entries are swept out in batches by expire_due()
+        self.entitlements: Dict[str, Tuple[SubscriptionTier, float]] = {}
+        self.expired_users: Set[str] = set()
+        self.expiry = ExpiryScheduler()
+        self.renewal_queue: Deque[RenewalRequest] = deque()
+        self.expiry_listeners: List[Callable[[ExpiryEvent], None]] = []
         
-        # Monthly themes for monthly and yearly subscribers
-        if tier in [SubscriptionTier.MONTHLY, SubscriptionTier.YEARLY]:
-            available_themes.extend([theme for theme in self.themes.values() if theme.tier == ThemeTier.MONTHLY])
+        # Writers (subscriptions, the expiry sweep, refreshes) run on worker
+        # threads and take this lock to change the in-memory tables; storage
+        # I/O happens outside it. Readers rely on single dict lookups.
+        self._lock = threading.RLock()
         
-        # Yearly themes only for yearly subscribers
-        if tier == SubscriptionTier.YEARLY:
-            available_themes.extend([theme for theme in self.themes.values() if theme.tier == ThemeTier.YEARLY])
-        
-        return available_themes
+        # Optional persistence; without it subscriptions live only in memory
+        self.storage = storage
+        if storage is not None:
+            self.load()
+    
+    def load(self):
+        """Rebuild the in-memory tables from storage"""
+        self.storage.load()
+        for record in self.storage.iter_subscriptions():
+            self._activate(Subscription.from_dict(record), record.get('themes') or {})
+        self.expired_users.update(self.storage.expired_user_ids())
+    
+    def close(self):
+        """Flush and close the storage backend"""
+        if self.storage is not None:
+            self.storage.close()
+    
+    def _activate(self, subscription: Subscription, theme_data: Dict):
+        """Make a subscription the user's current one and schedule its expiry"""
+        user_id = subscription.user_id
+        ends_at = subscription.end_date.timestamp()
+        self.subscriptions[user_id] = subscription
+        self.user_themes[user_id] = theme_data
+        self.entitlements[user_id] = (subscription.tier, ends_at)
+        self.expired_users.discard(user_id)
+        self.expiry.schedule(user_id, ends_at)
+    
+    def _deactivate(self, user_id: str) -> Optional[Subscription]:
+        """Drop a user's subscription from the in-memory tables, remembering that it expired"""
+        subscription = self.subscriptions.pop(user_id, None)
+        self.user_themes.pop(user_id, None)
+        self.entitlements.pop(user_id, None)
+        self.expiry.cancel(user_id)
+        if subscription is not None:
+            self.expired_users.add(user_id)
+        return subscription
+    
+    def _refresh(self):
+        """Apply subscription changes other worker processes have stored"""
+        if self.storage is None:
+            return
+        changes = self.storage.refresh()
+        if not changes:
+            return
+        with self._lock:
+            for user_id, record in changes:
+                if record is None:
+                    self._deactivate(user_id)
+                else:
+                    self._activate(Subscription.from_dict(record), record.get('themes') or {})
+    
+    @property
+    def themes(self) -> Mapping[str, Theme]:
+        """Read-only theme catalog; change it through set_themes/add_theme/remove_theme"""
+        return self._themes_view
+
+    def set_themes(self, themes: Iterable[Theme]):
+        """Replace the theme catalog and rebuild the entitlement tables"""
+        catalog = {theme.id: theme for theme in themes}
+        # Each theme gets one bit; a tier's mask has the bits of every theme it unlocks
+        theme_bits = {theme_id: 1 << i for i, theme_id in enumerate(catalog)}
+        tier_themes = {
+            tier: tuple(theme for theme_tier in theme_tiers
+                        for theme in catalog.values() if theme.tier == theme_tier)
+            for tier, theme_tiers in TIER_THEME_TIERS.items()
+        }
+        tier_masks = {
+            tier: sum(theme_bits[theme.id] for theme in themes_for_tier)
+            for tier, themes_for_tier in tier_themes.items()
+        }
+        # The theme list of a status response depends only on the tier, so it is
+        # serialized once here rather than on every poll
+        tier_theme_dicts = {
+            tier: tuple(theme.to_dict() for theme in themes_for_tier)
+            for tier, themes_for_tier in tier_themes.items()
+        }
+        tier_theme_json = {tier: dumps(list(dicts)) for tier, dicts in tier_theme_dicts.items()}
+        # Swap everything in at once so readers never see a half-built table
+        self._themes, self._themes_view = catalog, MappingProxyType(catalog)
+        self._theme_bits, self._tier_themes, self._tier_masks = theme_bits, tier_themes, tier_masks
+        self._tier_theme_dicts, self._tier_theme_json = tier_theme_dicts, tier_theme_json
+
+    def add_theme(self, theme: Theme):
+        """Add or replace one theme"""
+        self.set_themes([*(t for t in self._themes.values() if t.id != theme.id), theme])
+
+    def remove_theme(self, theme_id: str):
+        """Remove one theme from the catalog"""
+        self.set_themes(t for t in self._themes.values() if t.id != theme_id)
+
+    def get_themes_for_tier(self, tier: SubscriptionTier) -> Tuple[Theme, ...]:
+        """Get all themes available for a subscription tier (free, then monthly, then yearly themes)"""
+        return self._tier_themes[tier]
     
     def get_newly_unlocked_themes(self, old_tier: SubscriptionTier, new_tier: SubscriptionTier) -> List[Theme]:
         """Get themes that are newly unlocked when upgrading from old_tier to new_tier"""
-        old_themes = set(theme.id for theme in self.get_themes_for_tier(old_tier))
-        new_themes = set(theme.id for theme in self.get_themes_for_tier(new_tier))
-        newly_unlocked_ids = new_themes - old_themes
-        
-        return [self.themes[theme_id] for theme_id in newly_unlocked_ids]
+        old_mask = self._tier_masks[old_tier]
+        return [theme for theme in self._tier_themes[new_tier] if not old_mask & self._theme_bits[theme.id]]
     
+    @timed("process_subscription")
     def process_subscription(self, user_id: str, tier: str, payment_data: Dict) -> SubscriptionResponse:
         """Process a new subscription and unlock themes immediately"""
+        started = time.perf_counter()
         try:
             # Validate subscription tier
             subscription_tier = SubscriptionTier(tier)
             
-            # Get current subscription (if any)
-            current_subscription = self.subscriptions.get(user_id)
-            old_tier = current_subscription.tier if current_subscription else SubscriptionTier.FREE
+            # Tier the user currently has (an expired subscription counts as free)
+            old_tier, _ = self._entitlement(user_id)
             
             # Calculate subscription dates
             start_date = datetime.datetime.now()
@@ -123,9 +278,6 @@ class SubscriptionService:
                 transaction_id=payment_data.get('transaction_id')
             )
             
-            # Store subscription
-            self.subscriptions[user_id] = new_subscription
-            
             # Get all available themes for new tier
             all_available_themes = self.get_themes_for_tier(subscription_tier)
             
@@ -135,8 +287,8 @@ class SubscriptionService:
             # Auto-apply the first newly unlocked theme (if any)
             auto_applied_theme = newly_unlocked_themes[0] if newly_unlocked_themes else None
             
-            # Update user's available themes
-            self.user_themes[user_id] = {
+            # User's available themes
+            theme_data = {
                 'available_themes': [theme.id for theme in all_available_themes],
                 'newly_unlocked': [theme.id for theme in newly_unlocked_themes],
                 'auto_applied': auto_applied_theme.id if auto_applied_theme else None,
@@ -144,15 +296,19 @@ class SubscriptionService:
                 'unlock_timestamp': start_date.isoformat()
             }
             
+            # Persist first so a failed write never leaves an unsaved subscription
+            # active, then store it and schedule its expiry
+            if self.storage is not None:
+                self.storage.save_subscription(dict(new_subscription.to_dict(), themes=theme_data))
+            with self._lock:
+                self._activate(new_subscription, theme_data)
+            
             # Log the successful subscription
-            print(f"=== SUBSCRIPTION PROCESSED ===")
-            print(f"User ID: {user_id}")
-            print(f"Tier: {subscription_tier.value}")
-            print(f"Total Themes Unlocked: {len(all_available_themes)}")
-            print(f"Newly Unlocked Themes: {[t.name for t in newly_unlocked_themes]}")
-            print(f"Auto-Applied Theme: {auto_applied_theme.name if auto_applied_theme else 'None'}")
-            print(f"Transaction ID: {payment_data.get('transaction_id')}")
-            print(f"=== END SUBSCRIPTION LOG ===")
+            log_event(logger, "subscription_processed", user_id=user_id, tier=subscription_tier.value,
+                      themes_unlocked=len(all_available_themes),
+                      newly_unlocked=[t.id for t in newly_unlocked_themes],
+                      auto_applied=auto_applied_theme.id if auto_applied_theme else None,
+                      transaction_id=payment_data.get('transaction_id'), duration_ms=elapsed_ms(started))
             
             return SubscriptionResponse(
                 success=True,
@@ -163,7 +319,7 @@ class SubscriptionService:
             )
             
         except Exception as e:
-            print(f"Subscription processing error: {str(e)}")
+            logger.error("Subscription processing error: %s", e)
             return SubscriptionResponse(
                 success=False,
                 subscription=None,
@@ -172,46 +328,118 @@ class SubscriptionService:
                 message=f"Failed to process subscription: {str(e)}"
             )
     
-    def get_user_subscription_status(self, user_id: str) -> Dict:
-        """Get current subscription status and available themes for a user"""
-        subscription = self.subscriptions.get(user_id)
-        user_theme_data = self.user_themes.get(user_id, {})
-        
-        if not subscription:
-            # Free user
-            free_themes = self.get_themes_for_tier(SubscriptionTier.FREE)
-            return {
-                'tier': 'free',
-                'is_premium': False,
-                'available_themes': [asdict(theme) for theme in free_themes],
-                'total_themes': len(free_themes),
-                'subscription_active': False
-            }
+    def _entitlement(self, user_id: str) -> Tuple[SubscriptionTier, bool]:
+        """Tier a user is entitled to right now, and whether they have a lapsed subscription"""
+        self._refresh()
+        return self._entitlement_at(user_id, time.time())
+    
+    def _entitlement_at(self, user_id: str, now: float) -> Tuple[SubscriptionTier, bool]:
+        """_entitlement as of `now`, without first pulling in other workers' changes"""
+        entry = self.entitlements.get(user_id)
+        if entry is None:
+            return SubscriptionTier.FREE, user_id in self.expired_users
+        tier, ends_at = entry
+        # Lapsed but not yet swept by expire_due()
+        if now > ends_at:
+            return SubscriptionTier.FREE, True
+        return tier, False
+    
+    def expire_due(self, now: Optional[float] = None, batch_size: int = 1000) -> List[ExpiryEvent]:
+        """Downgrade up to batch_size subscriptions whose end_date has passed.
+
+        Expired users drop out of subscriptions, user_themes and entitlements
+        (only their id is kept, in expired_users). Subscriptions with
+        auto_renew are queued on renewal_queue for billing to charge again.
+        """
+        now = time.time() if now is None else now
+        # Renewals stored by other workers move their expiry out of this batch
+        self._refresh()
+        with self._lock:
+            due = self.expiry.pop_due(now, batch_size)
+        if not due:
+            return []
+        # Only the worker whose write actually expires a subscription reports it
+        try:
+            expired_here = set(self.storage.expire_subscriptions(due, now)) if self.storage is not None else set(due)
+        except Exception:
+            # Put the batch back so the next sweep retries it
+            with self._lock:
+                for user_id in due:
+                    entry = self.entitlements.get(user_id)
+                    if entry is not None:
+                        self.expiry.schedule(user_id, entry[1])
+            raise
+        events = []
+        with self._lock:
+            for user_id in due:
+                entry = self.entitlements.get(user_id)
+                if entry is not None and entry[1] > now:
+                    # Renewed while the batch was being written
+                    continue
+                subscription = self._deactivate(user_id)
+                if subscription is None or user_id not in expired_here:
+                    continue
+                events.append(ExpiryEvent(user_id, subscription.tier, subscription.end_date, subscription.auto_renew))
+                if subscription.auto_renew:
+                    self.renewal_queue.append(RenewalRequest(
+                        user_id, subscription.tier, subscription.end_date, subscription.transaction_id
+                    ))
         
-        # Check if subscription is still active
-        now = datetime.datetime.now()
-        is_active = now <= subscription.end_date
+        for event in events:
+            log_event(logger, "subscription_expired", user_id=event.user_id, tier=event.tier.value,
+                      end_date=event.end_date.isoformat(), auto_renew=event.auto_renew)
+            for listener in self.expiry_listeners:
+                try:
+                    listener(event)
+                except Exception as e:
+                    logger.error("Expiry listener error: %s", e)
+        return events
+    
+    def pop_renewals(self, limit: int = 100) -> List[RenewalRequest]:
+        """Take up to `limit` queued renewals, oldest first"""
+        renewals = []
+        while self.renewal_queue and len(renewals) < limit:
+            renewals.append(self.renewal_queue.popleft())
+        return renewals
+    
+    async def run_expiry_loop(self, interval: float = 30.0, batch_size: int = 1000):
+        """Sweep expired subscriptions forever on a worker thread, so storage writes never block the event loop"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, functools.partial(self.expire_due, batch_size=batch_size))
+            except Exception as e:
+                logger.error("Expiry sweep failed: %s", e)
+                await asyncio.sleep(interval)
+                continue
+            await asyncio.sleep(0 if self.expiry.has_due(time.time()) else interval)
+    
+    def _status_fields(self, user_id: str) -> Tuple[SubscriptionTier, Dict]:
+        """Tier whose themes the user gets, plus every status field except available_themes"""
+        tier, expired = self._entitlement(user_id)
+        subscription = self.subscriptions.get(user_id) if tier != SubscriptionTier.FREE else None
+        if tier != SubscriptionTier.FREE and subscription is None:
+            # Expired by the sweep on another thread since the entitlement lookup
+            tier, expired = SubscriptionTier.FREE, True
         
-        if not is_active:
-            # Expired subscription - revert to free
-            free_themes = self.get_themes_for_tier(SubscriptionTier.FREE)
-            return {
+        if tier == SubscriptionTier.FREE:
+            fields = {
                 'tier': 'free',
                 'is_premium': False,
-                'available_themes': [asdict(theme) for theme in free_themes],
-                'total_themes': len(free_themes),
-                'subscription_active': False,
-                'expired': True
+                'total_themes': len(self._tier_themes[SubscriptionTier.FREE]),
+                'subscription_active': False
             }
+            # Lapsed subscription - reverted to free
+            if expired:
+                fields['expired'] = True
+            return tier, fields
         
         # Active subscription
-        available_themes = self.get_themes_for_tier(subscription.tier)
-        
-        return {
-            'tier': subscription.tier.value,
+        user_theme_data = self.user_themes.get(user_id, {})
+        return tier, {
+            'tier': tier.value,
             'is_premium': True,
-            'available_themes': [asdict(theme) for theme in available_themes],
-            'total_themes': len(available_themes),
+            'total_themes': len(self._tier_themes[tier]),
             'subscription_active': True,
             'end_date': subscription.end_date.isoformat(),
             'newly_unlocked': user_theme_data.get('newly_unlocked', []),
@@ -219,25 +447,65 @@ class SubscriptionService:
             'unlock_timestamp': user_theme_data.get('unlock_timestamp')
         }
     
+    def _with_themes_json(self, tier: SubscriptionTier, fields: Dict) -> bytes:
+        """JSON object of fields with the tier's pre-serialized available_themes spliced in"""
+        return b'{"available_themes":' + self._tier_theme_json[tier] + b',' + dumps(fields)[1:]
+    
+    def get_user_subscription_status(self, user_id: str) -> Dict:
+        """Get current subscription status and available themes for a user.
+
+        The theme dicts are shared per tier; treat them as read-only.
+        """
+        tier, fields = self._status_fields(user_id)
+        return {'available_themes': list(self._tier_theme_dicts[tier]), **fields}
+    
+    def get_user_subscription_status_json(self, user_id: str) -> bytes:
+        """get_user_subscription_status() already encoded as JSON"""
+        return self._with_themes_json(*self._status_fields(user_id))
+    
+    def get_available_themes_json(self, user_id: str) -> bytes:
+        """JSON body for the available-themes endpoint"""
+        tier, fields = self._status_fields(user_id)
+        return self._with_themes_json(tier, {
+            'total_themes': fields['total_themes'],
+            'subscription_tier': fields['tier'],
+            'is_premium': fields['is_premium']
+        })
+    
     def validate_theme_access(self, user_id: str, theme_id: str) -> bool:
         """Validate if a user has access to a specific theme"""
-        if theme_id not in self.themes:
+        theme_bit = self._theme_bits.get(theme_id)
+        if theme_bit is None:
             return False
         
-        subscription = self.subscriptions.get(user_id)
-        if not subscription:
-            # Free user - only free themes
-            return self.themes[theme_id].tier == ThemeTier.FREE
-        
-        # Check if subscription is active
-        now = datetime.datetime.now()
-        if now > subscription.end_date:
-            # Expired - only free themes
-            return self.themes[theme_id].tier == ThemeTier.FREE
-        
-        # Active subscription - check tier access
-        available_themes = self.get_themes_for_tier(subscription.tier)
-        return any(theme.id == theme_id for theme in available_themes)
+        # Free users and expired subscriptions only get free themes
+        tier, _ = self._entitlement(user_id)
+        return bool(self._tier_masks[tier] & theme_bit)
+    
+    def validate_theme_access_batch(self, checks: Iterable[Tuple[str, str]]) -> List[Optional[bool]]:
+        """Validate many (user_id, theme_id) pairs, in order; None marks an unknown theme.
+
+        Storage is refreshed once for the whole batch and each user's
+        entitlement is resolved once, however many of their themes are checked.
+        """
+        self._refresh()
+        now = time.time()
+        user_masks: Dict[str, int] = {}
+        results = []
+        for user_id, theme_id in checks:
+            theme_bit = self._theme_bits.get(theme_id)
+            if theme_bit is None:
+                results.append(None)
+                continue
+            mask = user_masks.get(user_id)
+            if mask is None:
+                mask = user_masks[user_id] = self._tier_masks[self._entitlement_at(user_id, now)[0]]
+            results.append(bool(mask & theme_bit))
+        return results
+    
+    def validate_user_theme_access(self, user_id: str, theme_ids: Iterable[str]) -> List[Optional[bool]]:
+        """Validate one user's access to many themes, in order; None marks an unknown theme"""
+        return self.validate_theme_access_batch((user_id, theme_id) for theme_id in theme_ids)
 
 # Example usage and testing
 if __name__ == "__main__":
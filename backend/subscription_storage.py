@@ -0,0 +1,354 @@
+"""
+Subscription Storage Backends - JSON journal and SQLite persistence for SubscriptionService
+
+Backends store plain records, Subscription.to_dict() plus a "themes" dict
+with the user's unlock data, so they do not depend on the service's classes.
+"""
+import json
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from group_commit import GroupCommitFlusher
+from app_logging import get_logger
+from journal import Journal, write_json_snapshot
+from user_storage import SQLITE_SYNCHRONOUS
+
+logger = get_logger("subscription_storage")
+
+class SubscriptionStorage:
+    """Interface implemented by every SubscriptionService storage backend"""
+
+    def load(self) -> bool:
+        """Load persisted state; returns False when the store is new"""
+        raise NotImplementedError
+
+    def compact(self):
+        """Rewrite persisted state compactly (no-op where not applicable)"""
+
+    def close(self):
+        """Flush and release resources"""
+
+    def iter_subscriptions(self) -> Iterator[Dict]:
+        """Records of every active subscription"""
+        raise NotImplementedError
+
+    def expired_user_ids(self) -> Iterable[str]:
+        """Users whose last subscription expired"""
+        raise NotImplementedError
+
+    def save_subscription(self, record: Dict):
+        """Insert or replace a user's active subscription"""
+        raise NotImplementedError
+
+    def expire_subscriptions(self, user_ids: List[str], now: float) -> List[str]:
+        """Mark subscriptions ending by `now` as expired in one write.
+
+        Returns the users this call expired; ones already expired (e.g. by
+        another worker) or renewed past `now` are left out.
+        """
+        raise NotImplementedError
+
+    def refresh(self) -> List[Tuple[str, Optional[Dict]]]:
+        """Changes other processes made since the last call, as (user_id, record or None if expired)"""
+        return []
+
+class JsonSubscriptionStorage(SubscriptionStorage):
+    """Subscriptions persisted as a JSON snapshot plus a change journal.
+
+    Meant for a single process; use the SQLite backend to run several workers.
+    """
+
+    def __init__(self, db_file: str = "subscriptions.json", compact_ratio: float = 1.0,
+                 durability: str = "batched", flush_interval: float = 0.05, flush_batch_size: int = 512):
+        self.db_file = db_file
+        self.durability = durability
+        self.journal = Journal(db_file, compact_ratio=compact_ratio)
+        self.subscriptions: Dict[str, Dict] = {}
+        self.expired: Set[str] = set()
+        # Keeps in-memory changes and their journal records in the same order across threads
+        self._lock = threading.Lock()
+        self.flusher = GroupCommitFlusher(self._write_records, durability, flush_interval, flush_batch_size)
+        # One compaction at a time; _schedule_lock only guards starting the background thread
+        self._compact_lock = threading.Lock()
+        self._schedule_lock = threading.Lock()
+        self._compaction_thread: Optional[threading.Thread] = None
+
+    def load(self) -> bool:
+        """Load the snapshot and replay the change journal"""
+        if not self.journal.exists():
+            return False
+        data = self.journal.read_snapshot() or {}
+        for record in data.get('subscriptions', []):
+            self.subscriptions[record['user_id']] = record
+        self.expired.update(data.get('expired_users', []))
+        for record in self.journal.replay():
+            self._apply_record(record)
+        return True
+
+    def compact(self, only_if_due: bool = False):
+        """Write every subscription into a fresh snapshot and drop the journal it covers.
+
+        With only_if_due, skip it unless the journal still needs compacting.
+        """
+        with self._compact_lock:
+            # Copy the state with journal writes held off, so it covers
+            # exactly the journal up to keep_from
+            with self._lock, self.flusher.paused():
+                if only_if_due and not self.journal.needs_compaction():
+                    return
+                snapshot = {
+                    'subscriptions': list(self.subscriptions.values()),
+                    'expired_users': sorted(self.expired)
+                }
+                keep_from = self.journal.size()
+
+            # Writing the snapshot is the slow part; writers carry on meanwhile
+            tmp_file = self.journal.prepare_snapshot(lambda path: write_json_snapshot(path, snapshot))
+
+            with self._lock, self.flusher.paused():
+                self.journal.install_snapshot(tmp_file, keep_from)
+
+    def _schedule_compaction(self):
+        """Start a background compaction unless one is already running"""
+        with self._schedule_lock:
+            if self._compaction_thread is not None and self._compaction_thread.is_alive():
+                return
+            self._compaction_thread = threading.Thread(target=self._compact_in_background,
+                                                       name="subscription-compaction", daemon=True)
+            self._compaction_thread.start()
+
+    def _compact_in_background(self):
+        try:
+            self.compact(only_if_due=True)
+        except Exception as e:
+            logger.error("Subscription journal compaction failed: %s", e)
+
+    def close(self):
+        thread = self._compaction_thread
+        if thread is not None:
+            thread.join()
+        self.flusher.close()
+        self.journal.close()
+
+    def _apply_record(self, record: Dict):
+        """Apply a replayed journal record to the in-memory state"""
+        if record['op'] == 'subscription':
+            data = record['data']
+            self.subscriptions[data['user_id']] = data
+            self.expired.discard(data['user_id'])
+        elif record['op'] == 'expired':
+            for user_id in record['data']['user_ids']:
+                self.subscriptions.pop(user_id, None)
+                self.expired.add(user_id)
+
+    def _record_change(self, op: str, data: Dict) -> int:
+        """Apply a change and queue it for the journal; caller holds _lock and passes the result to _commit()"""
+        record = {'op': op, 'data': data}
+        self._apply_record(record)
+        return self.flusher.enqueue(record)
+
+    def _commit(self, sequence: int):
+        """Wait for a queued change, compacting in the background when the journal has grown too long.
+
+        Called after releasing _lock, so batched durability groups concurrent writers.
+        """
+        self.flusher.wait_for(sequence)
+        if self.journal.needs_compaction():
+            self._schedule_compaction()
+
+    def _write_records(self, records: List[Dict]):
+        """Write a group-committed batch of records to the journal"""
+        self.journal.append_batch(records, fsync=self.durability != "async")
+
+    def iter_subscriptions(self) -> Iterator[Dict]:
+        return iter(list(self.subscriptions.values()))
+
+    def expired_user_ids(self) -> Iterable[str]:
+        return list(self.expired)
+
+    def save_subscription(self, record: Dict):
+        with self._lock:
+            sequence = self._record_change('subscription', record)
+        self._commit(sequence)
+
+    def expire_subscriptions(self, user_ids: List[str], now: float) -> List[str]:
+        with self._lock:
+            # A subscription renewed since the caller saw it due is left alone
+            expired = [
+                user_id for user_id in user_ids
+                if user_id in self.subscriptions
+                and datetime.fromisoformat(self.subscriptions[user_id]['end_date']).timestamp() <= now
+            ]
+            if not expired:
+                return expired
+            sequence = self._record_change('expired', {'user_ids': expired})
+        self._commit(sequence)
+        return expired
+
+SUBSCRIPTION_COLUMNS = ("user_id", "tier", "start_date", "end_date", "auto_renew", "transaction_id")
+
+class SQLiteSubscriptionStorage(SubscriptionStorage):
+    """SQLite (WAL mode) storage shared by several worker processes.
+
+    Every write stamps its row with the next value of a global sequence, so
+    each process catches up by reading just the rows with a higher seq than
+    it has seen. Expired subscriptions stay as rows with status 'expired'.
+    """
+
+    def __init__(self, db_file: str = "subscriptions.db", timeout: float = 30.0, durability: str = "batched"):
+        if durability not in SQLITE_SYNCHRONOUS:
+            raise ValueError(f"Unknown durability mode: {durability}")
+        self.db_file = db_file
+        self.timeout = timeout
+        self.durability = durability
+        self._local = threading.local()
+        # Highest seq this process has applied
+        self.seq = 0
+        self._refresh_lock = threading.Lock()
+
+    def _conn(self) -> sqlite3.Connection:
+        """Get this thread's connection, opening it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS[self.durability]}")
+            self._local.conn = conn
+        return conn
+
+    def load(self) -> bool:
+        """Create the table; returns False when the database is new"""
+        conn = self._conn()
+        is_new = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name='subscriptions'"
+        ).fetchone() is None
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS subscriptions (
+                user_id TEXT PRIMARY KEY,
+                seq INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                tier TEXT NOT NULL,
+                start_date TEXT NOT NULL,
+                end_date TEXT NOT NULL,
+                end_ts REAL NOT NULL,
+                auto_renew INTEGER NOT NULL,
+                transaction_id TEXT,
+                themes TEXT
+            )"""
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_seq ON subscriptions (seq)")
+        return not is_new
+
+    def compact(self):
+        """Checkpoint the write-ahead log into the main database file"""
+        self._conn().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    @staticmethod
+    def _record_from_row(row) -> Dict:
+        record = dict(zip(SUBSCRIPTION_COLUMNS, row[:len(SUBSCRIPTION_COLUMNS)]))
+        record['auto_renew'] = bool(record['auto_renew'])
+        record['themes'] = json.loads(row[-1]) if row[-1] else {}
+        return record
+
+    def _select(self, where: str, params=()) -> List[Tuple]:
+        return self._conn().execute(
+            f"SELECT {', '.join(SUBSCRIPTION_COLUMNS)}, seq, status, themes FROM subscriptions WHERE {where}",
+            params
+        ).fetchall()
+
+    def _data_version_changed(self, conn: sqlite3.Connection) -> bool:
+        """Whether another connection committed since this thread last looked (always true at first)"""
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        changed = data_version != getattr(self._local, 'data_version', None)
+        self._local.data_version = data_version
+        return changed
+
+    def iter_subscriptions(self) -> Iterator[Dict]:
+        conn = self._conn()
+        with self._refresh_lock:
+            self._data_version_changed(conn)
+            # Read the high-water mark first; rows committed in between are re-read harmlessly
+            seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM subscriptions").fetchone()[0]
+            rows = self._select("status = 'active'")
+            self.seq = max(self.seq, seq)
+        for row in rows:
+            yield self._record_from_row(row)
+
+    def expired_user_ids(self) -> Iterable[str]:
+        return [row[0] for row in self._conn().execute(
+            "SELECT user_id FROM subscriptions WHERE status = 'expired'"
+        )]
+
+    def _next_seq(self, conn: sqlite3.Connection) -> int:
+        return conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM subscriptions").fetchone()[0]
+
+    def save_subscription(self, record: Dict):
+        conn = self._conn()
+        # IMMEDIATE takes the write lock up front, so seq numbers never collide across processes
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                """INSERT OR REPLACE INTO subscriptions
+                   (user_id, seq, status, tier, start_date, end_date, end_ts, auto_renew, transaction_id, themes)
+                   VALUES (?, ?, 'active', ?, ?, ?, ?, ?, ?, ?)""",
+                (record['user_id'], self._next_seq(conn), record['tier'], record['start_date'],
+                 record['end_date'], datetime.fromisoformat(record['end_date']).timestamp(),
+                 int(record['auto_renew']),
+                 record.get('transaction_id'), json.dumps(record.get('themes') or {}))
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def expire_subscriptions(self, user_ids: List[str], now: float) -> List[str]:
+        conn = self._conn()
+        expired = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            seq = self._next_seq(conn)
+            for user_id in user_ids:
+                cursor = conn.execute(
+                    "UPDATE subscriptions SET status = 'expired', seq = ? "
+                    "WHERE user_id = ? AND status = 'active' AND end_ts <= ?",
+                    (seq, user_id, now)
+                )
+                if cursor.rowcount:
+                    expired.append(user_id)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return expired
+
+    def refresh(self) -> List[Tuple[str, Optional[Dict]]]:
+        conn = self._conn()
+        with self._refresh_lock:
+            if not self._data_version_changed(conn):
+                return []
+            rows = self._select("seq > ? ORDER BY seq", (self.seq,))
+            if rows:
+                self.seq = max(self.seq, rows[-1][len(SUBSCRIPTION_COLUMNS)])
+        return [(row[0], self._record_from_row(row) if row[-2] == 'active' else None) for row in rows]
+
+SUBSCRIPTION_BACKENDS = {
+    'json': JsonSubscriptionStorage,
+    'sqlite': SQLiteSubscriptionStorage,
+}
+
+def create_subscription_storage(backend: str = "json", db_file: Optional[str] = None,
+                                **options) -> SubscriptionStorage:
+    """Build a subscription storage backend by name ("json" or "sqlite")"""
+    if backend not in SUBSCRIPTION_BACKENDS:
+        raise ValueError(f"Unknown subscription storage backend: {backend}")
+    if db_file is None:
+        db_file = "subscriptions.db" if backend == 'sqlite' else "subscriptions.json"
+    return SUBSCRIPTION_BACKENDS[backend](db_file, **options)
@@ -1,88 +1,135 @@
 """
 User Database and Authentication System
 """
-import json
-import hashlib
+import asyncio
+import base64
+import contextvars
+import functools
+import itertools
+import logging
 import uuid
+from concurrent.futures import Executor, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Union
-from dataclasses import dataclass, asdict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 import os
+import time
+from app_logging import elapsed_ms, get_logger, log_event
+from app_metrics import timed
+from fast_json import dumps
+from password_hashing import PasswordHasher, hash_passwords
+from response_cache import ResponseCache, etag_matches
+from user_models import User, PromoCode
+from user_storage import UserStorage, create_storage
 
-@dataclass
-class User:
-    id: str
-    email: str
-    password_hash: str
-    first_name: str
-    last_name: str
-    is_premium: bool = False
-    premium_plan: Optional[str] = None
-    created_at: str = ""
-    last_login: Optional[str] = None
-    is_active: bool = True
-    role: str = "user"
-
-@dataclass
-class PromoCode:
-    code: str
-    discount_percentage: float
-    discount_amount: Optional[float] = None
-    valid_from: str = ""
-    valid_until: str = ""
-    usage_limit: Optional[int] = None
-    used_count: int = 0
-    is_active: bool = True
-    applicable_to: str = "all"  # "all", "physical", "ebook"
-    minimum_order: float = 0.0
+logger = get_logger("user_database")
+
+PROMO_CODES_CACHE_KEY = "promo_codes"
+
+def user_cache_key(email: str) -> str:
+    """Response cache key for one user's public info"""
+    return f"user:{email.lower().strip()}"
 
 class UserDatabase:
-    def __init__(self, db_file: str = "users.json"):
-        self.db_file = db_file
-        self.users: Dict[str, User] = {}
-        self.promo_codes: Dict[str, PromoCode] = {}
+    def __init__(self, db_file: Optional[str] = None, backend: str = "json",
+                 storage: Optional[UserStorage] = None,
+                 password_hasher: Optional[PasswordHasher] = None, **storage_options):
+        self.storage = storage or create_storage(backend, db_file, **storage_options)
+        self.hasher = password_hasher or PasswordHasher()
+        self.db_file = self.storage.db_file
+        self.response_cache = ResponseCache()
+        self.storage.on_external_change = self._on_external_change
         self.load_database()
-        self.create_demo_admin()
-        self.initialize_promo_codes()
+        self.promo_counter = self.storage.create_promo_counter()
+        # Other worker processes may be seeding the same files
+        with self.storage.locked():
+            self.create_demo_admin()
+            self.initialize_promo_codes()
+
+    @property
+    def users(self):
+        """Mapping of email -> User"""
+        return self.storage.users
+
+    @property
+    def promo_codes(self):
+        """Mapping of code -> PromoCode"""
+        return self.storage.promo_codes
 
     def load_database(self):
-        """Load users from JSON file"""
+        """Load users from the configured storage backend"""
         try:
-            if os.path.exists(self.db_file):
-                with open(self.db_file, 'r') as f:
-                    data = json.load(f)
-                    for user_data in data.get('users', []):
-                        user = User(**user_data)
-                        self.users[user.email.lower()] = user
-                    
-                    for promo_data in data.get('promo_codes', []):
-                        promo = PromoCode(**promo_data)
-                        self.promo_codes[promo.code.upper()] = promo
-            else:
+            if not self.storage.load():
                 # Initialize empty database
                 self.save_database()
         except Exception as e:
-            print(f"Error loading database: {e}")
+            logger.error("Error loading database: %s", e)
             # Initialize empty database on error
             self.save_database()
 
     def save_database(self):
-        """Save users to JSON file"""
+        """Compact pending changes into the storage backend"""
         try:
-            data = {
-                'users': [asdict(user) for user in self.users.values()],
-                'promo_codes': [asdict(promo) for promo in self.promo_codes.values()]
-            }
-            with open(self.db_file, 'w') as f:
-                json.dump(data, f, indent=2)
+            self.storage.compact()
+        except Exception as e:
+            logger.error("Error saving database: %s", e)
+
+    def close(self):
+        """Flush pending writes and release the storage backend"""
+        try:
+            self.storage.close()
+            self.hasher.shutdown()
+        except Exception as e:
+            logger.error("Error closing database: %s", e)
+
+    def _on_external_change(self, op: Optional[str], key: Optional[str]):
+        """Invalidate cached responses for changes made by another process"""
+        if op == 'user':
+            self.response_cache.bump(user_cache_key(key))
+        elif op == 'promo':
+            self.response_cache.bump(PROMO_CODES_CACHE_KEY)
+        else:
+            self.response_cache.bump_all()
+
+    def cached_payload(self, key: str, build: Callable[[], Optional[Dict]],
+                       if_none_match: Optional[str] = None) -> Tuple[Optional[str], Optional[bytes]]:
+        """Serve a cacheable read as (etag, JSON body).
+
+        Returns (etag, None) when the client's If-None-Match is still
+        current, without building anything, and (None, None) when build()
+        finds nothing to return.
+        """
+        self.storage.refresh()
+        etag = self.response_cache.etag(key)
+        if etag_matches(if_none_match, etag):
+            return etag, None
+        entry = self.response_cache.get(key)
+        if entry is not None:
+            return entry
+        payload = build()
+        if payload is None:
+            return None, None
+        body = dumps(payload)
+        return self.response_cache.put(key, etag, body)
+
+    def _save_user(self, user: User):
+        """Persist the current state of a user"""
+        try:
+            self.storage.save_user(user)
+        except Exception as e:
+            logger.error("Error saving database: %s", e)
+
+    def _save_promo(self, promo: PromoCode):
+        """Persist the current state of a promo code"""
+        try:
+            self.storage.save_promo(promo)
         except Exception as e:
-            print(f"Error saving database: {e}")
+            logger.error("Error saving database: %s", e)
 
     def create_demo_admin(self):
         """Create demo admin user if it doesn't exist"""
         demo_email = "demo@bookhaven.com"
         
-        if demo_email not in self.users:
+        if self.storage.get_user(demo_email) is None:
             demo_user = User(
                 id="demo-admin-001",
                 email=demo_email,
@@ -94,18 +141,13 @@ class UserDatabase:
                 created_at=datetime.now().isoformat(),
                 role="admin"
             )
-            self.users[demo_email] = demo_user
-            self.save_database()
+            self._save_user(demo_user)
             
-            print(f"=== DEMO ADMIN CREATED ===")
-            print(f"Email: {demo_email}")
-            print(f"Password: demo123")
-            print(f"Role: admin")
-            print(f"=== END DEMO ADMIN ===")
+            log_event(logger, "demo_admin_created", email=demo_email, password="demo123", role="admin")
 
     def initialize_promo_codes(self):
         """Initialize promotional codes"""
-        if not self.promo_codes:
+        if next(self.storage.iter_promos(), None) is None:
             # DRSHIMA code - 100% discount
             drshima_code = PromoCode(
                 code="DRSHIMA",
@@ -117,7 +159,6 @@ class UserDatabase:
                 applicable_to="all",
                 minimum_order=0.0
             )
-            self.promo_codes["DRSHIMA"] = drshima_code
 
             # Additional promo codes
             welcome_code = PromoCode(
@@ -130,7 +171,6 @@ class UserDatabase:
                 applicable_to="all",
                 minimum_order=25.0
             )
-            self.promo_codes["WELCOME10"] = welcome_code
 
             student_code = PromoCode(
                 code="STUDENT20",
@@ -142,290 +182,625 @@ class UserDatabase:
                 applicable_to="all",
                 minimum_order=15.0
             )
-            self.promo_codes["STUDENT20"] = student_code
 
-            self.save_database()
+            for promo in (drshima_code, welcome_code, student_code):
+                self._save_promo(promo)
 
     def hash_password(self, password: str) -> str:
-        """Hash password using SHA-256"""
-        return hashlib.sha256(password.encode()).hexdigest()
+        """Hash password using salted scrypt"""
+        return self.hasher.hash(password)
 
     def verify_password(self, password: str, password_hash: str) -> bool:
         """Verify password against hash"""
-        return self.hash_password(password) == password_hash
+        return self.hasher.verify(password, password_hash)
+
+    def _check_registration(self, email: str, password: Optional[str]) -> Optional[Dict]:
+        """Validate registration input, returning an error response if invalid"""
+        # Prevent registration with demo admin email
+        if email == "demo@bookhaven.com":
+            return {
+                "success": False,
+                "error": "This email address is reserved for administrative purposes"
+            }
+
+        # Check if user already exists
+        if self.storage.get_user(email) is not None:
+            return {
+                "success": False,
+                "error": "User with this email already exists"
+            }
+
+        # Validate email format
+        if "@" not in email or "." not in email:
+            return {
+                "success": False,
+                "error": "Invalid email format"
+            }
+
+        # Validate password strength (imports may carry a hash instead)
+        if password is not None and len(password) < 6:
+            return {
+                "success": False,
+                "error": "Password must be at least 6 characters long"
+            }
+
+        return None
+
+    def _create_user(self, email: str, password_hash: str, first_name: str, last_name: str,
+                     started: float) -> Dict:
+        """Store a validated registration"""
+        user = User(
+            id=str(uuid.uuid4()),
+            email=email,
+            password_hash=password_hash,
+            first_name=first_name.strip(),
+            last_name=last_name.strip(),
+            created_at=datetime.now().isoformat()
+        )
+
+        # add_user re-checks atomically, in case the same email registered
+        # (here or in another worker) while the password was hashing
+        if not self.storage.add_user(user):
+            return {
+                "success": False,
+                "error": "User with this email already exists"
+            }
+        self.response_cache.bump(user_cache_key(email))
+
+        log_event(logger, "user_registered", email=email, user_id=user.id, duration_ms=elapsed_ms(started))
+
+        return {
+            "success": True,
+            "user_id": user.id,
+            "user": user.public_dict(),
+            "message": "User registered successfully"
+        }
 
     def register_user(self, email: str, password: str, first_name: str, last_name: str) -> Dict:
         """Register a new user"""
+        started = time.perf_counter()
         try:
             email = email.lower().strip()
-            
-            # Prevent registration with demo admin email
-            if email == "demo@bookhaven.com":
-                return {
-                    "success": False,
-                    "error": "This email address is reserved for administrative purposes"
-                }
-            
-            # Check if user already exists
-            if email in self.users:
-                return {
-                    "success": False,
-                    "error": "User with this email already exists"
-                }
 
-            # Validate email format
-            if "@" not in email or "." not in email:
-                return {
-                    "success": False,
-                    "error": "Invalid email format"
-                }
+            error = self._check_registration(email, password)
+            if error:
+                return error
 
-            # Validate password strength
-            if len(password) < 6:
-                return {
-                    "success": False,
-                    "error": "Password must be at least 6 characters long"
-                }
+            return self._create_user(email, self.hash_password(password), first_name, last_name, started)
 
-            # Create new user
-            user = User(
-                id=str(uuid.uuid4()),
-                email=email,
-                password_hash=self.hash_password(password),
-                first_name=first_name.strip(),
-                last_name=last_name.strip(),
-                created_at=datetime.now().isoformat()
-            )
+        except Exception as e:
+            logger.error("Registration error: %s", e)
+            return {
+                "success": False,
+                "error": f"Registration failed: {str(e)}"
+            }
 
-            self.users[email] = user
-            self.save_database()
+    @staticmethod
+    async def _call(executor: Optional[Executor], fn, *args):
+        """Run a storage step inline, or on executor when one is given"""
+        if executor is None:
+            return fn(*args)
+        # Carry the request's context (request_id for log events) onto the worker thread
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(context.run, fn, *args))
+
+    async def register_user_async(self, email: str, password: str, first_name: str, last_name: str,
+                                  executor: Optional[Executor] = None) -> Dict:
+        """Register a new user, hashing the password on the hasher's worker pool"""
+        started = time.perf_counter()
+        try:
+            email = email.lower().strip()
 
-            print(f"=== USER REGISTERED ===")
-            print(f"Email: {email}")
-            print(f"Name: {first_name} {last_name}")
-            print(f"User ID: {user.id}")
-            print(f"=== END REGISTRATION ===")
+            error = await self._call(executor, self._check_registration, email, password)
+            if error:
+                return error
 
-            return {
-                "success": True,
-                "user_id": user.id,
-                "user": {
-                    "id": user.id,
-                    "email": user.email,
-                    "first_name": user.first_name,
-                    "last_name": user.last_name,
-                    "is_premium": user.is_premium,
-                    "premium_plan": user.premium_plan,
-                    "role": user.role
-                },
-                "message": "User registered successfully"
-            }
+            password_hash = await self.hasher.hash_async(password)
+            return await self._call(executor, self._create_user, email, password_hash, first_name, last_name, started)
 
         except Exception as e:
-            print(f"Registration error: {e}")
+            logger.error("Registration error: %s", e)
             return {
                 "success": False,
                 "error": f"Registration failed: {str(e)}"
             }
 
+    @staticmethod
+    def _parse_flag(value) -> bool:
+        """Booleans arrive as strings from CSV files"""
+        if isinstance(value, str):
+            return value.strip().lower() in ("1", "true", "yes", "y")
+        return bool(value)
+
+    def _import_row(self, row: Dict, seen: set) -> Tuple[User, Optional[str]]:
+        """Validate one import row; returns the user and the password still to hash"""
+        if isinstance(row, Exception):
+            raise ValueError(str(row))
+        if not isinstance(row, dict):
+            raise ValueError("Row is not an object")
+
+        email = (row.get("email") or "").lower().strip()
+        password = row.get("password") or None
+        password_hash = row.get("password_hash") or None
+        if not email:
+            raise ValueError("Missing email")
+        if not isinstance(password or "", str) or not isinstance(password_hash or "", str):
+            raise ValueError("password and password_hash must be strings")
+        if email in seen:
+            raise ValueError("Duplicate email in import")
+        if password is None and password_hash is None:
+            raise ValueError("Missing password or password_hash")
+        if password is None and not self.hasher.is_valid_hash(password_hash):
+            raise ValueError("Unrecognized password_hash format")
+
+        error = self._check_registration(email, password)
+        if error:
+            raise ValueError(error["error"])
+
+        seen.add(email)
+        user = User(
+            id=str(uuid.uuid4()),
+            email=email,
+            password_hash=password_hash if password is None else "",
+            first_name=(row.get("first_name") or "").strip(),
+            last_name=(row.get("last_name") or "").strip(),
+            is_premium=self._parse_flag(row.get("is_premium")),
+            premium_plan=row.get("premium_plan") or None,
+            created_at=row.get("created_at") or datetime.now().isoformat()
+        )
+        return user, password
+
+    @staticmethod
+    def _import_error(report: Dict, row_number: int, row, error: str, max_errors: int):
+        report["failed"] += 1
+        if len(report["errors"]) < max_errors:
+            email = row.get("email") if isinstance(row, dict) else None
+            report["errors"].append({"row": row_number, "email": email, "error": error})
+        else:
+            report["errors_truncated"] = True
+
+    def _import_batch(self, batch: List[Tuple[int, Dict]], executor: Executor, report: Dict,
+                      max_errors: int, chunk_size: int):
+        """Validate, hash and commit one batch of import rows"""
+        seen = set()
+        pending = []  # (row_number, row, user, password)
+        for row_number, row in batch:
+            try:
+                user, password = self._import_row(row, seen)
+            except Exception as e:
+                self._import_error(report, row_number, row, str(e), max_errors)
+                continue
+            pending.append((row_number, row, user, password))
+
+        to_hash = [entry for entry in pending if entry[3] is not None]
+        chunks = [to_hash[start:start + chunk_size] for start in range(0, len(to_hash), chunk_size)]
+        futures = [
+            executor.submit(hash_passwords, [entry[3] for entry in chunk], self.hasher.settings)
+            for chunk in chunks
+        ]
+        failed = set()
+        for chunk, future in zip(chunks, futures):
+            try:
+                for entry, password_hash in zip(chunk, future.result()):
+                    entry[2].password_hash = password_hash
+            except Exception as e:
+                for row_number, row, _, _ in chunk:
+                    failed.add(row_number)
+                    self._import_error(report, row_number, row, f"Password hashing failed: {e}", max_errors)
+
+        ready = [entry for entry in pending if entry[0] not in failed]
+        try:
+            self.storage.save_users([entry[2] for entry in ready])
+            report["imported"] += len(ready)
+            for entry in ready:
+                self.response_cache.bump(user_cache_key(entry[2].email))
+        except Exception as e:
+            for row_number, row, _, _ in ready:
+                self._import_error(report, row_number, row, f"Saving batch failed: {e}", max_errors)
+
+    def import_users(self, rows: Iterable[Dict], batch_size: int = 1000, executor: Optional[Executor] = None,
+                     max_errors: int = 1000, chunk_size: int = 32) -> Dict:
+        """Bulk-create users from row dicts, committing once per batch.
+
+        Each row needs an email and either a password or an existing
+        password_hash (scrypt or legacy SHA-256, kept so migrated users can
+        still log in); first_name, last_name, is_premium, premium_plan and
+        created_at are optional. Passwords are hashed in chunks on executor
+        (user_import.py passes a process pool), defaulting to the hasher's
+        own pool. Only one batch is held in memory at a time, and the first
+        max_errors failing rows are reported by row number.
+        """
+        executor = executor or self.hasher.executor
+        report = {"success": True, "imported": 0, "failed": 0, "errors": [], "errors_truncated": False}
+        try:
+            numbered = enumerate(rows, 1)
+            while True:
+                batch = list(itertools.islice(numbered, batch_size))
+                if not batch:
+                    break
+                self._import_batch(batch, executor, report, max_errors, chunk_size)
+        except Exception as e:
+            logger.error("Import error: %s", e)
+            report["success"] = False
+            report["error"] = f"Import failed: {str(e)}"
+
+        # Fold the imported batches into the snapshot in one go
+        self.save_database()
+
+        log_event(logger, "users_imported", imported=report["imported"], failed=report["failed"])
+
+        return report
+
+    def _find_login_user(self, email: str):
+        """Look up an active user for login, returning (user, error_response)"""
+        user = self.storage.get_user(email)
+        if user is None:
+            return None, {
+                "success": False,
+                "error": "Invalid email or password"
+            }
+
+        # Check if user is active
+        if not user.is_active:
+            return None, {
+                "success": False,
+                "error": "Account is deactivated"
+            }
+
+        return user, None
+
+    def _complete_login(self, user: User, started: float, new_password_hash: Optional[str] = None) -> Dict:
+        """Record a successful login, upgrading the stored hash if one was computed"""
+        with self.storage.locked():
+            # Apply the update to the latest copy, which another worker may have changed
+            user = self.storage.get_user(user.email) or user
+            if new_password_hash:
+                user.password_hash = new_password_hash
+
+            # Update last login
+            user.last_login = datetime.now().isoformat()
+            self._save_user(user)
+
+        log_event(logger, "user_login", email=user.email, user_id=user.id, role=user.role,
+                  is_premium=user.is_premium, rehashed=bool(new_password_hash),
+                  duration_ms=elapsed_ms(started))
+
+        return {
+            "success": True,
+            "user": user.public_dict(),
+            "message": "Login successful"
+        }
+
+    @timed("authenticate_user")
     def authenticate_user(self, email: str, password: str) -> Dict:
         """Authenticate user login"""
+        started = time.perf_counter()
         try:
-            email = email.lower().strip()
-            
-            # Check if user exists
-            if email not in self.users:
+            user, error = self._find_login_user(email.lower().strip())
+            if error:
+                return error
+
+            # Verify password
+            if not self.verify_password(password, user.password_hash):
                 return {
                     "success": False,
                     "error": "Invalid email or password"
                 }
 
-            user = self.users[email]
+            # Transparently upgrade legacy or outdated hashes
+            new_hash = None
+            if self.hasher.needs_rehash(user.password_hash):
+                new_hash = self.hash_password(password)
 
-            # Check if user is active
-            if not user.is_active:
-                return {
-                    "success": False,
-                    "error": "Account is deactivated"
-                }
+            return self._complete_login(user, started, new_hash)
+
+        except Exception as e:
+            logger.error("Authentication error: %s", e)
+            return {
+                "success": False,
+                "error": f"Authentication failed: {str(e)}"
+            }
+
+    @timed("authenticate_user")
+    async def authenticate_user_async(self, email: str, password: str,
+                                      executor: Optional[Executor] = None) -> Dict:
+        """Authenticate user login, running the KDF on the hasher's worker pool"""
+        started = time.perf_counter()
+        try:
+            user, error = await self._call(executor, self._find_login_user, email.lower().strip())
+            if error:
+                return error
 
             # Verify password
-            if not self.verify_password(password, user.password_hash):
+            if not await self.hasher.verify_async(password, user.password_hash):
                 return {
                     "success": False,
                     "error": "Invalid email or password"
                 }
 
-            # Update last login
-            user.last_login = datetime.now().isoformat()
-            self.save_database()
+            # Transparently upgrade legacy or outdated hashes
+            new_hash = None
+            if self.hasher.needs_rehash(user.password_hash):
+                new_hash = await self.hasher.hash_async(password)
 
-            print(f"=== USER LOGIN ===")
-            print(f"Email: {email}")
-            print(f"Name: {user.first_name} {user.last_name}")
-            print(f"Role: {user.role}")
-            print(f"Premium: {user.is_premium}")
-            print(f"=== END LOGIN ===")
-
-            return {
-                "success": True,
-                "user": {
-                    "id": user.id,
-                    "email": user.email,
-                    "first_name": user.first_name,
-                    "last_name": user.last_name,
-                    "is_premium": user.is_premium,
-                    "premium_plan": user.premium_plan,
-                    "role": user.role
-                },
-                "message": "Login successful"
-            }
+            return await self._call(executor, self._complete_login, user, started, new_hash)
 
         except Exception as e:
-            print(f"Authentication error: {e}")
+            logger.error("Authentication error: %s", e)
             return {
                 "success": False,
                 "error": f"Authentication failed: {str(e)}"
             }
 
+    @timed("validate_promo_code")
     def validate_promo_code(self, code: str, order_total: float, cart_items: List = None) -> Dict:
         """Validate and apply promotional code"""
+        started = time.perf_counter()
         try:
             code = code.upper().strip()
             
-            if code not in self.promo_codes:
-                return {
+            rule = self.storage.get_promo_rule(code)
+            if rule is None:
+                result = {
                     "success": False,
                     "error": "Invalid promotional code"
                 }
+            else:
+                result = rule.check(order_total, cart_items)
 
-            promo = self.promo_codes[code]
+            log_event(logger, "promo_validated", level=logging.DEBUG, code=code, success=result["success"],
+                      order_total=order_total, duration_ms=elapsed_ms(started))
+            return result
 
-            # Check if code is active
-            if not promo.is_active:
-                return {
-                    "success": False,
-                    "error": "This promotional code is no longer active"
-                }
-
-            # Check validity dates
-            now = datetime.now()
-            if promo.valid_from and datetime.fromisoformat(promo.valid_from) > now:
-                return {
-                    "success": False,
-                    "error": "This promotional code is not yet valid"
-                }
+        except Exception as e:
+            logger.error("Promo code validation error: %s", e)
+            return {
+                "success": False,
+                "error": f"Error validating promotional code: {str(e)}"
+            }
 
-            if promo.valid_until and datetime.fromisoformat(promo.valid_until) < now:
-                return {
-                    "success": False,
-                    "error": "This promotional code has expired"
-                }
+    def reserve_promo_code(self, code: str, order_total: float, cart_items: List = None) -> Dict:
+        """Validate a promotional code and hold one use of it for this checkout"""
+        result = self.validate_promo_code(code, order_total, cart_items)
+        if not result["success"]:
+            return result
 
-            # Check usage limit
-            if promo.usage_limit and promo.used_count >= promo.usage_limit:
+        try:
+            reservation_id, expires_at = self.promo_counter.reserve(result["code"])
+            if reservation_id is None:
                 return {
                     "success": False,
                     "error": "This promotional code has reached its usage limit"
                 }
 
-            # Check minimum order amount
-            if order_total < promo.minimum_order:
-                return {
-                    "success": False,
-                    "error": f"Minimum order amount of ${promo.minimum_order:.2f} required for this code"
-                }
-
-            # Calculate discount
-            if promo.discount_amount:
-                discount = min(promo.discount_amount, order_total)
-            else:
-                discount = order_total * (promo.discount_percentage / 100)
-
-            # Ensure discount doesn't exceed order total
-            discount = min(discount, order_total)
-
-            print(f"=== PROMO CODE APPLIED ===")
-            print(f"Code: {code}")
-            print(f"Discount: {promo.discount_percentage}%")
-            print(f"Order Total: ${order_total:.2f}")
-            print(f"Discount Amount: ${discount:.2f}")
-            print(f"=== END PROMO ===")
-
-            return {
-                "success": True,
-                "code": code,
-                "discount_percentage": promo.discount_percentage,
-                "discount_amount": discount,
-                "final_total": max(0, order_total - discount),
-                "message": f"Promotional code applied! {promo.discount_percentage}% discount"
-            }
-
+            result["reservation_id"] = reservation_id
+            result["reservation_expires_at"] = expires_at
+            return result
         except Exception as e:
-            print(f"Promo code validation error: {e}")
+            logger.error("Error reserving promo code: %s", e)
             return {
                 "success": False,
-                "error": f"Error validating promotional code: {str(e)}"
+                "error": f"Error reserving promotional code: {str(e)}"
             }
 
+    def commit_promo_reservation(self, reservation_id: str) -> bool:
+        """Record the use held by a reservation once the order is placed"""
+        try:
+            committed = self.promo_counter.commit(reservation_id)
+            if committed:
+                self.response_cache.bump(PROMO_CODES_CACHE_KEY)
+            return committed
+        except Exception as e:
+            logger.error("Error committing promo reservation: %s", e)
+            return False
+
+    def release_promo_reservation(self, reservation_id: str) -> bool:
+        """Give back the use held by a reservation when checkout is abandoned"""
+        try:
+            return self.promo_counter.release(reservation_id)
+        except Exception as e:
+            logger.error("Error releasing promo reservation: %s", e)
+            return False
+
     def use_promo_code(self, code: str) -> bool:
         """Mark promo code as used"""
         try:
             code = code.upper().strip()
-            if code in self.promo_codes:
-                self.promo_codes[code].used_count += 1
-                self.save_database()
-                return True
-            return False
+            reservation_id, _ = self.promo_counter.reserve(code)
+            if reservation_id is None:
+                return False
+            return self.commit_promo_reservation(reservation_id)
         except Exception as e:
-            print(f"Error using promo code: {e}")
+            logger.error("Error using promo code: %s", e)
             return False
 
     def get_user_by_email(self, email: str) -> Optional[User]:
         """Get user by email"""
-        return self.users.get(email.lower().strip())
+        return self.storage.get_user(email.lower().strip())
 
     def get_user_by_id(self, user_id: str) -> Optional[User]:
         """Get user by ID"""
-        for user in self.users.values():
-            if user.id == user_id:
-                return user
-        return None
+        return self.storage.get_user_by_id(user_id)
 
     def update_user_premium_status(self, email: str, is_premium: bool, plan: str = None) -> bool:
         """Update user's premium status"""
         try:
             email = email.lower().strip()
-            if email in self.users:
-                self.users[email].is_premium = is_premium
-                if plan:
-                    self.users[email].premium_plan = plan
-                self.save_database()
-                return True
+            with self.storage.locked():
+                user = self.storage.get_user(email)
+                if user is not None:
+                    user.is_premium = is_premium
+                    if plan:
+                        user.premium_plan = plan
+                    self._save_user(user)
+                    self.response_cache.bump(user_cache_key(email))
+                    return True
             return False
         except Exception as e:
-            print(f"Error updating premium status: {e}")
+            logger.error("Error updating premium status: %s", e)
             return False
 
-    def list_all_users(self) -> List[Dict]:
-        """List all users (for admin purposes)"""
+    def find_users(self, role: Optional[str] = None, is_premium: Optional[bool] = None,
+                   premium_plan: Optional[str] = None) -> List[User]:
+        """Find users by role, premium flag and/or plan using the storage indexes"""
+        return list(self.storage.find_users(role, is_premium, premium_plan))
+
+    @staticmethod
+    def _user_summary(user: User) -> Dict:
+        """Public fields of a user for admin listings"""
+        return {
+            "id": user.id,
+            "email": user.email,
+            "first_name": user.first_name,
+            "last_name": user.last_name,
+            "is_premium": user.is_premium,
+            "premium_plan": user.premium_plan,
+            "created_at": user.created_at,
+            "last_login": user.last_login,
+            "role": user.role
+        }
+
+    def list_all_users(self, role: Optional[str] = None, is_premium: Optional[bool] = None,
+                       premium_plan: Optional[str] = None) -> List[Dict]:
+        """List all users (for admin purposes), optionally filtered"""
         return [
-            {
-                "id": user.id,
-                "email": user.email,
-                "first_name": user.first_name,
-                "last_name": user.last_name,
-                "is_premium": user.is_premium,
-                "premium_plan": user.premium_plan,
-                "created_at": user.created_at,
-                "last_login": user.last_login,
-                "role": user.role
-            }
-            for user in self.users.values()
+            self._user_summary(user)
+            for user in self.storage.find_users(role, is_premium, premium_plan)
         ]
 
+    @staticmethod
+    def encode_cursor(email: str) -> str:
+        """Opaque pagination cursor pointing just past a user"""
+        return base64.urlsafe_b64encode(email.encode()).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor: Optional[str]) -> Optional[str]:
+        if not cursor:
+            return None
+        try:
+            return base64.b64decode(cursor.encode('ascii'), altchars=b'-_', validate=True).decode()
+        except (ValueError, UnicodeError):
+            raise ValueError("Invalid cursor")
+
+    def iter_users(self, cursor: Optional[str] = None, role: Optional[str] = None,
+                   is_premium: Optional[bool] = None, premium_plan: Optional[str] = None,
+                   created_from: Optional[str] = None, created_to: Optional[str] = None) -> Iterator[Dict]:
+        """Stream user summaries in email order, starting after a cursor.
+
+        The cursor is decoded before this returns, so a bad one raises
+        ValueError here rather than once a streamed response has started.
+        """
+        users = self.storage.iter_users_after(
+            self.decode_cursor(cursor), role, is_premium, premium_plan, created_from, created_to
+        )
+        return (self._user_summary(user) for user in users)
+
+    def list_users_page(self, limit: int = 100, cursor: Optional[str] = None, role: Optional[str] = None,
+                        is_premium: Optional[bool] = None, premium_plan: Optional[str] = None,
+                        created_from: Optional[str] = None, created_to: Optional[str] = None) -> Dict:
+        """One page of users plus the cursor for the next page (None on the last page)"""
+        users = self.iter_users(cursor, role, is_premium, premium_plan, created_from, created_to)
+        # Fetch one extra user to know whether another page exists
+        page = list(itertools.islice(users, limit + 1))
+        has_more = len(page) > limit
+        page = page[:limit]
+        return {
+            "users": page,
+            "next_cursor": self.encode_cursor(page[-1]["email"]) if has_more else None
+        }
+
+    def list_promo_codes(self) -> List[PromoCode]:
+        """List all promo codes"""
+        return list(self.storage.iter_promos())
+
+class AsyncUserDatabase:
+    """Awaitable facade over UserDatabase for the async API handlers.
+
+    Storage work (journal writes, file locks, SQLite queries) runs on a
+    bounded thread pool so the event loop never waits on disk, while
+    password hashing keeps to the hasher's own pool; a burst of logins
+    therefore cannot take every thread that lookups and promo checks need.
+    """
+
+    def __init__(self, db: UserDatabase, max_workers: int = 8):
+        self.db = db
+        self.max_workers = max_workers
+        self._executor = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="user-db")
+        return self._executor
+
+    async def _run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self.executor, functools.partial(context.run, fn, *args, **kwargs))
+
+    async def register_user(self, email: str, password: str, first_name: str, last_name: str) -> Dict:
+        return await self.db.register_user_async(email, password, first_name, last_name, executor=self.executor)
+
+    async def authenticate_user(self, email: str, password: str) -> Dict:
+        return await self.db.authenticate_user_async(email, password, executor=self.executor)
+
+    async def cached_payload(self, key: str, build: Callable[[], Optional[Dict]],
+                             if_none_match: Optional[str] = None) -> Tuple[Optional[str], Optional[bytes]]:
+        return await self._run(self.db.cached_payload, key, build, if_none_match)
+
+    async def get_user_by_email(self, email: str) -> Optional[User]:
+        return await self._run(self.db.get_user_by_email, email)
+
+    async def validate_promo_code(self, code: str, order_total: float, cart_items: List = None) -> Dict:
+        return await self._run(self.db.validate_promo_code, code, order_total, cart_items)
+
+    async def reserve_promo_code(self, code: str, order_total: float, cart_items: List = None) -> Dict:
+        return await self._run(self.db.reserve_promo_code, code, order_total, cart_items)
+
+    async def commit_promo_reservation(self, reservation_id: str) -> bool:
+        return await self._run(self.db.commit_promo_reservation, reservation_id)
+
+    async def release_promo_reservation(self, reservation_id: str) -> bool:
+        return await self._run(self.db.release_promo_reservation, reservation_id)
+
+    async def use_promo_code(self, code: str) -> bool:
+        return await self._run(self.db.use_promo_code, code)
+
+    async def list_promo_codes(self) -> List[PromoCode]:
+        return await self._run(self.db.list_promo_codes)
+
+    async def update_user_premium_status(self, email: str, is_premium: bool, plan: str = None) -> bool:
+        return await self._run(self.db.update_user_premium_status, email, is_premium, plan)
+
+    async def list_users_page(self, *args, **kwargs) -> Dict:
+        return await self._run(self.db.list_users_page, *args, **kwargs)
+
+    async def import_users(self, *args, **kwargs) -> Dict:
+        return await self._run(self.db.import_users, *args, **kwargs)
+
+    async def close(self):
+        """Finish in-flight storage calls, then close the database"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self.db.close()
+
 # Global database instance
-user_db = UserDatabase()
+_backend = os.environ.get("BOOKHAVEN_USER_DB_BACKEND", "json")
+# "batched" fsyncs before a write returns; "async" (may lose the last writes on a crash) is opt-in
+_storage_options = {"durability": os.environ.get("BOOKHAVEN_USER_DB_DURABILITY", "batched")}
+if _backend == "json":
+    _storage_options["snapshot_format"] = os.environ.get("BOOKHAVEN_USER_DB_SNAPSHOT", "json")
+    # Set when several worker processes (uvicorn --workers N) share the files
+    _storage_options["shared"] = os.environ.get("BOOKHAVEN_USER_DB_SHARED", "") in ("1", "true", "yes")
+
+user_db = UserDatabase(
+    os.environ.get("BOOKHAVEN_USER_DB_FILE"),
+    backend=_backend,
+    password_hasher=PasswordHasher.from_env(),
+    **_storage_options
+)
+async_user_db = AsyncUserDatabase(user_db, max_workers=int(os.environ.get("BOOKHAVEN_DB_POOL_SIZE", 8)))
 
 # Example usage and testing
 if __name__ == "__main__":
@@ -0,0 +1,77 @@
+"""
+User Import - Stream users from CSV or NDJSON files into UserDatabase
+
+Usage:
+    python user_import.py <users.csv|users.ndjson> [--format csv|ndjson] [--batch-size 1000] [--workers 4]
+
+The target database is the one configured through the BOOKHAVEN_USER_DB_*
+environment variables, exactly as the API servers see it.
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, TextIO, Union
+
+IMPORT_FORMATS = ("csv", "ndjson")
+
+def detect_format(filename: str) -> str:
+    """Guess the import format from a file name, defaulting to NDJSON"""
+    return "csv" if filename.lower().endswith(".csv") else "ndjson"
+
+def read_csv(f: TextIO) -> Iterator[Dict]:
+    """Rows of a CSV file with a header line"""
+    for row in csv.DictReader(f):
+        yield row
+
+def read_ndjson(f: TextIO) -> Iterator[Union[Dict, Exception]]:
+    """One JSON object per line; malformed lines come through as their error"""
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield ValueError(f"Invalid JSON: {e}")
+
+def read_rows(f: TextIO, fmt: str) -> Iterator[Union[Dict, Exception]]:
+    """Stream import rows from an open text file"""
+    if fmt not in IMPORT_FORMATS:
+        raise ValueError(f"Unknown import format: {fmt}")
+    return read_csv(f) if fmt == "csv" else read_ndjson(f)
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import users into BookHaven")
+    parser.add_argument("path", help="CSV or NDJSON file to import")
+    parser.add_argument("--format", choices=IMPORT_FORMATS, help="defaults to the file extension")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="password hashing processes")
+    parser.add_argument("--max-errors", type=int, default=1000)
+    args = parser.parse_args()
+
+    from user_database import user_db
+
+    fmt = args.format or detect_format(args.path)
+    # Spawned workers only import password_hashing, never the database
+    context = multiprocessing.get_context("spawn")
+    with open(args.path, newline='', encoding='utf-8') as f, \
+            ProcessPoolExecutor(max_workers=args.workers, mp_context=context) as executor:
+        report = user_db.import_users(read_rows(f, fmt), batch_size=args.batch_size,
+                                      executor=executor, max_errors=args.max_errors)
+    user_db.close()
+
+    for error in report["errors"]:
+        print(f"Row {error['row']} ({error['email']}): {error['error']}")
+    if report["errors_truncated"]:
+        print(f"... only the first {args.max_errors} errors are shown")
+    if not report["success"]:
+        print(report["error"])
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
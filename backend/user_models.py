@@ -0,0 +1,187 @@
+"""
+User and Promo Code Models
+
+Both records use __slots__ instead of a per-instance __dict__, intern their
+low-cardinality strings (role, plan, applicable_to) and keep timestamps as
+integer microseconds since the epoch. Timestamp fields are still read and
+written as ISO strings, and to_dict() produces the same JSON as before, so
+callers and stored files are unaffected.
+"""
+import sys
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Union
+
+EPOCH = datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+def _is_canonical(value: str) -> bool:
+    """Whether datetime.isoformat() would print this exact naive timestamp back"""
+    if len(value) == 19:
+        return value[10] == "T"
+    if len(value) == 26:
+        return value[10] == "T" and value[19] == "." and not value.endswith(".000000")
+    return False
+
+def to_epoch_us(value: Optional[str]) -> Union[int, str, None]:
+    """Pack a naive ISO timestamp into epoch microseconds.
+
+    Values that would not come back byte-for-byte (timezone offsets, other
+    formats) are kept as the original string.
+    """
+    if not value:
+        return None
+    if not _is_canonical(value):
+        return value
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        return value
+    seconds = (moment.toordinal() - EPOCH_ORDINAL) * 86400 + \
+        moment.hour * 3600 + moment.minute * 60 + moment.second
+    return seconds * 1000000 + moment.microsecond
+
+def from_epoch_us(value: Union[int, str, None]) -> Optional[str]:
+    """Unpack a timestamp stored by to_epoch_us back into ISO format"""
+    if value is None or isinstance(value, str):
+        return value
+    return (EPOCH + timedelta(microseconds=value)).isoformat()
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    return sys.intern(value) if isinstance(value, str) else value
+
+class User:
+    __slots__ = ("id", "email", "password_hash", "first_name", "last_name", "is_premium",
+                 "_premium_plan", "_created_at", "_last_login", "is_active", "_role")
+
+    FIELDS = ("id", "email", "password_hash", "first_name", "last_name", "is_premium",
+              "premium_plan", "created_at", "last_login", "is_active", "role")
+
+    def __init__(self, id: str, email: str, password_hash: str, first_name: str, last_name: str,
+                 is_premium: bool = False, premium_plan: Optional[str] = None, created_at: str = "",
+                 last_login: Optional[str] = None, is_active: bool = True, role: str = "user"):
+        self.id = id
+        self.email = email
+        self.password_hash = password_hash
+        self.first_name = first_name
+        self.last_name = last_name
+        self.is_premium = is_premium
+        self.premium_plan = premium_plan
+        self.created_at = created_at
+        self.last_login = last_login
+        self.is_active = is_active
+        self.role = role
+
+    @property
+    def premium_plan(self) -> Optional[str]:
+        return self._premium_plan
+
+    @premium_plan.setter
+    def premium_plan(self, value: Optional[str]):
+        self._premium_plan = _intern(value)
+
+    @property
+    def role(self) -> str:
+        return self._role
+
+    @role.setter
+    def role(self, value: str):
+        self._role = _intern(value)
+
+    @property
+    def created_at(self) -> str:
+        return from_epoch_us(self._created_at) or ""
+
+    @created_at.setter
+    def created_at(self, value: str):
+        self._created_at = to_epoch_us(value)
+
+    @property
+    def last_login(self) -> Optional[str]:
+        return from_epoch_us(self._last_login)
+
+    @last_login.setter
+    def last_login(self, value: Optional[str]):
+        self._last_login = to_epoch_us(value)
+
+    def to_dict(self) -> Dict:
+        """Field dict in the same shape dataclasses.asdict used to produce"""
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    def public_dict(self) -> Dict:
+        """The fields API responses may show; never includes the password hash"""
+        return {
+            "id": self.id,
+            "email": self.email,
+            "first_name": self.first_name,
+            "last_name": self.last_name,
+            "is_premium": self.is_premium,
+            "premium_plan": self.premium_plan,
+            "role": self.role
+        }
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, User):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    def __repr__(self) -> str:
+        return f"User({', '.join(f'{name}={getattr(self, name)!r}' for name in self.FIELDS)})"
+
+class PromoCode:
+    __slots__ = ("code", "discount_percentage", "discount_amount", "_valid_from", "_valid_until",
+                 "usage_limit", "used_count", "is_active", "_applicable_to", "minimum_order")
+
+    FIELDS = ("code", "discount_percentage", "discount_amount", "valid_from", "valid_until",
+              "usage_limit", "used_count", "is_active", "applicable_to", "minimum_order")
+
+    def __init__(self, code: str, discount_percentage: float, discount_amount: Optional[float] = None,
+                 valid_from: str = "", valid_until: str = "", usage_limit: Optional[int] = None,
+                 used_count: int = 0, is_active: bool = True,
+                 applicable_to: str = "all",  # "all", "physical", "ebook"
+                 minimum_order: float = 0.0):
+        self.code = code
+        self.discount_percentage = discount_percentage
+        self.discount_amount = discount_amount
+        self.valid_from = valid_from
+        self.valid_until = valid_until
+        self.usage_limit = usage_limit
+        self.used_count = used_count
+        self.is_active = is_active
+        self.applicable_to = applicable_to
+        self.minimum_order = minimum_order
+
+    @property
+    def valid_from(self) -> str:
+        return from_epoch_us(self._valid_from) or ""
+
+    @valid_from.setter
+    def valid_from(self, value: str):
+        self._valid_from = to_epoch_us(value)
+
+    @property
+    def valid_until(self) -> str:
+        return from_epoch_us(self._valid_until) or ""
+
+    @valid_until.setter
+    def valid_until(self, value: str):
+        self._valid_until = to_epoch_us(value)
+
+    @property
+    def applicable_to(self) -> str:
+        return self._applicable_to
+
+    @applicable_to.setter
+    def applicable_to(self, value: str):
+        self._applicable_to = _intern(value)
+
+    def to_dict(self) -> Dict:
+        """Field dict in the same shape dataclasses.asdict used to produce"""
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, PromoCode):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    def __repr__(self) -> str:
+        return f"PromoCode({', '.join(f'{name}={getattr(self, name)!r}' for name in self.FIELDS)})"
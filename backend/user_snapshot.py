@@ -0,0 +1,174 @@
+"""
+Binary User Snapshot - Memory-mapped user records with email and id indexes
+
+File layout (all integers little-endian):
+
+    header   magic "BHUS", version, user_count, email_index_offset,
+             id_index_offset, promo_offset, promo_length
+    records  user_count x (u32 length + compact JSON user record)
+    indexes  for emails, then ids: user_count x u64 slot pointers sorted by
+             key, each pointing at an entry (u16 key length + key + u64
+             record offset)
+    promos   one JSON array with every promo code
+
+Opening a snapshot only reads the header, so startup cost does not depend on
+how many users it holds; User objects are built when a record is looked up.
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from user_models import User, PromoCode
+
+MAGIC = b"BHUS"
+VERSION = 1
+HEADER = struct.Struct("<4sHxxQQQQQ")
+LENGTH = struct.Struct("<I")
+OFFSET = struct.Struct("<Q")
+KEY_LENGTH = struct.Struct("<H")
+
+class BinaryUserSnapshot:
+    """Read-only, lazily decoded view of a binary user snapshot"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.user_count, self._email_index, self._id_index, \
+            promo_offset, promo_length = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a version {VERSION} user snapshot")
+        self._promo_slice = (promo_offset, promo_offset + promo_length)
+
+    def __len__(self) -> int:
+        return self.user_count
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+    def _entry(self, index_offset: int, position: int) -> Tuple[bytes, int]:
+        """Read the (key, record offset) stored at a slot of an index"""
+        entry_offset = OFFSET.unpack_from(self._mm, index_offset + position * OFFSET.size)[0]
+        key_length = KEY_LENGTH.unpack_from(self._mm, entry_offset)[0]
+        key_start = entry_offset + KEY_LENGTH.size
+        key = self._mm[key_start:key_start + key_length]
+        record_offset = OFFSET.unpack_from(self._mm, key_start + key_length)[0]
+        return key, record_offset
+
+    def _search(self, index_offset: int, key: str) -> Optional[int]:
+        """Binary search an index, returning the record offset for key"""
+        target = key.encode()
+        low, high = 0, self.user_count
+        while low < high:
+            middle = (low + high) // 2
+            found, record_offset = self._entry(index_offset, middle)
+            if found < target:
+                low = middle + 1
+            elif found > target:
+                high = middle
+            else:
+                return record_offset
+        return None
+
+    def _record(self, record_offset: int) -> User:
+        length = LENGTH.unpack_from(self._mm, record_offset)[0]
+        start = record_offset + LENGTH.size
+        return User(**json.loads(self._mm[start:start + length]))
+
+    def __contains__(self, email: str) -> bool:
+        return self._search(self._email_index, email) is not None
+
+    def get(self, email: str) -> Optional[User]:
+        """Materialize the user with this (lowercase) email"""
+        record_offset = self._search(self._email_index, email)
+        return self._record(record_offset) if record_offset is not None else None
+
+    def get_by_id(self, user_id: str) -> Optional[User]:
+        """Materialize the user with this id"""
+        record_offset = self._search(self._id_index, user_id)
+        return self._record(record_offset) if record_offset is not None else None
+
+    def _position_after(self, email: str) -> int:
+        """Index of the first email sorting after the given one"""
+        target = email.encode()
+        low, high = 0, self.user_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(self._email_index, middle)[0] <= target:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def iter_emails(self, after: Optional[str] = None) -> Iterator[str]:
+        """Iterate emails in sorted order, optionally starting after a given email"""
+        start = self._position_after(after) if after is not None else 0
+        for position in range(start, self.user_count):
+            yield self._entry(self._email_index, position)[0].decode()
+
+    def iter_users(self) -> Iterator[User]:
+        """Materialize every user, one at a time, in email order"""
+        for position in range(self.user_count):
+            yield self._record(self._entry(self._email_index, position)[1])
+
+    def promo_codes(self) -> List[PromoCode]:
+        start, end = self._promo_slice
+        return [PromoCode(**data) for data in json.loads(self._mm[start:end])]
+
+def _write_index(f, keys: List[Tuple[bytes, int]]) -> int:
+    """Write entries then their sorted slot table; returns the slot table offset"""
+    keys.sort()
+    entry_offsets = []
+    for key, record_offset in keys:
+        entry_offsets.append(f.tell())
+        f.write(KEY_LENGTH.pack(len(key)) + key + OFFSET.pack(record_offset))
+    index_offset = f.tell()
+    f.write(b"".join(OFFSET.pack(offset) for offset in entry_offsets))
+    return index_offset
+
+def write_snapshot(path: str, users: Iterable[Dict], promo_codes: Iterable[Dict]):
+    """Write a binary snapshot from user and promo code dicts"""
+    with open(path, 'wb') as f:
+        f.write(b"\0" * HEADER.size)
+
+        emails: List[Tuple[bytes, int]] = []
+        ids: List[Tuple[bytes, int]] = []
+        for user in users:
+            record_offset = f.tell()
+            payload = json.dumps(user, separators=(',', ':')).encode()
+            f.write(LENGTH.pack(len(payload)) + payload)
+            emails.append((user['email'].lower().encode(), record_offset))
+            ids.append((user['id'].encode(), record_offset))
+
+        email_index = _write_index(f, emails)
+        id_index = _write_index(f, ids)
+
+        promo_offset = f.tell()
+        promo_payload = json.dumps(list(promo_codes), separators=(',', ':')).encode()
+        f.write(promo_payload)
+
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, len(emails), email_index, id_index,
+                            promo_offset, len(promo_payload)))
+        f.flush()
+        os.fsync(f.fileno())
+
+def convert_json_database(json_path: str, snapshot_path: str) -> int:
+    """Convert an existing users.json into a binary snapshot; returns the user count"""
+    with open(json_path, 'r') as f:
+        data = json.load(f)
+    users = data.get('users', [])
+    write_snapshot(snapshot_path, users, data.get('promo_codes', []))
+    return len(users)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python user_snapshot.py <users.json> <users.snap>")
+        sys.exit(1)
+    count = convert_json_database(sys.argv[1], sys.argv[2])
+    print(f"Converted {count} users from {sys.argv[1]} to {sys.argv[2]}")
@@ -0,0 +1,1006 @@
+"""
+User Storage Backends - JSON journal and SQLite persistence for UserDatabase
+"""
+import bisect
+import heapq
+import os
+import sqlite3
+import threading
+from collections.abc import Mapping
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+from app_logging import get_logger
+from group_commit import GroupCommitFlusher
+from journal import Journal, write_json_snapshot
+from promo_counters import PromoUsageCounter, SharedPromoUsageCounter, SQLitePromoUsageCounter
+from promo_rules import CompiledPromo
+from user_models import User, PromoCode
+from user_snapshot import BinaryUserSnapshot, convert_json_database, write_snapshot
+
+logger = get_logger("user_storage")
+
+USER_COLUMNS = list(User.FIELDS)
+PROMO_COLUMNS = list(PromoCode.FIELDS)
+
+class UserStorage:
+    """Interface implemented by every UserDatabase storage backend"""
+
+    # Read-only mappings of email -> User and code -> PromoCode
+    users: Mapping
+    promo_codes: Mapping
+
+    # Called as (op, key) for each change another process made, with
+    # (None, None) when everything may have changed
+    on_external_change: Optional[Callable[[Optional[str], Optional[str]], None]] = None
+
+    def load(self):
+        """Load persisted state; returns False when the store is new"""
+        raise NotImplementedError
+
+    def compact(self):
+        """Fold pending changes into the main store"""
+        raise NotImplementedError
+
+    def close(self):
+        """Release file handles and connections"""
+
+    @contextmanager
+    def locked(self):
+        """Hold off writers in other processes for a read-modify-write sequence"""
+        yield
+
+    def refresh(self):
+        """Pick up changes made by other processes"""
+
+    def get_user(self, email: str) -> Optional[User]:
+        raise NotImplementedError
+
+    def get_user_by_id(self, user_id: str) -> Optional[User]:
+        raise NotImplementedError
+
+    def save_user(self, user: User):
+        raise NotImplementedError
+
+    def add_user(self, user: User) -> bool:
+        """Store a new user; returns False, storing nothing, if the email is taken"""
+        with self.locked():
+            if self.get_user(user.email) is not None:
+                return False
+            self.save_user(user)
+            return True
+
+    def save_users(self, users: List[User]):
+        """Persist a batch of users as a single commit"""
+        for user in users:
+            self.save_user(user)
+
+    def iter_users(self) -> Iterator[User]:
+        raise NotImplementedError
+
+    def find_users(self, role: Optional[str] = None, is_premium: Optional[bool] = None,
+                   premium_plan: Optional[str] = None) -> Iterator[User]:
+        """Iterate users matching every given filter"""
+        raise NotImplementedError
+
+    def iter_users_after(self, after_email: Optional[str] = None, role: Optional[str] = None,
+                         is_premium: Optional[bool] = None, premium_plan: Optional[str] = None,
+                         created_from: Optional[str] = None, created_to: Optional[str] = None) -> Iterator[User]:
+        """Iterate matching users in email order, starting after after_email"""
+        raise NotImplementedError
+
+    def get_promo(self, code: str) -> Optional[PromoCode]:
+        raise NotImplementedError
+
+    def save_promo(self, promo: PromoCode):
+        raise NotImplementedError
+
+    def iter_promos(self) -> Iterator[PromoCode]:
+        raise NotImplementedError
+
+    def get_promo_rule(self, code: str) -> Optional[CompiledPromo]:
+        """Compiled validator for a promo code"""
+        promo = self.get_promo(code)
+        return CompiledPromo(promo) if promo is not None else None
+
+    def create_promo_counter(self, **options) -> PromoUsageCounter:
+        """Build the usage counter that reserves and commits promo code uses"""
+        return PromoUsageCounter(self, **options)
+
+def user_matches(user: User, role: Optional[str] = None, is_premium: Optional[bool] = None,
+                 premium_plan: Optional[str] = None, created_from: Optional[str] = None,
+                 created_to: Optional[str] = None) -> bool:
+    """Check a user against listing filters; created_* are ISO timestamps"""
+    return (
+        (role is None or user.role == role)
+        and (is_premium is None or user.is_premium == is_premium)
+        and (premium_plan is None or user.premium_plan == premium_plan)
+        and (created_from is None or user.created_at >= created_from)
+        and (created_to is None or user.created_at <= created_to)
+    )
+
+class UserIndex:
+    """Secondary in-memory indexes over users: id, role, premium and plan"""
+
+    def __init__(self):
+        self.by_id: Dict[str, User] = {}
+        self.by_role: Dict[str, Set[str]] = {}
+        self.by_plan: Dict[str, Set[str]] = {}
+        self.premium: Set[str] = set()
+        # email -> (id, role, is_premium, premium_plan) as last indexed, since
+        # callers mutate User objects in place before saving them
+        self._keys: Dict[str, Tuple] = {}
+
+    def add(self, email: str, user: User):
+        """Index a user, replacing whatever was indexed for that email before"""
+        keys = (user.id, user.role, user.is_premium, user.premium_plan)
+        old_keys = self._keys.get(email)
+        if old_keys is not None:
+            if old_keys == keys:
+                self.by_id[user.id] = user
+                return
+            self.remove(email)
+
+        self._keys[email] = keys
+        self.by_id[user.id] = user
+        self.by_role.setdefault(user.role, set()).add(email)
+        if user.is_premium:
+            self.premium.add(email)
+        if user.premium_plan:
+            self.by_plan.setdefault(user.premium_plan, set()).add(email)
+
+    def remove(self, email: str):
+        """Drop a user from every index"""
+        old_keys = self._keys.pop(email, None)
+        if old_keys is None:
+            return
+        user_id, role, is_premium, plan = old_keys
+        self.by_id.pop(user_id, None)
+        self._discard(self.by_role, role, email)
+        self.premium.discard(email)
+        if plan:
+            self._discard(self.by_plan, plan, email)
+
+    @staticmethod
+    def _discard(index: Dict[str, Set[str]], key: str, email: str):
+        emails = index.get(key)
+        if emails is not None:
+            emails.discard(email)
+            if not emails:
+                del index[key]
+
+    def clear(self):
+        self.by_id.clear()
+        self.by_role.clear()
+        self.by_plan.clear()
+        self.premium.clear()
+        self._keys.clear()
+
+    def match(self, role: Optional[str] = None, is_premium: Optional[bool] = None,
+              premium_plan: Optional[str] = None) -> Optional[Set[str]]:
+        """Emails matching the given filters, or None when no filter is set"""
+        candidates = []
+        if role is not None:
+            candidates.append(self.by_role.get(role, set()))
+        if premium_plan is not None:
+            candidates.append(self.by_plan.get(premium_plan, set()))
+        if is_premium is True:
+            candidates.append(self.premium)
+
+        if not candidates:
+            if is_premium is False:
+                return set(self._keys) - self.premium
+            return None
+
+        # Intersect starting from the smallest set
+        candidates.sort(key=len)
+        emails = set(candidates[0])
+        for other in candidates[1:]:
+            emails &= other
+        if is_premium is False:
+            emails -= self.premium
+        return emails
+
+class LayeredUsers(Mapping):
+    """email -> User over a binary snapshot, with changed or accessed users kept in memory"""
+
+    def __init__(self, snapshot: Optional[BinaryUserSnapshot] = None):
+        self.snapshot = snapshot
+        self.overlay: Dict[str, User] = {}
+        self._new_emails: Set[str] = set()  # overlay emails missing from the snapshot
+
+    def reset(self, snapshot: BinaryUserSnapshot):
+        """Switch to a newer snapshot that already contains every overlay user"""
+        self.snapshot = snapshot
+        self._new_emails = {email for email in self._new_emails if email not in snapshot}
+
+    def _peek(self, email: str) -> Optional[User]:
+        """Look a user up without caching the materialized record"""
+        user = self.overlay.get(email)
+        if user is None and self.snapshot is not None:
+            user = self.snapshot.get(email)
+        return user
+
+    def __getitem__(self, email: str) -> User:
+        user = self.overlay.get(email)
+        if user is None:
+            user = self.snapshot.get(email) if self.snapshot is not None else None
+            if user is None:
+                raise KeyError(email)
+            self.overlay[email] = user
+        return user
+
+    def __setitem__(self, email: str, user: User):
+        if email not in self.overlay and (self.snapshot is None or email not in self.snapshot):
+            self._new_emails.add(email)
+        self.overlay[email] = user
+
+    def __contains__(self, email) -> bool:
+        return email in self.overlay or (self.snapshot is not None and email in self.snapshot)
+
+    def __iter__(self) -> Iterator[str]:
+        if self.snapshot is None:
+            return iter(list(self.overlay))
+        return self.iter_emails()
+
+    def __len__(self) -> int:
+        return (len(self.snapshot) if self.snapshot is not None else 0) + len(self._new_emails)
+
+    def iter_emails(self, after: Optional[str] = None) -> Iterator[str]:
+        """Iterate emails in sorted order, optionally starting after a given email"""
+        new_emails = sorted(email for email in self._new_emails if after is None or email > after)
+        if self.snapshot is None:
+            return iter(new_emails)
+        return heapq.merge(self.snapshot.iter_emails(after), new_emails)
+
+    def values(self) -> Iterator[User]:
+        """Iterate users without pulling every snapshot record into memory"""
+        return (self._peek(email) for email in self)
+
+SNAPSHOT_FORMATS = ("json", "binary")
+
+class JsonUserStorage(UserStorage):
+    """In-memory users persisted as a snapshot plus a JSON change journal.
+
+    With snapshot_format="binary" the snapshot is a memory-mapped
+    BinaryUserSnapshot (users.snap next to users.json) that is opened lazily,
+    so startup time no longer depends on the number of users; an existing
+    users.json is converted on first load.
+
+    locked() serializes read-modify-write sequences between threads; with
+    shared=True several processes (uvicorn --workers) can use the same
+    files. Writes take an exclusive flock on users.json.lock and go straight
+    to the journal; each process remembers the snapshot generation (inode,
+    mtime, size) and how far into the journal it has read, and before serving
+    a read it applies just the journal records other processes appended since.
+    A compaction by another process changes the generation and triggers a
+    full reload.
+
+    Compaction runs on a background thread once the journal outgrows the
+    snapshot (see Journal). The write lock is held only while the state is
+    copied and while the new files are swapped in, not while the snapshot
+    is serialized and written.
+    """
+
+    def __init__(self, db_file: str = "users.json", compact_ratio: float = 1.0,
+                 durability: str = "batched", flush_interval: float = 0.05, flush_batch_size: int = 512,
+                 snapshot_format: str = "json", shared: bool = False):
+        if snapshot_format not in SNAPSHOT_FORMATS:
+            raise ValueError(f"Unknown snapshot format: {snapshot_format}")
+        if shared and fcntl is None:
+            raise ValueError("Shared mode needs fcntl file locking, which this platform lacks")
+        self.db_file = db_file
+        self.snapshot_format = snapshot_format
+        if snapshot_format == "binary":
+            self.snapshot_file = f"{os.path.splitext(db_file)[0]}.snap"
+        else:
+            self.snapshot_file = db_file
+        self.journal = Journal(self.snapshot_file, f"{db_file}.journal", compact_ratio=compact_ratio)
+        self._reset()
+        self.durability = durability
+        self.shared = shared
+        # Snapshot identity and journal position this process has caught up to
+        self.generation: Optional[Tuple[int, int, int]] = None
+        self.journal_offset = 0
+        self._process_lock = threading.RLock()
+        self._lock_depth = 0
+        # Journal sequence number each thread must wait for once it leaves locked()
+        self._local = threading.local()
+        self._lock_file = open(f"{db_file}.lock", 'a+') if shared else None
+        # One compaction at a time, and at most one background compaction thread
+        self._compact_lock = threading.Lock()
+        self._schedule_lock = threading.Lock()
+        self._compaction_thread: Optional[threading.Thread] = None
+        # Other processes must see a change as soon as the write lock is released,
+        # so shared mode writes through instead of queueing
+        self.flusher = GroupCommitFlusher(self._write_records, "sync" if shared else durability,
+                                          flush_interval, flush_batch_size)
+
+    def _reset(self):
+        """Start from empty in-memory state"""
+        if self.snapshot_format == "binary":
+            self.users = LayeredUsers()
+        else:
+            self.users: Dict[str, User] = {}
+        self.promo_codes: Dict[str, PromoCode] = {}
+        # Promo codes are compiled whenever they are loaded or saved
+        self.promo_rules: Dict[str, CompiledPromo] = {}
+        self.index = UserIndex()
+        # In binary mode the role/premium indexes only cover loaded users
+        # until a filtered query needs them all
+        self._index_complete = self.snapshot_format != "binary"
+        # Sorted emails for cursor pagination, built on first use (JSON snapshots only)
+        self._sorted_emails: Optional[List[str]] = None
+
+    def _snapshot_generation(self) -> Optional[Tuple[int, int, int]]:
+        """Identity of the snapshot file; every compaction replaces it"""
+        try:
+            stat = os.stat(self.snapshot_file)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def is_stale(self) -> bool:
+        """Whether another process has changed the files since this one last read them"""
+        return self._snapshot_generation() != self.generation or self.journal.size() != self.journal_offset
+
+    def refresh(self):
+        """Pick up changes made by other processes (shared mode only)"""
+        if self.shared and self.is_stale():
+            with self.locked():
+                pass
+
+    @contextmanager
+    def locked(self, catch_up: bool = True):
+        """Hold the write lock: per process, plus in shared mode the cross-process
+        file lock with in-memory state caught up to disk"""
+        with self._process_lock:
+            self._lock_depth += 1
+            try:
+                if self._lock_depth == 1 and self.shared:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+                    if catch_up:
+                        self._catch_up()
+                yield
+            finally:
+                self._lock_depth -= 1
+                outermost = self._lock_depth == 0
+                if outermost and self.shared:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        # Wait for journal writes only once the lock is released, so batched
+        # durability still groups concurrent writers into one fsync
+        if outermost:
+            sequence = getattr(self._local, 'sequence', 0)
+            self._local.sequence = 0
+            self.flusher.wait_for(sequence)
+
+    def _catch_up(self):
+        """Apply changes written by other processes; caller holds the file lock"""
+        if self._snapshot_generation() != self.generation:
+            self._reset()
+            self._load()
+            self._notify(None, None)
+            return
+        records, self.journal_offset = self.journal.read_from(self.journal_offset)
+        for record in records:
+            self._apply_record(record)
+            key = record['data'].get('email' if record['op'] == 'user' else 'code')
+            self._notify(record['op'], key)
+
+    def _notify(self, op: Optional[str], key: Optional[str]):
+        if self.on_external_change is not None:
+            self.on_external_change(op, key)
+
+    def load(self) -> bool:
+        """Load the snapshot and replay the change journal"""
+        with self.locked(catch_up=False):
+            return self._load()
+
+    def _load(self) -> bool:
+        # Another process's compaction may have replaced the journal file
+        self.journal.close()
+        self.generation = self._snapshot_generation()
+        self.journal_offset = 0
+        if self.snapshot_format == "binary":
+            if not os.path.exists(self.snapshot_file) and os.path.exists(self.db_file):
+                convert_json_database(self.db_file, self.snapshot_file)
+            if not self.journal.exists():
+                return False
+
+            if os.path.exists(self.snapshot_file):
+                self.users.reset(BinaryUserSnapshot(self.snapshot_file))
+                for promo in self.users.snapshot.promo_codes():
+                    self._put_promo(promo)
+        else:
+            if not self.journal.exists():
+                return False
+
+            data = self.journal.read_snapshot() or {}
+            for user_data in data.get('users', []):
+                self._put_user(User(**user_data))
+
+            for promo_data in data.get('promo_codes', []):
+                self._put_promo(PromoCode(**promo_data))
+
+        for record in self.journal.replay():
+            self._apply_record(record)
+        self.generation = self._snapshot_generation()
+        self.journal_offset = self.journal.size()
+        return True
+
+    def compact(self, only_if_due: bool = False):
+        """Compact all users into a fresh snapshot.
+
+        With only_if_due, skip it unless the journal still needs compacting
+        once caught up, since another worker may just have done it.
+        """
+        with self._compact_lock:
+            # Copy the state with journal writes held off, so it covers
+            # exactly the journal up to keep_from
+            with self.locked(), self.flusher.paused():
+                if only_if_due and not self.journal.needs_compaction():
+                    return
+                users = [user.to_dict() for user in list(self.users.values())]
+                promos = [promo.to_dict() for promo in list(self.promo_codes.values())]
+                keep_from = self.journal.size()
+                generation = self.generation
+
+            # Serializing and fsyncing the snapshot is the slow part; writers carry on meanwhile
+            if self.snapshot_format == "binary":
+                tmp_file = self.journal.prepare_snapshot(lambda path: write_snapshot(path, users, promos))
+            else:
+                tmp_file = self.journal.prepare_snapshot(
+                    lambda path: write_json_snapshot(path, {'users': users, 'promo_codes': promos})
+                )
+
+            with self.locked(), self.flusher.paused():
+                if self.generation != generation or self.journal.size() < keep_from:
+                    # Another process compacted in the meantime; keep its snapshot
+                    os.remove(tmp_file)
+                    return
+                self.journal.install_snapshot(tmp_file, keep_from)
+                if self.snapshot_format == "binary":
+                    # The old snapshot is not closed here: iterators still walking it
+                    # keep it mapped until they finish, then it is garbage collected.
+                    # Users changed since the copy stay in the overlay.
+                    self.users.reset(BinaryUserSnapshot(self.snapshot_file))
+                self.generation = self._snapshot_generation()
+                self.journal_offset = self.journal.size()
+
+    def _schedule_compaction(self):
+        """Start a background compaction unless one is already running"""
+        with self._schedule_lock:
+            if self._compaction_thread is not None and self._compaction_thread.is_alive():
+                return
+            self._compaction_thread = threading.Thread(target=self._compact_in_background,
+                                                       name="journal-compaction", daemon=True)
+            self._compaction_thread.start()
+
+    def _compact_in_background(self):
+        try:
+            self.compact(only_if_due=True)
+        except Exception as e:
+            logger.error("Journal compaction failed: %s", e)
+
+    def close(self):
+        thread = self._compaction_thread
+        if thread is not None:
+            thread.join()
+        self.flusher.close()
+        self.journal.close()
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _apply_record(self, record: Dict):
+        """Apply a replayed journal record to the in-memory state"""
+        if record['op'] == 'user':
+            self._put_user(User(**record['data']))
+        elif record['op'] == 'promo':
+            self._put_promo(PromoCode(**record['data']))
+
+    def _record_change(self, op: str, data: Dict):
+        """Queue a change for the journal, compacting in the background when it grows too long.
+
+        Callers hold locked(), which waits for the write once it is released.
+        """
+        self._local.sequence = self.flusher.enqueue({'op': op, 'data': data})
+        if self.journal.needs_compaction():
+            self._schedule_compaction()
+
+    def _write_records(self, records: List[Dict]):
+        """Write a group-committed batch of records to the journal"""
+        if not self.shared:
+            # The flusher thread writes these; it must not wait on locked(),
+            # which the submitting thread may still hold
+            self.journal.append_batch(records, fsync=self.durability != "async")
+            return
+        # Shared mode writes synchronously from the thread holding locked()
+        with self.locked():
+            self.journal.append_batch(records, fsync=self.durability != "async")
+            self.journal_offset = self.journal.size()
+
+    def _put_user(self, user: User):
+        email = user.email.lower()
+        if self._sorted_emails is not None and email not in self.users:
+            bisect.insort(self._sorted_emails, email)
+        self.users[email] = user
+        self.index.add(email, user)
+
+    def _put_promo(self, promo: PromoCode):
+        code = promo.code.upper()
+        self.promo_codes[code] = promo
+        self.promo_rules[code] = CompiledPromo(promo)
+
+    def get_user(self, email: str) -> Optional[User]:
+        self.refresh()
+        user = self.users.get(email)
+        if user is not None and not self._index_complete:
+            self.index.add(email, user)
+        return user
+
+    def get_user_by_id(self, user_id: str) -> Optional[User]:
+        self.refresh()
+        user = self.index.by_id.get(user_id)
+        if user is None and not self._index_complete and self.users.snapshot is not None:
+            user = self.users.snapshot.get_by_id(user_id)
+            if user is not None:
+                user = self.get_user(user.email.lower())
+        return user
+
+    def save_user(self, user: User):
+        with self.locked():
+            self._put_user(user)
+            self._record_change('user', user.to_dict())
+
+    def save_users(self, users: List[User]):
+        # Inserting one by one into the sorted email list is quadratic for
+        # large batches; drop it and let the next paginated read rebuild it
+        with self.locked():
+            self._sorted_emails = None
+            for user in users:
+                self._put_user(user)
+            # Queued records are flushed first, then the batch goes out as one
+            # journal append
+            with self.flusher.paused():
+                self._write_records([{'op': 'user', 'data': user.to_dict()} for user in users])
+        if self.journal.needs_compaction():
+            self._schedule_compaction()
+
+    def iter_users(self) -> Iterator[User]:
+        self.refresh()
+        if self.snapshot_format == "binary":
+            return self.users.values()
+        return iter(list(self.users.values()))
+
+    def find_users(self, role: Optional[str] = None, is_premium: Optional[bool] = None,
+                   premium_plan: Optional[str] = None) -> Iterator[User]:
+        self.refresh()
+        if role is None and is_premium is None and premium_plan is None:
+            return self.iter_users()
+        if not self._index_complete:
+            # Filtering a lazily loaded snapshot needs every user indexed once
+            for email in list(self.users):
+                self.index.add(email, self.users[email])
+            self._index_complete = True
+        emails = self.index.match(role, is_premium, premium_plan)
+        return (self.users[email] for email in sorted(emails))
+
+    def _walk_sorted_emails(self, after_email: Optional[str]) -> Iterator[str]:
+        """Walk the sorted email list by value, so concurrent inserts can't shift the walk"""
+        emails = self._sorted_emails
+        position = bisect.bisect_right(emails, after_email) if after_email is not None else 0
+        while position < len(emails):
+            email = emails[position]
+            yield email
+            position = bisect.bisect_right(emails, email)
+
+    def iter_users_after(self, after_email: Optional[str] = None, role: Optional[str] = None,
+                         is_premium: Optional[bool] = None, premium_plan: Optional[str] = None,
+                         created_from: Optional[str] = None, created_to: Optional[str] = None) -> Iterator[User]:
+        self.refresh()
+        if self.snapshot_format == "binary":
+            emails = self.users.iter_emails(after_email)
+            get_user = self.users._peek
+        else:
+            if self._sorted_emails is None:
+                self._sorted_emails = sorted(self.users)
+            emails = self._walk_sorted_emails(after_email)
+            get_user = self.users.get
+
+        for email in emails:
+            user = get_user(email)
+            if user is not None and user_matches(user, role, is_premium, premium_plan, created_from, created_to):
+                yield user
+
+    def get_promo(self, code: str) -> Optional[PromoCode]:
+        self.refresh()
+        return self.promo_codes.get(code)
+
+    def save_promo(self, promo: PromoCode):
+        with self.locked():
+            self._put_promo(promo)
+            self._record_change('promo', promo.to_dict())
+
+    def iter_promos(self) -> Iterator[PromoCode]:
+        self.refresh()
+        return iter(list(self.promo_codes.values()))
+
+    def get_promo_rule(self, code: str) -> Optional[CompiledPromo]:
+        self.refresh()
+        return self.promo_rules.get(code)
+
+    def create_promo_counter(self, **options) -> PromoUsageCounter:
+        # Reservations must be visible to every worker sharing the files
+        if self.shared:
+            return SharedPromoUsageCounter(self, **options)
+        return PromoUsageCounter(self, **options)
+
+class _SQLiteMapping(Mapping):
+    """Read-only dict view over a SQLite table, keyed by its primary key"""
+
+    def __init__(self, storage: "SQLiteUserStorage", table: str, key: str):
+        self._storage = storage
+        self._table = table
+        self._key = key
+
+    def __getitem__(self, key):
+        item = self._storage._get(self._table, self._key, key)
+        if item is None:
+            raise KeyError(key)
+        return item
+
+    def __iter__(self):
+        cursor = self._storage._conn().execute(f"SELECT {self._key} FROM {self._table}")
+        return (row[0] for row in cursor)
+
+    def __len__(self):
+        return self._storage._conn().execute(f"SELECT COUNT(*) FROM {self._table}").fetchone()[0]
+
+    def values(self):
+        return self._storage._iter(self._table)
+
+# Durability modes map onto SQLite's own commit syncing; batching writes in
+# memory would hide them from other workers reading the same database
+SQLITE_SYNCHRONOUS = {
+    'sync': 'FULL',
+    'batched': 'NORMAL',
+    'async': 'OFF',
+}
+
+# Change-log rows kept for processes that have not caught up yet
+CHANGE_LOG_KEEP = 10000
+
+class SQLiteUserStorage(UserStorage):
+    """SQLite (WAL mode) storage shared safely by several worker processes"""
+
+    def __init__(self, db_file: str = "users.db", timeout: float = 30.0, durability: str = "batched"):
+        if durability not in SQLITE_SYNCHRONOUS:
+            raise ValueError(f"Unknown durability mode: {durability}")
+        self.db_file = db_file
+        self.timeout = timeout
+        self.durability = durability
+        self._local = threading.local()
+        self.users = _SQLiteMapping(self, 'users', 'email')
+        self.promo_codes = _SQLiteMapping(self, 'promo_codes', 'code')
+        # Compiled promo rules by code, dropped whenever a promo may have changed;
+        # the generation keeps a rule compiled from a row read before an
+        # invalidation from being cached after it
+        self._promo_rules: Dict[str, CompiledPromo] = {}
+        self._promo_generation = 0
+        self._promo_lock = threading.Lock()
+        # Last change-log row this process has acted on, shared by all its threads
+        self._change_seq = 0
+        self._change_lock = threading.Lock()
+
+    def _conn(self) -> sqlite3.Connection:
+        """Get this thread's connection, opening it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=self.timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS[self.durability]}")
+            self._local.conn = conn
+            # Seed the baseline so a new connection does not look like a change
+            self._local.data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        return conn
+
+    def load(self) -> bool:
+        """Create tables and indexes; returns False when the database is new"""
+        conn = self._conn()
+        is_new = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name='users'"
+        ).fetchone() is None
+        with conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS users (
+                    email TEXT PRIMARY KEY,
+                    id TEXT NOT NULL,
+                    password_hash TEXT NOT NULL,
+                    first_name TEXT,
+                    last_name TEXT,
+                    is_premium INTEGER NOT NULL DEFAULT 0,
+                    premium_plan TEXT,
+                    created_at TEXT,
+                    last_login TEXT,
+                    is_active INTEGER NOT NULL DEFAULT 1,
+                    role TEXT NOT NULL DEFAULT 'user'
+                )"""
+            )
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_id ON users (id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_users_role ON users (role)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_users_premium ON users (is_premium, premium_plan)")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS promo_codes (
+                    code TEXT PRIMARY KEY,
+                    discount_percentage REAL NOT NULL,
+                    discount_amount REAL,
+                    valid_from TEXT,
+                    valid_until TEXT,
+                    usage_limit INTEGER,
+                    used_count INTEGER NOT NULL DEFAULT 0,
+                    is_active INTEGER NOT NULL DEFAULT 1,
+                    applicable_to TEXT NOT NULL DEFAULT 'all',
+                    minimum_order REAL NOT NULL DEFAULT 0
+                )"""
+            )
+            # Every row write is logged so other processes can invalidate just
+            # the users and promos that changed
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS changes (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    op TEXT NOT NULL,
+                    key TEXT NOT NULL
+                )"""
+            )
+            for table, op, key in (('users', 'user', 'email'), ('promo_codes', 'promo', 'code')):
+                for event in ('INSERT', 'UPDATE'):
+                    conn.execute(
+                        f"CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_log AFTER {event} ON {table} "
+                        f"BEGIN INSERT INTO changes (op, key) VALUES ('{op}', NEW.{key}); END"
+                    )
+        with self._change_lock:
+            self._change_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+        return not is_new
+
+    def refresh(self):
+        """Act on commits made through other connections since this thread last looked"""
+        conn = self._conn()
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self._local.data_version:
+            return
+        self._local.data_version = data_version
+        with self._change_lock:
+            last_seq = self._change_seq
+            rows = conn.execute(
+                "SELECT seq, op, key FROM changes WHERE seq > ? ORDER BY seq", (last_seq,)
+            ).fetchall()
+            if not rows:
+                return
+            self._change_seq = rows[-1][0]
+            first_seq = conn.execute("SELECT MIN(seq) FROM changes").fetchone()[0]
+        # Rows this process never saw were pruned, so anything may have changed
+        missed = first_seq > last_seq + 1
+        changed = {(op, key) for _, op, key in rows}
+        if missed or any(op == 'promo' for op, _ in changed):
+            self.invalidate_promo_rules()
+        if self.on_external_change is not None:
+            if missed:
+                self.on_external_change(None, None)
+            else:
+                for op, key in changed:
+                    self.on_external_change(op, key)
+        if self._change_seq - first_seq >= 2 * CHANGE_LOG_KEEP:
+            with self._writing() as conn:
+                conn.execute("DELETE FROM changes WHERE seq <= ?", (self._change_seq - CHANGE_LOG_KEEP,))
+
+    def invalidate_promo_rules(self):
+        """Forget compiled promo rules; data_version misses this connection's own commits"""
+        with self._promo_lock:
+            self._promo_rules = {}
+            self._promo_generation += 1
+
+    def compact(self):
+        """Checkpoint the write-ahead log into the main database file"""
+        self._conn().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    @contextmanager
+    def locked(self):
+        """Run a read-modify-write sequence in one BEGIN IMMEDIATE transaction.
+
+        The write lock is taken up front, so reads inside see the latest rows
+        and no other connection can change them before the writes commit.
+        """
+        conn = self._conn()
+        depth = getattr(self._local, 'lock_depth', 0)
+        self._local.lock_depth = depth + 1
+        try:
+            if depth:
+                yield
+                return
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+        finally:
+            self._local.lock_depth = depth
+
+    @contextmanager
+    def _writing(self) -> Iterator[sqlite3.Connection]:
+        """Commit writes on exit, unless they belong to an enclosing locked() transaction"""
+        conn = self._conn()
+        if getattr(self._local, 'lock_depth', 0):
+            yield conn
+        else:
+            with conn:
+                yield conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    @staticmethod
+    def _user_from_row(row) -> User:
+        user = User(*row)
+        user.is_premium = bool(user.is_premium)
+        user.is_active = bool(user.is_active)
+        return user
+
+    @staticmethod
+    def _promo_from_row(row) -> PromoCode:
+        promo = PromoCode(*row)
+        promo.is_active = bool(promo.is_active)
+        return promo
+
+    def _columns(self, table: str):
+        return USER_COLUMNS if table == 'users' else PROMO_COLUMNS
+
+    def _from_row(self, table: str, row):
+        return self._user_from_row(row) if table == 'users' else self._promo_from_row(row)
+
+    def _get(self, table: str, key: str, value):
+        row = self._conn().execute(
+            f"SELECT {', '.join(self._columns(table))} FROM {table} WHERE {key} = ?", (value,)
+        ).fetchone()
+        return self._from_row(table, row) if row else None
+
+    def _iter(self, table: str) -> Iterator:
+        cursor = self._conn().execute(f"SELECT {', '.join(self._columns(table))} FROM {table}")
+        return (self._from_row(table, row) for row in cursor)
+
+    def _upsert(self, table: str, item):
+        self._upsert_many(table, [item])
+
+    def _upsert_many(self, table: str, items: List):
+        columns = self._columns(table)
+        with self._writing() as conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' for _ in columns)})",
+                (tuple(getattr(item, column) for column in columns) for item in items)
+            )
+
+    def get_user(self, email: str) -> Optional[User]:
+        return self._get('users', 'email', email)
+
+    def get_user_by_id(self, user_id: str) -> Optional[User]:
+        return self._get('users', 'id', user_id)
+
+    def save_user(self, user: User):
+        self._upsert('users', user)
+
+    def add_user(self, user: User) -> bool:
+        # A plain INSERT lets the email primary key reject a concurrent duplicate
+        try:
+            with self._writing() as conn:
+                conn.execute(
+                    f"INSERT INTO users ({', '.join(USER_COLUMNS)}) VALUES ({', '.join('?' for _ in USER_COLUMNS)})",
+                    tuple(getattr(user, column) for column in USER_COLUMNS)
+                )
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def save_users(self, users: List[User]):
+        self._upsert_many('users', users)
+
+    def iter_users(self) -> Iterator[User]:
+        return self._iter('users')
+
+    def find_users(self, role: Optional[str] = None, is_premium: Optional[bool] = None,
+                   premium_plan: Optional[str] = None) -> Iterator[User]:
+        clauses = []
+        params = []
+        if role is not None:
+            clauses.append("role = ?")
+            params.append(role)
+        if is_premium is not None:
+            clauses.append("is_premium = ?")
+            params.append(int(is_premium))
+        if premium_plan is not None:
+            clauses.append("premium_plan = ?")
+            params.append(premium_plan)
+
+        query = f"SELECT {', '.join(USER_COLUMNS)} FROM users"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        cursor = self._conn().execute(query + " ORDER BY email", params)
+        return (self._user_from_row(row) for row in cursor)
+
+    def iter_users_after(self, after_email: Optional[str] = None, role: Optional[str] = None,
+                         is_premium: Optional[bool] = None, premium_plan: Optional[str] = None,
+                         created_from: Optional[str] = None, created_to: Optional[str] = None,
+                         page_size: int = 500) -> Iterator[User]:
+        filters = [
+            ("role = ?", role),
+            ("is_premium = ?", None if is_premium is None else int(is_premium)),
+            ("premium_plan = ?", premium_plan),
+            ("created_at >= ?", created_from),
+            ("created_at <= ?", created_to),
+        ]
+        clauses = [clause for clause, value in filters if value is not None]
+        params = [value for _, value in filters if value is not None]
+
+        # Walk the email primary key in pages so no cursor stays open between pages
+        while True:
+            page_clauses = clauses + (["email > ?"] if after_email is not None else [])
+            page_params = params + ([after_email] if after_email is not None else [])
+            query = f"SELECT {', '.join(USER_COLUMNS)} FROM users"
+            if page_clauses:
+                query += " WHERE " + " AND ".join(page_clauses)
+            rows = self._conn().execute(query + " ORDER BY email LIMIT ?", page_params + [page_size]).fetchall()
+            for row in rows:
+                yield self._user_from_row(row)
+            if len(rows) < page_size:
+                return
+            after_email = rows[-1][USER_COLUMNS.index('email')]
+
+    def get_promo(self, code: str) -> Optional[PromoCode]:
+        return self._get('promo_codes', 'code', code)
+
+    def save_promo(self, promo: PromoCode):
+        self._upsert('promo_codes', promo)
+        self.invalidate_promo_rules()
+
+    def iter_promos(self) -> Iterator[PromoCode]:
+        return self._iter('promo_codes')
+
+    def get_promo_rule(self, code: str) -> Optional[CompiledPromo]:
+        self.refresh()
+        rule = self._promo_rules.get(code)
+        if rule is None:
+            generation = self._promo_generation
+            promo = self.get_promo(code)
+            if promo is None:
+                return None
+            rule = CompiledPromo(promo)
+            with self._promo_lock:
+                if generation == self._promo_generation:
+                    self._promo_rules[code] = rule
+        return rule
+
+    def create_promo_counter(self, **options) -> SQLitePromoUsageCounter:
+        return SQLitePromoUsageCounter(self, **options)
+
+STORAGE_BACKENDS = {
+    'json': JsonUserStorage,
+    'sqlite': SQLiteUserStorage,
+}
+
+def create_storage(backend: str = "json", db_file: Optional[str] = None, **options) -> UserStorage:
+    """Build a storage backend by name ("json" or "sqlite")"""
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown user storage backend: {backend}")
+    if db_file is None:
+        db_file = "users.db" if backend == 'sqlite' else "users.json"
+    return STORAGE_BACKENDS[backend](db_file, **options)